@@ -1,41 +1,265 @@
-import socket
 import os
+import json
+import time
+import socket
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
 
-from broker import MessageBroker
-from res import app_logger
+from broker import MessageBroker, get_workers
+from res import app_logger, status, protocol, config_tool, metrics, throttle, workers as task_workers
 logger = app_logger.get_logger(__name__)
 
+STATUS_REFRESH = 1
+LAUNCH_WORKERS = 4
+MIB = 1024 * 1024
+DATAGRAM_SUFFIX = '.dgram'
+# longest datagram reply, larger ones are answered with an error
+DATAGRAM_LIMIT = 64 * 1024
+# frames of a stream connection in flight, it isn't read further until replies go out
+PIPELINE_LIMIT = 64
+# commands timed under their own name in the request metrics, others as 'other'
+COMMANDS = ('status', 'metrics', 'throttle', 'backup', 'restore', 'cancel', 'read')
 
-def main_server(unix_socket="/tmp/oV_backup_unix_socket"):
-    if os.path.exists(unix_socket):
-        os.remove(unix_socket)
 
-    logger.debug("Opening socket...")
-    server = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
-    logger.debug('UNIX_SOCKET: ' + unix_socket)
-    server.bind(unix_socket)
+class ControlServer(asyncio.DatagramProtocol):
+    """Asyncio control daemon.
+
+    Status queries are answered from self.status, which a background coroutine
+    refreshes from the task files, so they never wait for disk or for a task
+    launch. Launches run on a small thread pool off the event loop.
+
+    The main socket is a stream socket speaking length-prefixed JSON frames
+    (see res/protocol.py). A frame holds one command or a list of commands,
+    answered by one reply or a list of replies in the same order, and a client
+    may pipeline frames on a connection: they are executed concurrently and
+    answered in the order they were sent. Past PIPELINE_LIMIT frames waiting
+    for their reply the connection isn't read, so a client that doesn't read
+    its replies doesn't make the daemon buffer them. The old
+    one-command-per-datagram socket is still served next to it with the
+    DATAGRAM_SUFFIX, for replies up to DATAGRAM_LIMIT bytes.
+
+    The 'metrics' command returns the daemon and worker metrics in Prometheus
+    text format, they are also written to metrics_file if it is configured.
+
+    The 'throttle' command changes the copy rate limits (MiB/s, 0 unlimited)
+    of the daemon and of its priority classes, e.g. {"task": "throttle",
+    "read": 200, "classes": {"background": {"read": 50, "write": 50}}}, and
+    returns the limits in force. Running copies follow at their next block.
+
+    The 'read' command returns a byte range of a backed-up disk from its
+    framed (*-mt) image without restoring it, e.g. {"task": "read",
+    "engine": "engine1", "path": "<backup dir of the VM>", "disk":
+    "<alias>_<id>", "offset": 0, "length": 65536}, the data base64 encoded.
+    """
+    def __init__(self, unix_socket):
+        self.unix_socket = unix_socket
+        self.datagram_socket = unix_socket + DATAGRAM_SUFFIX
+        self.executor = ThreadPoolExecutor(max_workers=LAUNCH_WORKERS)
+        self.transport = None
+        self.status = dict()
+        self.throttle = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, addr):
+        asyncio.get_running_loop().create_task(self.handle(data, addr))
+
+    def error_received(self, exc):
+        logger.error(f'Datagram reply error: {exc!r}')
+
+    async def serve(self):
+        for path in (self.unix_socket, self.datagram_socket):
+            if os.path.exists(path):
+                os.remove(path)
+
+        logger.debug("Opening socket...")
+        logger.debug('UNIX_SOCKET: ' + self.unix_socket)
+        server = await asyncio.start_unix_server(self.handle_stream, path=self.unix_socket)
+
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        sock.bind(self.datagram_socket)
+        loop = asyncio.get_running_loop()
+        await loop.create_datagram_endpoint(lambda: self, sock=sock)
+        config = config_tool.ConfigTool()
+        # limits of the config, changes made at runtime last until a restart
+        self.throttle = throttle.get_throttle(config.get_throttle_file())
+        self.throttle.set_limits(
+            read=config.get_throttle('read'),
+            write=config.get_throttle('write'),
+            classes={
+                io_class: {direction: config.get_throttle(direction, io_class) for direction in throttle.DIRECTIONS}
+                for io_class in throttle.CLASSES
+            },
+        )
+        # workers start warming up before the first task arrives
+        workers = await loop.run_in_executor(self.executor, get_workers)
+        exporter = None
+        if config.get_metrics_file():
+            exporter = loop.create_task(self.export_metrics(config.get_metrics_file(), config.get_metrics_interval()))
+        logger.debug("Listening...")
+        try:
+            await self.refresh_status()
+        finally:
+            if exporter:
+                exporter.cancel()
+            workers.close()
+            server.close()
+            self.transport.close()
+            self.executor.shutdown(wait=False)
+            for path in (self.unix_socket, self.datagram_socket):
+                if os.path.exists(path):
+                    os.remove(path)
+
+    async def refresh_status(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            try:
+                self.status = await loop.run_in_executor(self.executor, status.Status().get) or dict()
+            except:
+                logger.exception('Status refresh error: ')
+            await asyncio.sleep(STATUS_REFRESH)
 
-    logger.debug("Listening...")
-    while True:
+    async def export_metrics(self, path, interval):
+        loop = asyncio.get_running_loop()
+        while True:
+            try:
+                await loop.run_in_executor(self.executor, metrics.write_file, path, self.render_metrics())
+            except:
+                logger.exception('Metrics export error: ')
+            await asyncio.sleep(interval)
+
+    @staticmethod
+    def render_metrics():
+        return metrics.render([metrics.get_metrics().snapshot()] + task_workers.get_metrics_snapshots())
+
+    async def handle(self, data, addr):
+        try:
+            message = json.loads(data.decode('utf-8'))
+            result = await self.execute(message)
+            send_data = result if isinstance(result, str) else json.dumps(result)
+        except:
+            logger.exception('Request error: ')
+            send_data = json.dumps({'error': 'bad request'})
+        if not addr:
+            return
+        reply = str(send_data).encode('utf-8')
+        if len(reply) > DATAGRAM_LIMIT:
+            logger.error(f'Reply of {len(reply)} bytes does not fit in a datagram')
+            reply = json.dumps({'error': 'reply too large for a datagram, use the stream socket'}).encode('utf-8')
+        try:
+            self.transport.sendto(reply, addr)
+        except:
+            logger.exception('Datagram reply error: ')
+
+    async def handle_stream(self, reader, writer):
+        # replies are queued in request order while the commands run concurrently
+        replies = asyncio.Queue(maxsize=PIPELINE_LIMIT)
+        sender = asyncio.get_running_loop().create_task(self.send_replies(writer, replies))
+        try:
+            while True:
+                message = await protocol.read_message(reader)
+                if message is None:
+                    break
+                await replies.put(asyncio.ensure_future(self.execute_frame(message)))
+        except (protocol.ProtocolError, ValueError, ConnectionError):
+            logger.exception('Stream request error: ')
+        finally:
+            await replies.put(None)
+            await sender
+
+    @staticmethod
+    async def send_replies(writer, replies):
+        try:
+            while True:
+                reply = await replies.get()
+                if reply is None:
+                    break
+                reply = await reply
+                if writer.is_closing():
+                    # keep draining, handle_stream may be waiting for room in the queue
+                    continue
+                try:
+                    writer.write(protocol.encode(reply))
+                    await writer.drain()
+                except ConnectionError:
+                    logger.debug('Client went away')
+                    writer.close()
+        finally:
+            writer.close()
+
+    async def execute_frame(self, message):
+        if isinstance(message, list):
+            return list(await asyncio.gather(*[self.execute_safe(command) for command in message]))
+        return await self.execute_safe(message)
+
+    async def execute_safe(self, command):
         try:
-            data = server.recv(1024)
-        except KeyboardInterrupt:
-            break
+            return await self.execute(command)
         except:
-            logger.exception('Listening socket error: ')
-            break
+            logger.exception('Request error: ')
+            return {'error': 'bad request'}
 
-        data = data.decode('utf-8')
-        logger.debug(data)
+    async def execute(self, command):
+        started = time.monotonic()
+        logger.debug(command)
+        try:
+            if command['task'] == 'metrics':
+                return self.render_metrics()
+            if command['task'] == 'throttle':
+                return self.set_throttle(command)
+            if command['task'] == 'status':
+                ids = command.get('ids')
+                if ids is None:
+                    return self.status
+                found = {task_id: self.status[task_id] for task_id in ids if task_id in self.status}
+                missing = [task_id for task_id in ids if task_id not in found]
+                if missing:
+                    # older tasks come straight from the task registry
+                    loop = asyncio.get_running_loop()
+                    found.update(await loop.run_in_executor(self.executor, status.Status().get, missing))
+                return found
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(self.executor, self.launch, json.dumps(command))
+        finally:
+            name = command.get('task') if isinstance(command, dict) else None
+            metrics.get_metrics().observe('ovbackup_control_request_seconds', time.monotonic() - started,
+                                          command=name if name in COMMANDS else 'other')
+
+    def set_throttle(self, command):
+        classes = {
+            io_class: {direction: rate * MIB for direction, rate in rates.items() if rate is not None}
+            for io_class, rates in command.get('classes', dict()).items()
+        }
+        read, write = (command.get(direction) for direction in throttle.DIRECTIONS)
+        self.throttle.set_limits(
+            read=None if read is None else read * MIB,
+            write=None if write is None else write * MIB,
+            classes=classes,
+        )
+        limits = self.throttle.limits()
+        return {
+            'read': limits['read'] / MIB,
+            'write': limits['write'] / MIB,
+            'classes': {
+                io_class: {direction: rate / MIB for direction, rate in rates.items()}
+                for io_class, rates in limits['classes'].items()
+            },
+        }
 
-        parser = MessageBroker(data)
-        send_data = parser.run()
-        server.send(send_data.encode('utf-8'))
+    @staticmethod
+    def launch(message):
+        return MessageBroker(message).run()
 
+
+def main_server(unix_socket="/tmp/oV_backup_unix_socket"):
+    server = ControlServer(unix_socket)
+    try:
+        asyncio.run(server.serve())
+    except KeyboardInterrupt:
+        pass
     logger.debug("-" * 20)
     logger.debug("Shutting down...")
-    server.close()
-    os.remove(unix_socket)
     logger.debug("Done")
 
 
@@ -1,16 +1,35 @@
 import os
-import time
 import glob
 import json
+import base64
+import threading
+import shlex
+import signal
 import subprocess
+from functools import partial
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
 import ovirtsdk4 as sdk
 from ovirtsdk4 import types
 
-from res import app_logger, config_tool
+from res import app_logger, config_tool, copy_engine, chunk_store, poller, discovery, inventory, progress
+from res import connection_pool, metrics, codec_select, throttle, storage
 from res import utils
 from res import status
+from res import workers as task_workers
 logger = app_logger.get_logger(__name__)
 
+# VM names per OR'ed search of the metadata collector
+METADATA_BATCH = 50
+# largest range of one read command, base64 of it has to fit in a protocol frame
+READ_LIMIT = 16 * 1024 * 1024
+# a cancelled task stops at its next check or block of a copy
+CANCELLED = (task_workers.TaskCancelled, copy_engine.CopyCancelled)
+
+
+class TaskError(Exception):
+    pass
+
 
 class Api:
     def __init__(self, settings, task_id):
@@ -24,10 +43,21 @@ class Api:
         self.main_backup_dir = self.config.get_backup_dir()
         self.tmp = self.config.get_tmp()
         self.status = status.Status()
-        self.status.info_file(task_id)
+        self.status.status_file(task_id)
+        self.api_lock = threading.Lock()
+        self.poller = poller.StatusPoller(self.api_lock)
+        self.inventory = inventory.get_inventory(self.settings['engine'], self.config.get_inventory_ttl())
+        self.pool = connection_pool.get_pool(self.settings['engine'], self.config)
+        self.pooled = None
+        self.cancel = task_workers.cancel_event()
+        self.metrics = metrics.get_metrics()
+        io_class = self.settings.get('io_class') or throttle.DEFAULT_CLASS.get(self.settings['task'], 'normal')
+        self.throttle = throttle.get_throttle(self.config.get_throttle_file()).limiter(io_class)
+        self.storage = storage.get_storage(self.config)
 
         self.api_service = None
         self.vms_service = None
+        self.backup_vm_id = None
         self.backup_vm_service = None
         self.vm_service = None
 
@@ -38,110 +68,466 @@ class Api:
 
     def __enter__(self):
         self.__get_api_service()
+        return self
 
     def __exit__(self, exc_type, exc_val, exc_tb):
-        self.__api_close()
+        self._api_close()
 
     def __get_api_service(self):
         logger.info('Connect to ovirt')
         try:
-            self.api = sdk.Connection(
-                url=self.url,
-                username=self.username,
-                password=self.password,
-                ca_file=self.ca_file,
-                # insecure=True,
-                # debug=True,
-            )
+            self.pooled = self.pool.borrow()
         except sdk.Error:
             logger.exception('Connection error: ')
         except:
             logger.exception('Unexpected Connection error: ')
         else:
+            self.api = self.pooled.connection
             self.api_service = self.api.system_service()
             self.vms_service = self.api_service.vms_service()
-            self.backup_vm_service = self.__get_vm_service(self.config.get_backup_server())
+            self.backup_vm_id = self.get_vm_id(self.config.get_backup_server())
+            self.backup_vm_service = self.vms_service.vm_service(self.backup_vm_id)
+
+    def _api_close(self):
+        if self.pooled is None:
+            return
+        logger.info(f'Inventory cache: {self.inventory.stats()}')
+        logger.info(f'Connection pool: {self.pool.stats()}')
+        self.poller.close()
+        self.pool.give_back(self.pooled)
+        self.pooled = None
 
-    def __api_close(self):
-        self.api.close()
+    def _attachments_service(self, connection):
+        """Disk attachments of the backup VM through a pooled connection."""
+        vm_service = connection.system_service().vms_service().vm_service(self.backup_vm_id)
+        return vm_service.disk_attachments_service()
+
+    def _stage(self, stage, vm=''):
+        """Time a stage of the task into the stage metrics."""
+        return self.metrics.stage(self.settings['task'], stage, vm)
 
     def get_vm_id(self, vm_name):
-        vm = self.vms_service.list(search=f'name={vm_name}')
-        try:
-            return vm[0].id
-        except IndexError:
-            logger.exception(f'Can`t get vm {vm_name}')
+        vm_id = self.inventory.vm_id(self.api_service, vm_name)
+        if vm_id is None:
+            logger.error(f'Can`t get vm {vm_name}')
+        return vm_id
 
-    def __get_vm_service(self, vm_name):
+    def _get_vm_service(self, vm_name):
         vm_id = self.get_vm_id(vm_name)
         try:
             return self.vms_service.vm_service(vm_id)
         except:
             logger.exception('Get vm service error: ')
 
-    def __find_disk(self, attachment):
+    def _waiting_for_attachment(self, attachments_service, attachment):
+        try:
+            self.poller.wait(attachments_service, attachment.id, lambda item: item.active,
+                             self.config.get_disk_finding_timeout())
+        except TimeoutError:
+            logger.error('Timeout disk attaching!')
+
+    @contextmanager
+    def _attached_disk(self, attachments_service, disk, interface, vm_name):
+        """Attach disk to the backup VM for the block, yields its device."""
+        task_workers.check_cancelled()
+        # ovirtsdk4 connection is not thread safe, workers borrow their own
+        with self._stage('attach', vm_name):
+            with self.pool.connection() as connection:
+                attachment = self._attachments_service(connection).add(
+                    attachment=types.DiskAttachment(
+                        disk=disk,
+                        active=True,
+                        bootable=False,
+                        interface=interface,
+                    )
+                )
+            self._waiting_for_attachment(attachments_service, attachment)
+        try:
+            with self._stage('find_disk', vm_name):
+                disk_image = self._find_disk(attachment)
+            yield disk_image
+        finally:
+            with self._stage('detach', vm_name), self.pool.connection() as connection:
+                self._attachments_service(connection).attachment_service(attachment.id).remove(wait=True)
+
+    def _find_disk(self, attachment):
+        logger.info('Searching for image')
         timeout = self.config.get_disk_finding_timeout()
-        pause = 5
-        tries = timeout // pause
-
-        for i in range(tries):
-            logger.info('Searching for image')
-            for path in glob.glob('/sys/block/*/serial'):
-                with open(path, 'r') as f:
-                    serial = f.read()
-                if serial == attachment.disk.id[:20]:
-                    disk_name = path.split('/')[3]
-                    return f'/dev/{disk_name}'
-            time.sleep(pause)
-        logger.error('Cannot find attached disk')
-
-    def __get_cluster_name(self, cluster_id):
-        clusters_service = self.api_service.clusters_service()
-        for cluster in clusters_service.list():
-            if cluster_id == cluster.id:
-                return cluster.name
-
-    def __get_nic_profile_name(self, nic_id):
-        nic_service = self.api_service.vnic_profiles_service()
-        for nic in nic_service.list():
-            if nic_id == nic.id:
-                return nic.name
-
-    def __get_nic_profile_id(self, nic_name):
-        nic_service = self.api_service.vnic_profiles_service()
-        for nic in nic_service.list():
-            if nic_name == nic.name:
-                return nic.id
-
-    def __get_shell_command(self, input_file, output_file, progress):
+        disk_image = discovery.get_discovery().wait(attachment.disk.id[:20], timeout)
+        if disk_image is None:
+            logger.error('Cannot find attached disk')
+        return disk_image
+
+    def _get_cluster_name(self, cluster_id):
+        return self.inventory.cluster_name(self.api_service, cluster_id)
+
+    def _get_nic_profile_name(self, nic_id):
+        return self.inventory.nic_profile_name(self.api_service, nic_id)
+
+    def _get_nic_profile_id(self, nic_name):
+        return self.inventory.nic_profile_id(self.api_service, nic_name)
+
+    def _copy_image(self, input_file, output_file, progress, disk_meta, vm_name=''):
+        # the codec of a disk is in its .meta, the job setting is for old backups
+        compress = disk_meta.get('compress') or self.task_settings['compress']
+        save = self.settings['task'] == 'backup'
+        # sparse images keep their extent map next to the .meta file
+        extents_file = (output_file if save else input_file) + '.extents'
+        sparse = self.config.get_sparse() if save else self.storage.exists(extents_file)
+        # streamed backends take the image from the native engine, the shell pipeline needs a path
+        native = self.config.get_copy_engine() == 'native' and (
+            self.storage.streamed or not self.config.get_remote_server())
+        if save and compress == codec_select.ADAPTIVE:
+            with self._stage('select_codec', vm_name):
+                compress = self.__select_codec(input_file, disk_meta, sparse, native)
+        # the chunk store and incremental images live next to local metadata
+        manifest_file = (output_file if save else input_file) + '.manifest'
+        if self.storage.posix and (self.config.get_chunk_store() if save else os.path.exists(manifest_file)):
+            return self.__copy_chunks(input_file, output_file, progress, disk_meta, manifest_file, compress, vm_name)
+        blocks_file = (output_file if save else input_file) + '.blocks'
+        if self.storage.posix and (self.config.get_incremental() if save else os.path.exists(blocks_file)):
+            # delta layers are written block by block, which needs an in-process codec
+            if copy_engine.is_supported(compress, save):
+                return self.__copy_delta(input_file, output_file, progress, disk_meta, blocks_file, compress,
+                                         vm_name)
+            if not save:
+                logger.error(f'Incremental image {input_file} requires the native copy engine')
+                return 1
+            logger.warning(f'Compression {compress} has no incremental mode, backing up {input_file} in full')
+        use_native = native and copy_engine.is_supported(compress, save)
+        if sparse and not use_native and not save:
+            logger.error(f'Sparse image {input_file} requires the native copy engine')
+            return 1
+        if not use_native and (utils.COMPRESS_TYPES[compress][1] is None or not self.storage.posix):
+            logger.error(f'Compression {compress} requires the native copy engine')
+            return 1
+        if not use_native:
+            disk_meta['sparse'] = 0
+            cmd = self.__get_shell_command(input_file, output_file, compress)
+            # pv reads the compressed image on restore, nothing local with a remote server
+            pv_input = input_file if save else input_file + utils.COMPRESS_TYPES[compress][0]
+            return self.__run_shell_command(cmd, None if self.config.get_remote_server() else pv_input, progress,
+                                            self.cancel)
+
+        extension = utils.COMPRESS_TYPES[compress][0]
+        engine = self.__copy_engine(self.config.get_copy_block_size(), progress, disk_meta)
+        image_file = (output_file if save else input_file) + extension
+        with self.storage.open_image(image_file, save, disk_meta.get('provisioned_size') or 0) as image:
+            if save:
+                engine.backup(input_file, image, compress, sparse=sparse)
+            elif sparse:
+                extents = self.storage.read_json(extents_file)
+                engine.restore(image, output_file, compress, extents=extents['extents'], size=extents['size'])
+            else:
+                engine.restore(image, output_file, compress)
+        if save:
+            disk_meta['sparse'] = int(sparse)
+            if sparse:
+                self.storage.write_json(extents_file, {'size': engine.total, 'extents': engine.extents})
+        self.__record_copy(engine, disk_meta, vm_name)
+        logger.info(f'Copied {engine.bytes_read} bytes from {input_file} '
+                    f'({engine.throughput() / 2 ** 20:.1f} MiB/s)')
+        return 0
+
+    def __select_codec(self, input_file, disk_meta, sparse, native):
+        """Sample the source and record the codec picked for it in disk_meta."""
+        selector = codec_select.CodecSelector(
+            throughput=self.config.get_adaptive_throughput(),
+            cores=self.config.get_adaptive_cores() if native else 1,
+            min_saving=self.config.get_adaptive_min_saving(),
+            candidates=codec_select.NATIVE_CANDIDATES if native else codec_select.SHELL_CANDIDATES,
+        )
+        try:
+            choice = selector.select(input_file, sparse)
+        except OSError:
+            logger.exception('Codec sampling error: ')
+            choice = {'compress': 'off', 'level': None}
+        disk_meta['compress'] = choice['compress']
+        if choice['level'] is not None:
+            disk_meta['compress_level'] = choice['level']
+        disk_meta['adaptive'] = {key: value for key, value in choice.items() if key not in ('compress', 'level')}
+        self.status.send_info(f'Disk {disk_meta["alias"]}: {choice["compress"]} selected')
+        return choice['compress']
+
+    def __record_copy(self, engine, disk_meta, vm_name):
+        kind = self.settings['task']
+        disk = disk_meta['id']
+        self.status.add_bytes(engine.bytes_read)
+        self.metrics.inc('ovbackup_copy_bytes_total', engine.bytes_read, kind=kind, vm=vm_name, disk=disk)
+        read_time = max(0.0, engine.elapsed - engine.codec_time - engine.write_time - engine.throttle_time)
+        phases = (
+            ('read', read_time), ('codec', engine.codec_time),
+            ('write', engine.write_time), ('throttle', engine.throttle_time),
+        )
+        for phase, seconds in phases:
+            self.metrics.inc('ovbackup_copy_seconds_total', seconds, kind=kind, vm=vm_name, disk=disk, phase=phase)
+        if engine.elapsed:
+            self.metrics.observe('ovbackup_copy_throughput_bytes', engine.throughput(), kind=kind)
+            self.metrics.set('ovbackup_copy_last_throughput_bytes', engine.throughput(),
+                             kind=kind, vm=vm_name, disk=disk)
+
+    def __copy_engine(self, block_size, progress, disk_meta):
+        return copy_engine.CopyEngine(
+            block_size=block_size,
+            direct=self.config.get_direct_io(),
+            progress_file=progress,
+            level=disk_meta.get('compress_level', self.task_settings.get('compress_level')),
+            workers=self.config.get_compress_workers(),
+            throttle=self.throttle,
+            cancel=self.cancel,
+        )
+
+    def __copy_chunks(self, input_file, output_file, progress, disk_meta, manifest_file, compress, vm_name):
+        chunks_dir = os.path.join(self.main_backup_dir, self.config.get_chunk_store_dir())
+        engine = self.__copy_engine(self.config.get_chunk_size(), progress, disk_meta)
+        with chunk_store.ChunkStore(chunks_dir, compress, engine.block_size) as store:
+            if self.settings['task'] == 'backup':
+                chunks = engine.backup_chunks(input_file, store)
+                # chunks and index are durable before a manifest refers to them
+                store.flush()
+                with open(manifest_file, 'w') as f:
+                    json.dump({'size': engine.total, 'chunk_size': engine.block_size, 'chunks': chunks}, f)
+                disk_meta['chunks'] = 1
+                logger.info(f'{input_file}: {store.new_chunks} new chunks, {store.dedup_chunks} deduplicated')
+            else:
+                with open(manifest_file, 'r') as f:
+                    manifest = json.load(f)
+                engine.block_size = manifest['chunk_size']
+                engine.restore_chunks(manifest['chunks'], manifest['size'], output_file, store)
+        self.__record_copy(engine, disk_meta, vm_name)
+        return 0
+
+    def __copy_delta(self, input_file, output_file, progress, disk_meta, blocks_file, compress, vm_name):
+        extension = utils.COMPRESS_TYPES[compress][0]
+        engine = self.__copy_engine(self.config.get_incremental_block_size(), progress, disk_meta)
+        if self.settings['task'] == 'restore':
+            layers = self.__load_delta_chain(blocks_file)
+            engine.block_size = layers[-1]['block_size']
+            engine.restore_chain(layers, layers[-1]['size'], output_file)
+            self.__record_copy(engine, disk_meta, vm_name)
+            return 0
+
+        parent = self.__find_parent_blocks(output_file, disk_meta['id'], engine.block_size)
+        parent_hashes = parent['hashes'] if parent else None
+        hashes, changed, zeroed = engine.backup_delta(input_file, output_file + '.delta' + extension,
+                                                      compress, parent_hashes)
+        blocks = {
+            'size': engine.total,
+            'block_size': engine.block_size,
+            'compress': compress,
+            'parent': os.path.relpath(parent['path'], os.path.dirname(output_file)) if parent else None,
+            'depth': parent['depth'] + 1 if parent else 0,
+            'hashes': hashes,
+            'changed': changed,
+            'zeroed': zeroed,
+        }
+        with open(blocks_file, 'w') as f:
+            json.dump(blocks, f)
+        disk_meta['incremental'] = 1
+        self.__record_copy(engine, disk_meta, vm_name)
+        logger.info(f'{input_file}: {len(changed)} of {len(hashes)} blocks changed')
+        return 0
+
+    def __find_parent_blocks(self, output_file, disk_id, block_size):
+        """Return the newest earlier .blocks manifest of the disk, None if
+        a full backup is due."""
+        backup_dir = os.path.dirname(output_file)
+        vm_dir = os.path.dirname(backup_dir)
+        for task_time in sorted(os.listdir(vm_dir), reverse=True):
+            if task_time >= os.path.basename(backup_dir):
+                continue
+            found = glob.glob(os.path.join(vm_dir, task_time, f'*_{disk_id}.blocks'))
+            if not found:
+                continue
+            with open(found[0], 'r') as f:
+                parent = json.load(f)
+            if parent['block_size'] != block_size or parent['depth'] + 1 > self.config.get_incremental_chain():
+                return None
+            parent['path'] = found[0][:-len('.blocks')]
+            return parent
+
+    @staticmethod
+    def __load_delta_chain(blocks_file):
+        layers = list()
+        while blocks_file:
+            with open(blocks_file, 'r') as f:
+                layer = json.load(f)
+            base = blocks_file[:-len('.blocks')]
+            layer['file'] = base + '.delta' + utils.COMPRESS_TYPES[layer['compress']][0]
+            layers.insert(0, layer)
+            if layer['parent']:
+                blocks_file = os.path.normpath(os.path.join(os.path.dirname(base), layer['parent'])) + '.blocks'
+            else:
+                blocks_file = None
+        return layers
+
+    @staticmethod
+    def __run_shell_command(cmd, input_file, progress_file, cancel):
+        """Run a pv pipeline, feeding the byte counts it prints on stderr to
+        the progress record. The pipeline is stopped once cancel is set."""
+        total = 0
+        if input_file is not None:
+            try:
+                with open(input_file, 'rb') as f:
+                    total = f.seek(0, os.SEEK_END)
+            except OSError:
+                logger.exception('Image size error: ')
+        process = subprocess.Popen(cmd, shell=True, executable='/bin/bash', start_new_session=True,
+                                   stderr=subprocess.PIPE, universal_newlines=True)
+        with progress.ProgressRecord(progress_file) as record:
+            done = 0
+            for line in process.stderr:
+                if cancel.is_set():
+                    os.killpg(process.pid, signal.SIGTERM)
+                    break
+                try:
+                    done = int(line)
+                except ValueError:
+                    logger.error(line.rstrip())
+                    continue
+                record.update(done, total)
+            returncode = process.wait()
+            record.update(done, total, final=True)
+        task_workers.check_cancelled()
+        return returncode
+
+    def __get_shell_command(self, input_file, output_file, compress):
+        """pv pipeline of a copy. With a remote server only the image end
+        runs there: the disk is attached to this host."""
         compress_types = utils.COMPRESS_TYPES
-        compress = self.task_settings['compress']
-        cmd_ssh = []
-        if self.settings['task'] == 'backup':
+        save = self.settings['task'] == 'backup'
+        if save:
             output_file += compress_types[compress][0]
-            cmd_compress = ['|'] + compress_types[compress][1]
-        elif self.settings['task'] == 'restore':
+            cmd_codec = compress_types[compress][1]
+        else:
             input_file += compress_types[compress][0]
-            cmd_compress = ['|'] + compress_types[compress][2]
+            cmd_codec = compress_types[compress][2]
+        cmd_pv = ['pv', '-n', '-b']
+        # a pipeline can't follow later limit changes, it keeps the rate it started with
+        rate = self.throttle.rate('read')
+        if rate:
+            cmd_pv += ['-L', str(int(rate))]
+        cmd_dd = ['dd', 'bs=1M', 'conv=notrunc,noerror', 'status=none', 'of=' + output_file]
+
+        if not self.config.get_remote_server():
+            pipeline = [cmd_pv + [input_file], cmd_codec, cmd_dd]
+        elif save:
+            pipeline = [cmd_pv + [input_file], cmd_codec, self.__ssh(cmd_dd)]
         else:
-            logger.error('get_backup_command error')
-            return
-        if self.config.get_remote_server():
-            cmd_ssh = ['ssh', self.config.get_remote_user() + '@' + self.config.get_remote_fqdn()]
-        cmd_pv = ['pv', '-n', input_file]
-        cmd_dd = ['|', 'dd', 'bs=1M', 'conv=notrunc,noerror', 'status=none', 'of=' + output_file]
-        cmd_progress = ['>', progress, '2>&1']
+            pipeline = [self.__ssh(['cat', input_file]), cmd_pv, cmd_codec, cmd_dd]
+        cmd = ' | '.join(self.__join(command) for command in pipeline if command)
+        # a failing pv or codec must not hide behind the exit status of dd
+        return 'set -o pipefail; ' + cmd
 
-        cmd = cmd_ssh + ['('] + cmd_pv + cmd_compress + cmd_dd + [')'] + cmd_progress
-        return cmd
+    def __ssh(self, command):
+        """Run command on the remote server, as one argument of ssh."""
+        return ['ssh', self.config.get_remote_user() + '@' + self.config.get_remote_fqdn(), self.__join(command)]
 
+    @staticmethod
+    def __join(command):
+        return ' '.join(shlex.quote(token) for token in command)
 
-class Backup(Api):
-    def __init__(self, settings, task_id):
-        super(Backup, self).__init__(settings, task_id)
 
+class VmTask:
+    def __init__(self, name):
+        self.name = name
+        self.vm_service = None
+        self.vm_backup_dir = ''
         self.snapshots_service = None
         self.snapshot = None
+        self.snapshot_service = None
+        self.vm_settings = dict()
+        self.disks_meta = dict()
+
+
+class JobScheduler:
+    """Runs jobs in threads with global, per-host and per-storage domain limits.
+
+    A limit of 0 disables the corresponding per-resource cap. Jobs that cannot
+    start because of a busy host or storage domain are skipped in favour of the
+    next runnable job, so a single loaded SAN doesn't block the whole queue.
+    """
+    def __init__(self, max_jobs=1, max_per_host=0, max_per_storage=0):
+        self.max_jobs = max(1, max_jobs)
+        self.max_per_host = max_per_host
+        self.max_per_storage = max_per_storage
+        self.condition = threading.Condition()
+        self.pending = list()
+        self.running = 0
+        self.hosts = dict()
+        self.storages = dict()
+        self.results = dict()
+
+    def submit(self, name, function, hosts=(), storages=()):
+        with self.condition:
+            self.pending.append((name, function, set(hosts), set(storages)))
+
+    def run(self):
+        threads = list()
+        with self.condition:
+            while self.pending:
+                job = self.__next_job()
+                if job is None:
+                    self.condition.wait()
+                    continue
+                self.pending.remove(job)
+                self.__acquire(job)
+                thread = threading.Thread(target=self.__run_job, args=(job,), daemon=True)
+                threads.append(thread)
+                thread.start()
+        for thread in threads:
+            thread.join()
+        return self.results
+
+    def __next_job(self):
+        if self.running >= self.max_jobs:
+            return None
+        for job in self.pending:
+            name, function, hosts, storages = job
+            if not self.__is_free(hosts, self.hosts, self.max_per_host):
+                continue
+            if not self.__is_free(storages, self.storages, self.max_per_storage):
+                continue
+            return job
+
+    @staticmethod
+    def __is_free(keys, counters, limit):
+        if not limit:
+            return True
+        return all(counters.get(key, 0) < limit for key in keys)
+
+    def __acquire(self, job):
+        name, function, hosts, storages = job
+        self.running += 1
+        for key in hosts:
+            self.hosts[key] = self.hosts.get(key, 0) + 1
+        for key in storages:
+            self.storages[key] = self.storages.get(key, 0) + 1
+
+    def __release(self, job):
+        name, function, hosts, storages = job
+        self.running -= 1
+        for key in hosts:
+            self.hosts[key] -= 1
+        for key in storages:
+            self.storages[key] -= 1
+
+    def __run_job(self, job):
+        name = job[0]
+        try:
+            result = job[1]()
+        except Exception as e:
+            logger.exception(f'Job {name} error: ')
+            result = e
+        with self.condition:
+            self.results[name] = result
+            self.__release(job)
+            self.condition.notify_all()
+
+
+class Backup(Api):
+    def __init__(self, settings, task_id):
+        super(Backup, self).__init__(settings, task_id)
 
     def run(self):
         logger.info('Start backup (task id=' + self.task_id + ')')
@@ -149,97 +535,167 @@ class Backup(Api):
         self.task_settings = self.settings['backup']
         backup_name = self.task_settings['backup_name']
         backup_dir = os.path.join(self.main_backup_dir, backup_name)
-        if not os.path.isdir(backup_dir):
-            os.makedirs(backup_dir)
+        self.storage.makedirs(backup_dir)
         vms = self.task_settings['vms']
 
-        for vm_name, disks in vms.items():
-            self.vm_service = self.__get_vm_service(vm_name)
-
-            vm_dir = os.path.join(backup_dir, vm_name)
-            if not os.path.isdir(vm_dir):
-                os.makedirs(vm_dir)
-            task_time = self.config.get_time()
-            self.vm_backup_dir = os.path.join(vm_dir, task_time)
-            os.makedirs(self.vm_backup_dir)
-
-            self.__save_vm_settings(self.vm_service.get(all_content=True), vm_name)
-            self.__meta_create()
-
-            self.snapshots_service = self.vm_service.snapshots_service()
-            self.snapshot = self.snapshots_service.add(
-                snapshot=types.Snapshot(
-                    description=self.config.get_snapshot_description(),
-                    persist_memorystate=False
+        scheduler = JobScheduler(
+            max_jobs=self.config.get_vm_workers(),
+            max_per_host=self.config.get_vm_workers_per_host(),
+            max_per_storage=self.config.get_vm_workers_per_storage(),
+        )
+        with self._stage('metadata'):
+            vms_data = self.__collect_metadata(list(vms.keys()))
+        for vm_name, vm_data in vms_data.items():
+            hosts, storages = self.__get_vm_resources(vm_data)
+            scheduler.submit(vm_name, partial(self.__timed_backup_vm, vm_data, backup_dir), hosts, storages)
+        failed = list()
+        for vm_name in set(vms.keys()) - set(vms_data.keys()):
+            logger.error(f'Can`t get vm {vm_name}')
+            self.status.send_info(f'Backup {vm_name} failed: vm not found')
+            failed.append(vm_name)
+
+        for vm_name, result in scheduler.run().items():
+            if isinstance(result, Exception):
+                self.status.send_info(f'Backup {vm_name} failed: {result}')
+                failed.append(vm_name)
+        self._api_close()
+        if failed:
+            raise TaskError(f'{len(failed)} of {len(vms)} VMs failed: {", ".join(sorted(failed))}')
+
+    def __collect_metadata(self, vm_names):
+        """Fetch VMs of the job with their disks and NICs in bulk calls."""
+        vms_data = dict()
+        for first in range(0, len(vm_names), METADATA_BATCH):
+            search = ' or '.join(f'name={vm_name}' for vm_name in vm_names[first:first + METADATA_BATCH])
+            with self.api_lock:
+                vms = self.vms_service.list(
+                    search=search,
+                    all_content=True,
+                    follow='disk_attachments.disk,nics',
                 )
-            )
-            self.__waiting_for_snapshot_creation()
-            self.__backup_images()
-        self.__api_close()
+            for vm_data in vms:
+                vms_data[vm_data.name] = vm_data
+        return vms_data
 
-    def __waiting_for_snapshot_creation(self):
-        self.snapshot_service = self.snapshots_service.snapshot_service(self.snapshot.id)
-        snapshot_status = types.SnapshotStatus.LOCKED
+    @staticmethod
+    def __get_vm_resources(vm_data):
+        hosts = list()
+        storages = list()
+        if vm_data.host is not None:
+            hosts.append(vm_data.host.id)
+        for attachment in vm_data.disk_attachments or []:
+            for storage_domain in attachment.disk.storage_domains or []:
+                storages.append(storage_domain.id)
+        return hosts, storages
+
+    def __timed_backup_vm(self, vm_data, backup_dir):
+        with self._stage('vm', vm_data.name):
+            self.__backup_vm(vm_data, backup_dir)
+
+    def __backup_vm(self, vm_data, backup_dir):
+        task_workers.check_cancelled()
+        vm = VmTask(vm_data.name)
+        vm.vm_service = self.vms_service.vm_service(vm_data.id)
+
+        vm_dir = os.path.join(backup_dir, vm.name)
+        task_time = self.config.get_time()
+        vm.vm_backup_dir = os.path.join(vm_dir, task_time)
+        self.storage.makedirs(vm.vm_backup_dir)
+
+        with self.api_lock, self._stage('settings', vm.name):
+            self.__save_vm_settings(vm, vm_data)
+            self.__meta_create(vm, vm_data)
 
-        timeout = self.config.get_snapshot_timeout()
-        pause = 2
-        tries = timeout // pause
+        try:
+            with self._stage('snapshot', vm.name):
+                with self.api_lock:
+                    vm.snapshots_service = vm.vm_service.snapshots_service()
+                    vm.snapshot = vm.snapshots_service.add(
+                        snapshot=types.Snapshot(
+                            description=self.config.get_snapshot_description(),
+                            persist_memorystate=False
+                        )
+                    )
+                self.__waiting_for_snapshot_creation(vm)
+            self.__backup_images(vm)
+        except:
+            if self.cancel.is_set() and vm.snapshot is not None:
+                self.__remove_snapshot(vm)
+            raise
+        self.status.send_info(f'Backup {vm.name} done')
+
+    def __remove_snapshot(self, vm):
+        """Drop the snapshot of a cancelled backup, its disks are detached by now."""
+        logger.info(f'Removing snapshot {vm.snapshot.id} of cancelled backup of {vm.name}')
+        try:
+            with self.api_lock:
+                vm.snapshots_service.snapshot_service(vm.snapshot.id).remove()
+        except:
+            logger.exception('Snapshot removal error: ')
+
+    def __waiting_for_snapshot_creation(self, vm):
+        vm.snapshot_service = vm.snapshots_service.snapshot_service(vm.snapshot.id)
 
         logger.info('Start snapshot creating...')
-        for i in range(tries):
-            try:
-                snapshot_status = self.snapshot_service.get().snapshot_status
-            except:
-                logger.exception('Error getting snapshot status: ')
-            if snapshot_status == types.SnapshotStatus.OK:
-                break
-            logger.debug(f'Snapshot {self.snapshot.id} creation in progress...')
-            time.sleep(pause)
-        else:
+        try:
+            self.poller.wait(
+                vm.snapshots_service, vm.snapshot.id,
+                lambda snapshot: snapshot.snapshot_status == types.SnapshotStatus.OK,
+                self.config.get_snapshot_timeout(),
+            )
+        except TimeoutError:
             logger.error('Timeout snapshot creating!')
 
-    def __backup_images(self):
-        disks_service = self.snapshot_service.disks_service()
+    def __backup_images(self, vm):
+        with self.api_lock:
+            disks = vm.snapshot_service.disks_service().list()
         attachments_service = self.backup_vm_service.disk_attachments_service()
-
-        for disk in disks_service.list():
-            disk_meta = self.disks_meta[disk.id]
-            disk_meta['compress'] = self.task_settings['compress']
-
-            attachment = attachments_service.add(
-                attachment=types.DiskAttachment(
-                    disk=types.Disk(
-                        id=disk.id,
-                        snapshot=types.Snapshot(id=self.snapshot.id)
-                    ),
-                    active=True,
-                    bootable=False,
-                    interface=utils.DISK_INTERFACE[disk_meta['interface']],
-                )
-            )
-            attachment_service = attachments_service.attachment_service(attachment.id)
-            disk_image = self.__find_disk(attachment)
-            self.__save_disk(disk_image, disk_meta)
-            attachment_service.remove(wait=True)
-
-    def __save_disk(self, disk_image, disk_meta):
-        output_file = os.path.join(self.vm_backup_dir, disk_meta['alias'] + '_' + disk_meta['id'])
+        workers = self.config.get_disk_workers()
+
+        failed = list()
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = [
+                executor.submit(self.__backup_image, vm, attachments_service, disk)
+                for disk in disks
+            ]
+            for disk, future in zip(disks, futures):
+                try:
+                    future.result()
+                except CANCELLED:
+                    logger.info(f'Disk {disk.id} backup cancelled')
+                except:
+                    logger.exception('Disk backup error: ')
+                    failed.append(vm.disks_meta.get(disk.id, {}).get('alias') or disk.id)
+        task_workers.check_cancelled()
+        if failed:
+            raise TaskError(f'{len(failed)} of {len(disks)} disks failed: {", ".join(failed)}')
+
+    def __backup_image(self, vm, attachments_service, disk):
+        disk_meta = vm.disks_meta[disk.id]
+        disk_meta['compress'] = self.task_settings['compress']
+
+        snapshot_disk = types.Disk(id=disk.id, snapshot=types.Snapshot(id=vm.snapshot.id))
+        interface = utils.DISK_INTERFACE[disk_meta['interface']]
+        with self._attached_disk(attachments_service, snapshot_disk, interface, vm.name) as disk_image:
+            with self._stage('copy', vm.name):
+                self.__save_disk(vm, disk_image, disk_meta)
+
+    def __save_disk(self, vm, disk_image, disk_meta):
+        output_file = os.path.join(vm.vm_backup_dir, disk_meta['alias'] + '_' + disk_meta['id'])
         meta_file = output_file + '.meta'
-        progress = os.path.join(self.tmp, self.task_id + '.dat')
-        cmd_save = self.__get_shell_command(disk_image, output_file, progress)
-        shell_save = subprocess.Popen(cmd_save)
-
-        with open(meta_file, 'w') as f:
-            json.dump(disk_meta, f)
+        progress = os.path.join(self.tmp, self.task_id + '_' + disk_meta['id'] + '.progress')
+        result = self._copy_image(disk_image, output_file, progress, disk_meta, vm.name)
+        if result:
+            raise TaskError(f'Copy of disk {disk_meta["alias"]} failed ({result})')
+        self.storage.write_json(meta_file, disk_meta)
 
     def __add_engine_event(self):
         pass
 
-    def __meta_create(self):
-        vm_disks = self.vm_service.disk_attachments_service().list()
-        for disk in vm_disks:
-            disk_id = disk.id
-            disk_info = self.api_service.disks_service().list(search=f'id={disk_id}')
+    def __meta_create(self, vm, vm_data):
+        for disk in vm_data.disk_attachments or []:
+            disk_info = disk.disk
+            disk_id = disk_info.id
             meta = {
                 'interface': disk.interface.value,
                 'bootable': int(disk.bootable),
@@ -252,16 +708,16 @@ class Backup(Api):
                 'provisioned_size': disk_info.provisioned_size,
                 'format': disk_info.format.value,
             }
-            self.disks_meta[disk_id] = meta
+            vm.disks_meta[disk_id] = meta
 
-    def __save_vm_settings(self, vm_data, vm_name):
-        self.vm_settings = {
+    def __save_vm_settings(self, vm, vm_data):
+        vm.vm_settings = {
             'name': vm_data.name,
             'creation_time': vm_data.creation_time.strftime('%Y.%m.%d %H:%M:%S'),
             'stop_time': vm_data.stop_time.strftime('%Y.%m.%d %H:%M:%S'),
             'stop_reason': vm_data.stop_reason,
             'cluster_id': vm_data.cluster.id,
-            'cluster_name': self.__get_cluster_name(vm_data.cluster.id),
+            'cluster_name': self._get_cluster_name(vm_data.cluster.id),
             'os_type': vm_data.os.type,
             'optimized': vm_data.type.value,
             'description': vm_data.description,
@@ -298,10 +754,9 @@ class Backup(Api):
             'stateless': int(vm_data.stateless),
         }
         vm_network = dict()
-        vm_nic_service = self.vm_service.nics_service()
-        for nic in vm_nic_service.list():
+        for nic in vm_data.nics or []:
             network_id = nic.vnic_profile.id
-            network_name = self.__get_nic_profile_name(network_id)
+            network_name = self._get_nic_profile_name(network_id)
             mac = nic.mac.address
             interface = nic.interface.value
             vm_network[nic.name] = {
@@ -311,16 +766,13 @@ class Backup(Api):
                 'interface': interface,
             }
 
-        self.vm_settings['network'] = vm_network
+        vm.vm_settings['network'] = vm_network
 
-        settings_file = os.path.join(self.vm_backup_dir, vm_name + '.json')
-        with open(settings_file, 'w') as f:
-            json.dump(self.vm_settings, f)
+        settings_file = os.path.join(vm.vm_backup_dir, vm.name + '.json')
+        self.storage.write_json(settings_file, vm.vm_settings)
 
-        ovf_file = os.path.join(self.vm_backup_dir, vm_name + '.ovf')
-        data = vm_data.initialization.configuration.data
-        with open(ovf_file, 'w') as f:
-            f.write(data)
+        ovf_file = os.path.join(vm.vm_backup_dir, vm.name + '.ovf')
+        self.storage.write_file(ovf_file, vm_data.initialization.configuration.data)
 
 
 class Restore(Api):
@@ -330,17 +782,19 @@ class Restore(Api):
 
     def run(self):
         self.task_settings = self.settings['restore']
+        vm_name = self.task_settings.get('vm_name', '')
         self.__upload_disks()
         if self.task_settings['create_vm']:
             self.__get_vm_settings(self.task_settings['vm_settings'])
-            self.__create_vm()
-            self.__disk_attachment()
-        self.__api_close()
+            with self._stage('create_vm', vm_name):
+                self.__create_vm()
+            with self._stage('attach_disks', vm_name):
+                self.__disk_attachment()
+        self._api_close()
 
     def __get_vm_settings(self, settings):
         settings_path = os.path.join(self.task_settings['path'], self.task_settings['vm_name'] + '.json')
-        with open(settings_path, 'r') as f:
-            loaded_settings = json.load(f)
+        loaded_settings = self.storage.read_json(settings_path)
         self.vm_settings = utils.get_vm_options(self.__merge_settings(settings, loaded_settings))
 
     def __create_vm(self):
@@ -400,6 +854,7 @@ class Restore(Api):
             )
         )
         self.vm_service = self.vms_service.vm_service(vm.id)
+        self.inventory.invalidate('vms')
 
     def __disk_attachment(self):
         attachments_service = self.vm_service.disk_attachments_service()
@@ -433,33 +888,46 @@ class Restore(Api):
         disks_service = self.api_service.disks_service()
         attachments_service = self.backup_vm_service.disk_attachments_service()
 
-        for disk_name, disk_settings in self.task_settings['disks'].items():
-            disk, disk_meta = self.__create_disk(disks_service, disk_name, disk_settings)
-            self.__waiting_for_disk_creation(disks_service, disk)
-            disk_id = disk.id
-            self.vm_disks[disk_id] = disk
-            self.disks_meta[disk_id] = disk_meta
-
-            attachment = attachments_service.add(
-                attachment=types.DiskAttachment(
-                    disk=types.Disk(
-                        id=disk_id,
-                    ),
-                    active=True,
-                    bootable=False,
-                    interface=types.DiskInterface.VIRTIO,
-                )
-            )
-            attachment_service = attachments_service.attachment_service(attachment.id)
-            disk_image = self.__find_disk(attachment)
-            self.__load_disk(disk_image, disk_name)
-            attachment_service.remove(wait=True)
+        disk_names = dict()
+        with self._stage('create_disks', self.task_settings.get('vm_name', '')):
+            for disk_name, disk_settings in self.task_settings['disks'].items():
+                disk, disk_meta = self.__create_disk(disks_service, disk_name, disk_settings)
+                self.vm_disks[disk.id] = disk
+                self.disks_meta[disk.id] = disk_meta
+                disk_names[disk.id] = disk_name
+            self.__waiting_for_disk_creation(disks_service, list(self.vm_disks.keys()))
+
+        failed = list()
+        workers = self.config.get_disk_workers()
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = [
+                executor.submit(self.__upload_disk, attachments_service, disk_id, disk_name)
+                for disk_id, disk_name in disk_names.items()
+            ]
+            for disk_name, future in zip(disk_names.values(), futures):
+                try:
+                    future.result()
+                except CANCELLED:
+                    logger.info(f'Disk {disk_name} upload cancelled')
+                except:
+                    logger.exception('Disk upload error: ')
+                    failed.append(disk_name)
+        task_workers.check_cancelled()
+        # a VM isn't created with disks that weren't loaded
+        if failed:
+            raise TaskError(f'{len(failed)} of {len(disk_names)} disks failed: {", ".join(failed)}')
+
+    def __upload_disk(self, attachments_service, disk_id, disk_name):
+        vm_name = self.task_settings.get('vm_name', '')
+        disk = types.Disk(id=disk_id)
+        with self._attached_disk(attachments_service, disk, types.DiskInterface.VIRTIO, vm_name) as disk_image:
+            with self._stage('copy', vm_name):
+                self.__load_disk(disk_image, disk_name, disk_id)
 
     def __create_disk(self, disks_service, disk_name, disk_settings):
         disk_path = os.path.join(self.task_settings['path'], disk_name)
         meta_file = disk_path + '.meta'
-        with open(meta_file, 'r') as f:
-            disk_meta = json.load(f)
+        disk_meta = self.storage.read_json(meta_file)
 
         meta = self.__merge_settings(disk_settings, disk_meta)
         meta = utils.get_disk_options(meta)
@@ -488,25 +956,51 @@ class Restore(Api):
 
         return result_settings
 
-    def __load_disk(self, disk_image, disk_path):
-        progress = os.path.join(self.tmp, self.task_id + '.dat')
-        cmd_load = self.__get_shell_command(disk_path, disk_image, progress)
-        shell_load = subprocess.call(cmd_load)
+    def __load_disk(self, disk_image, disk_name, disk_id):
+        disk_path = os.path.join(self.task_settings['path'], disk_name)
+        progress = os.path.join(self.tmp, self.task_id + '_' + disk_id + '.progress')
+        result = self._copy_image(disk_path, disk_image, progress, self.disks_meta[disk_id],
+                                  self.task_settings.get('vm_name', ''))
+        if result:
+            raise TaskError(f'Copy of disk {disk_name} failed ({result})')
 
-    def __waiting_for_disk_creation(self, disks_service, disk):
-        disk_service = disks_service.disk_service(disk.id)
-        disk_status = types.DiskStatus.LOCKED
+    def __waiting_for_disk_creation(self, disks_service, disk_ids):
         timeout = self.config.get_snapshot_timeout()
-        pause = 2
-        tries = timeout // pause
-
-        for i in range(tries):
+        futures = [
+            self.poller.watch(disks_service, disk_id, lambda disk: disk.status == types.DiskStatus.OK,
+                              timeout, search=True)
+            for disk_id in disk_ids
+        ]
+        for future in futures:
             try:
-                disk_status = disk_service.get().status
-            except:
-                logger.exception('Error getting disk status: ')
-            if disk_status == types.DiskStatus.OK:
-                break
-            time.sleep(pause)
-        else:
-            logger.error('Disk upload timeout')
+                future.result()
+            except TimeoutError as e:
+                logger.error(f'Disk upload timeout: {e}')
+
+
+def read_disk(settings):
+    """Byte range of a backed-up disk, read from its framed image without
+    restoring it. settings hold engine, path and disk as a restore gets
+    them, offset and length; the data is returned base64 encoded."""
+    config = config_tool.ConfigTool(settings['engine'])
+    disk_path = os.path.join(settings['path'], settings['disk'])
+    offset, length = int(settings['offset']), int(settings['length'])
+    if not os.path.realpath(disk_path).startswith(os.path.realpath(config.get_backup_dir()) + os.sep):
+        return {'error': 'disk is outside of main_backup_dir'}
+    if config.get_storage() != 'local':
+        return {'error': 'only local backups can be read'}
+    if offset < 0 or not 0 < length <= READ_LIMIT:
+        return {'error': f'length has to be 1 to {READ_LIMIT} bytes from a positive offset'}
+    with open(disk_path + '.meta', 'r') as f:
+        compress = json.load(f).get('compress')
+    if compress not in copy_engine.frames.CODECS:
+        return {'error': f'{compress} images have no index to read from'}
+    extents_file = disk_path + '.extents'
+    extents, size = None, 0
+    if os.path.exists(extents_file):
+        with open(extents_file, 'r') as f:
+            sparse = json.load(f)
+        extents, size = sparse['extents'], sparse['size']
+    data = copy_engine.read_image(disk_path + utils.COMPRESS_TYPES[compress][0], offset, length, extents, size,
+                                  config.get_compress_workers())
+    return {'offset': offset, 'length': len(data), 'data': base64.b64encode(data).decode('ascii')}
@@ -0,0 +1,445 @@
+#!/usr/bin/env python
+"""End-to-end Backup.run / Restore.run benchmark against a fake engine.
+
+    python bench/e2e_bench.py --size 256 --disks 2 --patterns zero,random,text,mixed,sparse \
+        --compress off,zlib-mt --attach-latency 0.5 --snapshot-locked 2
+    python bench/e2e_bench.py --compare bench/results/e2e-1b90ec9.json
+    python bench/e2e_bench.py --storage s3 --s3-latency 0.02 --set s3_part_size=8
+    python bench/e2e_bench.py --storage remote --kill-receiver 16
+
+Every scenario (fill pattern x compression) backs up one VM whose disks are
+sparse files filled with the pattern, then restores the backup into new disks
+and checks them against the originals. ovirtsdk4 is replaced by
+bench/fake_ovirt.py, the proxy's sysfs and /dev by a tree in the work dir, so
+only the copy path touches real I/O. Backup and restore each run in a forked
+process, which gives the wall time, bytes per second, stage latencies from
+the task metrics and peak RSS of that job alone. With --storage s3 the backups
+go to bench/fake_s3.py serving a directory of the work dir, with --storage
+remote they are streamed through the remote session of res/remote.py to a
+local receiver process. --kill-receiver kills that receiver once in every
+backup and restore, when its streams have moved the given MiB. The scenario
+reports if both jobs recovered from it with a new session and the bytes they
+resent, verified still compares the restored disks with the originals.
+
+Results go to bench/results/e2e-<revision>.json; --compare prints the change
+of every scenario against an earlier result file.
+"""
+import os
+import sys
+import json
+import time
+import base64
+import random
+import shutil
+import hashlib
+import argparse
+import platform
+import resource
+import tempfile
+import threading
+import subprocess
+import multiprocessing
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCH_DIR)
+sys.path.insert(0, REPO_DIR)
+sys.path.insert(0, BENCH_DIR)
+import fake_ovirt
+import fake_s3
+
+ENGINE = 'bench'
+BUCKET = 'bench'
+PROXY_VM = 'backup-proxy'
+BLOCK = 2 ** 20
+PATTERNS = ('zero', 'random', 'text', 'mixed', 'sparse')
+# share of blocks with data in a sparse disk
+SPARSE_FILL = 0.1
+WORDS = ('kernel', 'backup', 'disk', 'error', 'info', 'snapshot', 'GET', '/api/vms', '200', 'user',
+         'session', 'timeout', 'worker', 'cache', 'request', 'queue', 'INFO', 'WARN', '0x7f3a', 'sda1')
+
+
+def fill_image(path, size, pattern, seed):
+    """Write a disk image of size bytes filled with the pattern."""
+    rng = random.Random(f'{seed}-{pattern}')
+    text = ' '.join(rng.choice(WORDS) for _ in range(BLOCK // 4)).encode('ascii')
+    zero = bytes(BLOCK)
+    with open(path, 'wb') as f:
+        f.truncate(size)
+        for offset in range(0, size, BLOCK):
+            kind = pattern
+            if pattern == 'mixed':
+                kind = rng.choice(('zero', 'random', 'text'))
+            elif pattern == 'sparse':
+                if rng.random() >= SPARSE_FILL:
+                    continue
+                kind = 'random'
+            length = min(BLOCK, size - offset)
+            if kind == 'zero':
+                block = zero
+            elif kind == 'random':
+                block = rng.randbytes(length)
+            else:
+                start = rng.randrange(len(text) - BLOCK)
+                block = text[start:start + BLOCK]
+            f.seek(offset)
+            f.write(block[:length])
+
+
+def file_hash(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(BLOCK), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def tree_size(path):
+    """Allocated bytes of the files under path."""
+    total = 0
+    for root, dirs, files in os.walk(path):
+        for name in files:
+            total += os.lstat(os.path.join(root, name)).st_blocks * 512
+    return total
+
+
+def write_config(work, options):
+    os.makedirs(os.path.join(work, 'res', 'conf'), exist_ok=True)
+    os.makedirs(os.path.join(work, 'tmp'), exist_ok=True)
+    if not os.path.exists(os.path.join(REPO_DIR, 'res_temp.py')):
+        with open(os.path.join(work, 'res_temp.py'), 'w') as f:
+            f.write(f'KEY = {base64.urlsafe_b64encode(os.urandom(32))!r}\n')
+    sys.path.append(work)
+    import res_temp
+    from cryptography.fernet import Fernet
+    with open(os.path.join(work, 'res', 'conf', 'base.conf'), 'w') as f:
+        f.write('[base]\nmain_conf = engines.conf\ntmp = tmp\npid_folder = tmp\n')
+    engine = {
+        'url': 'engine.bench',
+        'username': 'admin@internal',
+        'password': Fernet(res_temp.KEY).encrypt(b'bench').decode('utf-8'),
+        'ca_file': 'ca.pem',
+        'backup_server': PROXY_VM,
+        'main_backup_dir': os.path.join(work, 'backups'),
+        'snapshot_description': 'bench {}',
+        'snapshot_timeout': '600',
+        'disk_finding_timeout': '60',
+        'remote_server': '0',
+    }
+    engine.update(options)
+    if 's3_secret_key' in engine:
+        engine['s3_secret_key'] = Fernet(res_temp.KEY).encrypt(engine['s3_secret_key'].encode('utf-8')).decode('utf-8')
+    with open(os.path.join(work, 'res', 'conf', 'engines.conf'), 'w') as f:
+        f.write(f'[{ENGINE}]\n')
+        for key, value in engine.items():
+            f.write(f'{key} = {value}\n')
+
+
+def load_modules(work, engine):
+    """Import the daemon's modules inside the job process, wired to the fakes."""
+    os.chdir(work)
+    fake_ovirt.install(engine)
+    from res import app_logger
+    app_logger.LOGGING_CONFIG['handlers']['default']['filename'] = os.path.join(work, 'bench.log')
+    from res import discovery
+    discovery._discovery = discovery.DeviceDiscovery(
+        sysfs=engine.sysfs, dev=engine.dev, use_netlink=False, poll_interval=0.05)
+    import backup_tools
+    from res import config_tool, metrics, registry
+    return backup_tools, config_tool, metrics, registry
+
+
+def kill_receiver(after):
+    """Kill the receiver of the local remote session once its open streams
+    moved after bytes, they have to reconnect and resend."""
+    from res import remote
+    while True:
+        session = remote._sessions.get(('', ''))
+        if session is not None:
+            with session.condition:
+                moved = sum(stream.bytes for stream in session.streams.values())
+                process = session.process
+            if moved >= after and process is not None:
+                process.kill()
+                return
+        time.sleep(0.01)
+
+
+def run_job(conn, work, args, kind, task_id, settings, vm_name, disks):
+    """Job process: one Backup.run or Restore.run, result sent over conn."""
+    try:
+        engine = fake_ovirt.FakeEngine(
+            os.path.join(work, 'engine'), login_latency=args.login_latency, api_latency=args.api_latency,
+            attach_latency=args.attach_latency, detach_latency=args.detach_latency,
+            snapshot_locked=args.snapshot_locked, disk_locked=args.disk_locked,
+        )
+        engine.add_vm(PROXY_VM)
+        engine.add_vm(vm_name, disks)
+        backup_tools, config_tool, metrics, registry = load_modules(work, engine)
+        config = config_tool.ConfigTool()
+        tasks = registry.get_registry(config.get_task_registry_file(), config.get_task_retention())
+        tasks.create(task_id, kind)
+        tasks.start(task_id, os.getpid())
+        base_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        job = backup_tools.Backup if kind == 'backup' else backup_tools.Restore
+        if args.kill_receiver is not None:
+            threading.Thread(target=kill_receiver, args=(args.kill_receiver * 2 ** 20,), daemon=True).start()
+        started = time.monotonic()
+        with job(settings=settings, task_id=task_id) as api_task:
+            api_task.run()
+        elapsed = time.monotonic() - started
+        tasks.finish(task_id, 'done')
+        restored = {disk.alias: disk.path for disk in engine.disks.values() if disk.path not in disks}
+        conn.send({
+            'seconds': elapsed,
+            'api_calls': engine.calls,
+            'base_rss_kib': base_rss,
+            'peak_rss_kib': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+            'children_peak_rss_kib': resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss,
+            'metrics': metrics.get_metrics().snapshot(),
+            'restored': restored,
+        })
+    except BaseException as e:
+        conn.send({'error': repr(e)})
+        raise
+    finally:
+        conn.close()
+
+
+def run_process(work, args, kind, task_id, settings, vm_name, disks):
+    context = multiprocessing.get_context('fork')
+    parent, child = context.Pipe(duplex=False)
+    process = context.Process(target=run_job, args=(child, work, args, kind, task_id, settings, vm_name, disks))
+    process.start()
+    child.close()
+    try:
+        result = parent.recv()
+    except EOFError:
+        result = {'error': f'job process exited with {process.exitcode}'}
+    process.join()
+    if 'error' in result:
+        raise RuntimeError(f'{kind} {task_id}: {result["error"]}')
+    return result
+
+
+def summarize(result, kind, logical_bytes):
+    """Throughput and per-stage latency of one job."""
+    snapshot = result['metrics']
+    stages = dict()
+    for (name, labels), histogram in snapshot['histograms'].items():
+        labels = dict(labels)
+        if name != 'ovbackup_stage_duration_seconds' or labels.get('kind') != kind:
+            continue
+        stages[labels['stage']] = {
+            'count': histogram[-1],
+            'total': histogram[-2],
+            'mean': histogram[-2] / histogram[-1] if histogram[-1] else 0.0,
+        }
+    copy_bytes = sum(
+        value for (name, labels), value in snapshot['counters'].items() if name == 'ovbackup_copy_bytes_total'
+    )
+    copy_seconds = dict()
+    for (name, labels), value in snapshot['counters'].items():
+        if name == 'ovbackup_copy_seconds_total':
+            phase = dict(labels)['phase']
+            copy_seconds[phase] = copy_seconds.get(phase, 0.0) + value
+    remote = dict()
+    for (name, labels), value in snapshot['counters'].items():
+        if name in ('ovbackup_remote_sessions_total', 'ovbackup_remote_resent_bytes_total'):
+            remote[name] = remote.get(name, 0) + value
+    copy_time = stages.get('copy', {}).get('total', 0.0)
+    return {
+        'seconds': result['seconds'],
+        'bytes_per_second': logical_bytes / result['seconds'] if result['seconds'] else 0.0,
+        'copy_bytes': copy_bytes,
+        'copy_bytes_per_second': copy_bytes / copy_time if copy_time else 0.0,
+        'copy_seconds': copy_seconds,
+        'remote_sessions': remote.get('ovbackup_remote_sessions_total', 0),
+        'remote_resent_bytes': remote.get('ovbackup_remote_resent_bytes_total', 0),
+        'stages': stages,
+        'api_calls': result['api_calls'],
+        'base_rss_kib': result['base_rss_kib'],
+        'peak_rss_kib': result['peak_rss_kib'],
+        'children_peak_rss_kib': result['children_peak_rss_kib'],
+    }
+
+
+def store_dir(work, args):
+    """Where the backups end up, the fake bucket's directory with s3."""
+    if args.storage == 's3':
+        return os.path.join(work, 's3', BUCKET, 'backups')
+    return os.path.join(work, 'backups')
+
+
+def run_scenario(work, args, pattern, compress, images):
+    name = f'{pattern}-{compress}'
+    vm_name = f'vm-{name}'
+    disks = images[pattern]
+    logical_bytes = sum(os.path.getsize(path) for path in disks)
+    backup_settings = {
+        'engine': ENGINE,
+        'task': 'backup',
+        'backup': {'backup_name': name, 'vms': {vm_name: {}}, 'compress': compress},
+    }
+    backup = run_process(work, args, 'backup', f'backup-{name}', backup_settings, vm_name, disks)
+
+    vm_dir = os.path.join(store_dir(work, args), name, vm_name)
+    task_time = sorted(os.listdir(vm_dir))[-1]
+    restore_disks = {
+        file_name[:-len('.meta')]: {
+            'alias': '', 'format': '', 'interface': '', 'provisioned_size': 0, 'storage': 'data',
+        }
+        for file_name in os.listdir(os.path.join(vm_dir, task_time)) if file_name.endswith('.meta')
+    }
+    # the path of a local backup, a storage backend maps it to its own namespace
+    backup_dir = os.path.join(work, 'backups', name, vm_name, task_time)
+    restore_settings = {
+        'engine': ENGINE,
+        'task': 'restore',
+        'restore': {
+            'path': backup_dir, 'disks': restore_disks, 'compress': compress, 'create_vm': False, 'vm_name': vm_name,
+        },
+    }
+    restore = run_process(work, args, 'restore', f'restore-{name}', restore_settings, vm_name, [])
+
+    sources = {f'{vm_name}_Disk{number + 1}': path for number, path in enumerate(disks)}
+    restored = restore['restored']
+    verified = len(restored) == len(sources) and all(
+        file_hash(restored[alias]) == file_hash(path) for alias, path in sources.items() if alias in restored
+    )
+    for path in restored.values():
+        os.remove(path)
+    stored = tree_size(os.path.join(store_dir(work, args), name))
+    shutil.rmtree(os.path.join(store_dir(work, args), name))
+    backup = summarize(backup, 'backup', logical_bytes)
+    restore = summarize(restore, 'restore', logical_bytes)
+    recovered = None
+    if args.kill_receiver is not None:
+        # False when the streams ended before they moved enough to be killed
+        recovered = backup['remote_sessions'] > 1 and restore['remote_sessions'] > 1
+    return {
+        'name': name,
+        'pattern': pattern,
+        'compress': compress,
+        'disks': len(disks),
+        'logical_bytes': logical_bytes,
+        'stored_bytes': stored,
+        'verified': verified,
+        'recovered': recovered,
+        'backup': backup,
+        'restore': restore,
+    }
+
+
+def git_revision():
+    try:
+        revision = subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=REPO_DIR, text=True).strip()
+        dirty = subprocess.run(['git', 'diff', '--quiet', 'HEAD'], cwd=REPO_DIR).returncode != 0
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+    return revision + ('-dirty' if dirty else '')
+
+
+def compare(current, previous):
+    """Print throughput and peak RSS of the current run against an earlier one."""
+    before = {scenario['name']: scenario for scenario in previous['scenarios']}
+    print(f'{current["revision"]} against {previous["revision"]}')
+    for scenario in current['scenarios']:
+        old = before.get(scenario['name'])
+        if old is None:
+            continue
+        for kind in ('backup', 'restore'):
+            new_rate = scenario[kind]['bytes_per_second']
+            old_rate = old[kind]['bytes_per_second']
+            speedup = new_rate / old_rate if old_rate else 0.0
+            rss = scenario[kind]['peak_rss_kib'] - old[kind]['peak_rss_kib']
+            print(f'{scenario["name"]:>20} {kind:<8} {new_rate / 2 ** 20:9.1f} MiB/s '
+                  f'x{speedup:5.2f}  peak RSS {rss:+d} KiB')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--size', type=int, default=256, help='disk size in MiB')
+    parser.add_argument('--disks', type=int, default=2, help='disks per VM')
+    parser.add_argument('--patterns', default=','.join(PATTERNS))
+    parser.add_argument('--compress', default='off,zlib-mt')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--login-latency', type=float, default=0.05)
+    parser.add_argument('--api-latency', type=float, default=0.005)
+    parser.add_argument('--attach-latency', type=float, default=0.5)
+    parser.add_argument('--detach-latency', type=float, default=0.2)
+    parser.add_argument('--snapshot-locked', type=float, default=2.0)
+    parser.add_argument('--disk-locked', type=float, default=1.0)
+    parser.add_argument('--storage', choices=('local', 'remote', 's3'), default='local')
+    parser.add_argument('--s3-latency', type=float, default=0.0, help='seconds added to every S3 request')
+    parser.add_argument('--kill-receiver', type=float, metavar='MIB',
+                        help='with --storage remote, kill the receiver once its streams moved MIB in a job')
+    parser.add_argument('--set', action='append', default=[], metavar='OPTION=VALUE',
+                        help='engine config option, e.g. --set sparse=1 --set disk_workers=4')
+    parser.add_argument('--work-dir', help='kept after the run when given')
+    parser.add_argument('--output', help='result file, bench/results/e2e-<revision>.json by default')
+    parser.add_argument('--compare', help='earlier result file to compare with')
+    args = parser.parse_args()
+    if args.kill_receiver is not None and args.storage != 'remote':
+        parser.error('--kill-receiver needs --storage remote')
+
+    options = dict(option.split('=', 1) for option in args.set)
+    work = os.path.abspath(args.work_dir) if args.work_dir else tempfile.mkdtemp(prefix='ov-backup-e2e-')
+    revision = git_revision()
+    store = None
+    try:
+        if args.storage == 's3':
+            store = fake_s3.FakeS3(os.path.join(work, 's3'), latency=args.s3_latency).start()
+            options = dict({
+                'storage': 's3', 's3_endpoint': store.endpoint, 's3_bucket': BUCKET, 's3_prefix': 'backups/',
+                's3_access_key': store.access_key, 's3_secret_key': store.secret_key,
+            }, **options)
+        elif args.storage == 'remote':
+            # no remote_fqdn: res.remote starts the receiver as a local process
+            options = dict({'storage': 'remote', 'remote_fqdn': '', 'remote_user': ''}, **options)
+        write_config(work, options)
+        images = dict()
+        for pattern in args.patterns.split(','):
+            images[pattern] = list()
+            for number in range(args.disks):
+                path = os.path.join(work, 'source', f'{pattern}-{number}.img')
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                fill_image(path, args.size * 2 ** 20, pattern, args.seed + number)
+                images[pattern].append(path)
+
+        scenarios = list()
+        for pattern in images:
+            for compress in args.compress.split(','):
+                scenario = run_scenario(work, args, pattern, compress, images)
+                scenarios.append(scenario)
+                print(f'{scenario["name"]:>20} backup {scenario["backup"]["bytes_per_second"] / 2 ** 20:9.1f} MiB/s '
+                      f'restore {scenario["restore"]["bytes_per_second"] / 2 ** 20:9.1f} MiB/s '
+                      f'verified={scenario["verified"]}'
+                      + (f' recovered={scenario["recovered"]}'
+                         f' resent={scenario["backup"]["remote_resent_bytes"] / 2 ** 20:.1f}'
+                         f'/{scenario["restore"]["remote_resent_bytes"] / 2 ** 20:.1f} MiB'
+                         if args.kill_receiver is not None else ''), file=sys.stderr)
+    finally:
+        if store is not None:
+            store.stop()
+        if not args.work_dir:
+            shutil.rmtree(work, ignore_errors=True)
+
+    result = {
+        'revision': revision,
+        'created': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        'host': {'python': platform.python_version(), 'machine': platform.machine(), 'cpus': os.cpu_count()},
+        'options': vars(args),
+        'scenarios': scenarios,
+    }
+    output = args.output or os.path.join(BENCH_DIR, 'results', f'e2e-{revision}.json')
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, 'w') as f:
+        json.dump(result, f, indent=2)
+    print(json.dumps(result, indent=2))
+    if args.compare:
+        with open(args.compare, 'r') as f:
+            compare(result, json.load(f))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,394 @@
+"""In-process stand-in for ovirtsdk4, for benchmarks only.
+
+FakeEngine keeps VMs, disks, snapshots and disk attachments in memory. Disk
+contents are plain files. Attaching a disk to the backup VM publishes a
+device in a fake sysfs tree (block/<name>/serial) with /dev/<name> linked to
+the disk file, after attach_latency, so res/discovery.py finds it as on a
+real proxy. Snapshots and new disks stay LOCKED for their configured time.
+
+    engine = FakeEngine(root, attach_latency=0.5)
+    fake_ovirt.install(engine)   # before importing backup_tools
+"""
+import os
+import re
+import sys
+import time
+import uuid
+import types as pytypes
+import datetime
+import threading
+
+ENUMS = {
+    'BiosType', 'BootDevice', 'DiskFormat', 'DiskInterface', 'DiskStatus', 'DisplayType',
+    'InheritableBoolean', 'NicInterface', 'NumaTuneMode', 'SnapshotStatus', 'VmAffinity',
+    'VmStorageErrorResumeBehaviour', 'VmType',
+}
+
+
+class Error(Exception):
+    pass
+
+
+class EnumValue:
+    def __init__(self, enum, name):
+        self.enum = enum
+        self.name = name
+        self.value = name.lower()
+
+    def __repr__(self):
+        return f'{self.enum}.{self.name}'
+
+
+class Enum:
+    def __init__(self, name):
+        self.__name = name
+        self.__values = dict()
+
+    def __getattr__(self, name):
+        if not name.isupper():
+            raise AttributeError(name)
+        if name not in self.__values:
+            self.__values[name] = EnumValue(self.__name, name)
+        return self.__values[name]
+
+
+class Struct:
+    """Any sdk type: keyword attributes, missing ones read as None."""
+    def __init__(self, *args, **kwargs):
+        self.args = args
+        self.__dict__.update(kwargs)
+
+    def __getattr__(self, name):
+        if name.startswith('__'):
+            raise AttributeError(name)
+        return None
+
+
+def _make_types():
+    module = pytypes.ModuleType('ovirtsdk4.types')
+    cache = dict()
+
+    def get(name):
+        if name.startswith('__'):
+            raise AttributeError(name)
+        if name not in cache:
+            cache[name] = Enum(name) if name in ENUMS else type(name, (Struct,), {})
+        return cache[name]
+
+    module.__getattr__ = get
+    return module
+
+
+types = _make_types()
+
+
+def _search_values(search, key):
+    return re.findall(rf'{key}=([^\s]+)', search or '')
+
+
+class FakeDisk:
+    def __init__(self, disk_id, alias, path, size, locked_until=0.0):
+        self.id = disk_id
+        self.alias = alias
+        self.path = path
+        self.size = size
+        self.locked_until = locked_until
+
+    def sdk(self):
+        status = types.DiskStatus.LOCKED if time.monotonic() < self.locked_until else types.DiskStatus.OK
+        return types.Disk(
+            id=self.id, alias=self.alias, description='', provisioned_size=self.size,
+            format=types.DiskFormat.RAW, status=status,
+            storage_domains=[types.StorageDomain(id='storage-' + str(hash(self.id) % 4))],
+        )
+
+
+class FakeEngine:
+    def __init__(self, root, login_latency=0.0, api_latency=0.0, attach_latency=0.0, detach_latency=0.0,
+                 snapshot_locked=0.0, disk_locked=0.0):
+        self.root = root
+        self.login_latency = login_latency
+        self.api_latency = api_latency
+        self.attach_latency = attach_latency
+        self.detach_latency = detach_latency
+        self.snapshot_locked = snapshot_locked
+        self.disk_locked = disk_locked
+        self.lock = threading.Lock()
+        self.vms = dict()
+        self.disks = dict()
+        self.snapshots = dict()
+        self.attachments = dict()
+        self.devices = 0
+        self.calls = 0
+        self.sysfs = os.path.join(root, 'sys')
+        self.dev = os.path.join(root, 'dev')
+        self.images = os.path.join(root, 'images')
+        for path in (os.path.join(self.sysfs, 'block'), self.dev, self.images):
+            os.makedirs(path, exist_ok=True)
+        self.clusters = [types.Cluster(id='cluster-1', name='Default')]
+        self.vnic_profiles = [types.VnicProfile(id='profile-1', name='ovirtmgmt')]
+
+    def call(self):
+        with self.lock:
+            self.calls += 1
+        if self.api_latency:
+            time.sleep(self.api_latency)
+
+    def add_vm(self, name, disk_paths=(), host='host-1'):
+        vm_id = str(uuid.uuid4())
+        disks = list()
+        for number, path in enumerate(disk_paths):
+            disk = FakeDisk(str(uuid.uuid4()), f'{name}_Disk{number + 1}', path, os.path.getsize(path))
+            self.disks[disk.id] = disk
+            disks.append(disk)
+        self.vms[vm_id] = {'id': vm_id, 'name': name, 'host': host, 'disks': disks}
+        return vm_id
+
+    def new_disk(self, alias, size):
+        disk_id = str(uuid.uuid4())
+        path = os.path.join(self.images, disk_id + '.img')
+        with open(path, 'wb') as f:
+            f.truncate(size)
+        disk = FakeDisk(disk_id, alias, path, size, time.monotonic() + self.disk_locked)
+        self.disks[disk_id] = disk
+        return disk
+
+    def vm_sdk(self, vm):
+        attachments = [
+            types.DiskAttachment(
+                id=disk.id, disk=disk.sdk(), interface=types.DiskInterface.VIRTIO, bootable=number == 0,
+                active=True, read_only=False, uses_scsi_reservation=False,
+            )
+            for number, disk in enumerate(vm['disks'])
+        ]
+        nics = [types.Nic(name='nic1', vnic_profile=types.VnicProfile(id='profile-1'),
+                          mac=types.Mac(address='56:6f:00:00:00:01'), interface=types.NicInterface.VIRTIO)]
+        now = datetime.datetime.now()
+        return types.Vm(
+            id=vm['id'], name=vm['name'], host=types.Host(id=vm['host']) if vm['host'] else None,
+            cluster=types.Cluster(id='cluster-1'), disk_attachments=attachments, nics=nics,
+            creation_time=now, stop_time=now, stop_reason='', description='', comment='',
+            os=types.OperatingSystem(type='other_linux'), type=types.VmType.SERVER,
+            memory=2 ** 30, memory_policy=types.MemoryPolicy(max=2 ** 31, guaranteed=2 ** 30, ballooning=True),
+            cpu=types.Cpu(topology=types.CpuTopology(sockets=1, cores=2, threads=1)),
+            multi_queues_enabled=True, virtio_scsi=types.VirtioScsi(enabled=True), io=types.Io(threads=1),
+            numa_tune_mode=types.NumaTuneMode.INTERLEAVE, bios=types.Bios(type=types.BiosType.Q35_SEA_BIOS),
+            time_zone=types.TimeZone(name='Etc/GMT'),
+            display=types.Display(type=types.DisplayType.VNC, disconnect_action='LOCK_SCREEN',
+                                  copy_paste_enabled=True, file_transfer_enabled=True,
+                                  smartcard_enabled=False, monitors=1, proxy=None),
+            usb=types.Usb(enabled=False), high_availability=types.HighAvailability(enabled=False, priority=0),
+            storage_error_resume_behaviour=types.VmStorageErrorResumeBehaviour.AUTO_RESUME,
+            placement_policy=types.VmPlacementPolicy(affinity=types.VmAffinity.MIGRATABLE),
+            migration=types.MigrationOptions(auto_converge=types.InheritableBoolean.INHERIT,
+                                             encrypted=types.InheritableBoolean.INHERIT,
+                                             compressed=types.InheritableBoolean.INHERIT),
+            start_paused=False, stateless=False,
+            initialization=types.Initialization(configuration=types.Configuration(data='<ovf/>')),
+        )
+
+    def attach(self, disk_id):
+        attachment_id = str(uuid.uuid4())
+        with self.lock:
+            self.devices += 1
+            name = 'vd' + str(self.devices)
+        attachment = {'id': attachment_id, 'disk': disk_id, 'device': name,
+                      'active_at': time.monotonic() + self.attach_latency}
+        self.attachments[attachment_id] = attachment
+        timer = threading.Timer(self.attach_latency, self.__publish, (attachment,))
+        timer.daemon = True
+        timer.start()
+        return attachment
+
+    def detach(self, attachment_id):
+        attachment = self.attachments.pop(attachment_id)
+        time.sleep(self.detach_latency)
+        os.remove(os.path.join(self.dev, attachment['device']))
+        block = os.path.join(self.sysfs, 'block', attachment['device'])
+        os.remove(os.path.join(block, 'serial'))
+        os.rmdir(block)
+
+    def __publish(self, attachment):
+        disk = self.disks[attachment['disk']]
+        os.symlink(disk.path, os.path.join(self.dev, attachment['device']))
+        block = os.path.join(self.sysfs, 'block', attachment['device'])
+        os.makedirs(block)
+        with open(os.path.join(block, 'serial'), 'w') as f:
+            f.write(disk.id[:20] + '\n')
+
+
+class Service:
+    def __init__(self, engine, path):
+        self._engine = engine
+        self._path = path
+
+
+class SystemService(Service):
+    def vms_service(self):
+        return VmsService(self._engine, '/vms')
+
+    def disks_service(self):
+        return DisksService(self._engine, '/disks')
+
+    def clusters_service(self):
+        return ListService(self._engine, '/clusters', self._engine.clusters)
+
+    def vnic_profiles_service(self):
+        return ListService(self._engine, '/vnicprofiles', self._engine.vnic_profiles)
+
+
+class ListService(Service):
+    def __init__(self, engine, path, items):
+        super().__init__(engine, path)
+        self.items = items
+
+    def list(self, **kwargs):
+        self._engine.call()
+        return list(self.items)
+
+
+class VmsService(Service):
+    def list(self, search=None, **kwargs):
+        self._engine.call()
+        names = _search_values(search, 'name')
+        return [self._engine.vm_sdk(vm) for vm in self._engine.vms.values() if not names or vm['name'] in names]
+
+    def vm_service(self, vm_id):
+        return VmService(self._engine, f'/vms/{vm_id}', vm_id)
+
+    def add(self, vm=None, **kwargs):
+        self._engine.call()
+        vm_id = self._engine.add_vm(vm.name)
+        return types.Vm(id=vm_id, name=vm.name)
+
+
+class VmService(Service):
+    def __init__(self, engine, path, vm_id):
+        super().__init__(engine, path)
+        self.vm_id = vm_id
+
+    def snapshots_service(self):
+        return SnapshotsService(self._engine, self._path + '/snapshots', self.vm_id)
+
+    def disk_attachments_service(self):
+        return AttachmentsService(self._engine, self._path + '/diskattachments', self.vm_id)
+
+    def nics_service(self):
+        return ListService(self._engine, self._path + '/nics', [])
+
+
+class SnapshotsService(Service):
+    def __init__(self, engine, path, vm_id):
+        super().__init__(engine, path)
+        self.vm_id = vm_id
+
+    def add(self, snapshot=None, **kwargs):
+        self._engine.call()
+        snapshot_id = str(uuid.uuid4())
+        self._engine.snapshots[snapshot_id] = {
+            'vm': self.vm_id, 'ready_at': time.monotonic() + self._engine.snapshot_locked,
+        }
+        return types.Snapshot(id=snapshot_id, snapshot_status=types.SnapshotStatus.LOCKED)
+
+    def list(self, **kwargs):
+        self._engine.call()
+        snapshots = list()
+        for snapshot_id, snapshot in self._engine.snapshots.items():
+            if snapshot['vm'] != self.vm_id:
+                continue
+            ready = time.monotonic() >= snapshot['ready_at']
+            status = types.SnapshotStatus.OK if ready else types.SnapshotStatus.LOCKED
+            snapshots.append(types.Snapshot(id=snapshot_id, snapshot_status=status))
+        return snapshots
+
+    def snapshot_service(self, snapshot_id):
+        return SnapshotService(self._engine, f'{self._path}/{snapshot_id}', self.vm_id, snapshot_id)
+
+
+class SnapshotService(Service):
+    def __init__(self, engine, path, vm_id, snapshot_id):
+        super().__init__(engine, path)
+        self.vm_id = vm_id
+        self.snapshot_id = snapshot_id
+
+    def remove(self, **kwargs):
+        self._engine.call()
+        self._engine.snapshots.pop(self.snapshot_id, None)
+
+    def disks_service(self):
+        disks = [types.Disk(id=disk.id) for disk in self._engine.vms[self.vm_id]['disks']]
+        return ListService(self._engine, self._path + '/disks', disks)
+
+
+class AttachmentsService(Service):
+    def __init__(self, engine, path, vm_id):
+        super().__init__(engine, path)
+        self.vm_id = vm_id
+
+    def add(self, attachment=None, **kwargs):
+        self._engine.call()
+        record = self._engine.attach(attachment.disk.id)
+        return types.DiskAttachment(id=record['id'], disk=types.Disk(id=attachment.disk.id), active=False)
+
+    def list(self, **kwargs):
+        self._engine.call()
+        now = time.monotonic()
+        return [
+            types.DiskAttachment(id=record['id'], disk=types.Disk(id=record['disk']), active=now >= record['active_at'])
+            for record in list(self._engine.attachments.values())
+        ]
+
+    def attachment_service(self, attachment_id):
+        return AttachmentService(self._engine, f'{self._path}/{attachment_id}', attachment_id)
+
+
+class AttachmentService(Service):
+    def __init__(self, engine, path, attachment_id):
+        super().__init__(engine, path)
+        self.attachment_id = attachment_id
+
+    def remove(self, wait=True, **kwargs):
+        self._engine.call()
+        self._engine.detach(self.attachment_id)
+
+
+class DisksService(Service):
+    def add(self, disk=None, **kwargs):
+        self._engine.call()
+        return self._engine.new_disk(disk.alias, disk.provisioned_size).sdk()
+
+    def list(self, search=None, **kwargs):
+        self._engine.call()
+        ids = _search_values(search, 'id')
+        return [disk.sdk() for disk_id, disk in list(self._engine.disks.items()) if not ids or disk_id in ids]
+
+
+class Connection:
+    engine = None
+
+    def __init__(self, url=None, username=None, password=None, ca_file=None, **kwargs):
+        self.url = url
+
+    def authenticate(self):
+        time.sleep(self.engine.login_latency)
+
+    def test(self, raise_exception=True):
+        return True
+
+    def system_service(self):
+        return SystemService(self.engine, '')
+
+    def close(self):
+        pass
+
+
+def install(engine):
+    """Register the fake as ovirtsdk4, before anything imports the real one."""
+    Connection.engine = engine
+    module = pytypes.ModuleType('ovirtsdk4')
+    module.Connection = Connection
+    module.Error = Error
+    module.types = types
+    sys.modules['ovirtsdk4'] = module
+    sys.modules['ovirtsdk4.types'] = types
+    return module
@@ -0,0 +1,299 @@
+"""Local stand-in for an S3-compatible object store, for the benchmarks.
+
+    python bench/fake_s3.py --root /tmp/s3 --port 9000
+
+Serves the path-style calls res/s3.py makes (HEAD, ranged GET, PUT, DELETE
+and multipart uploads) from a directory: bucket/key is the file
+<root>/<bucket>/<key>, parts wait under <root>/.uploads until the upload is
+completed. Requests have to carry a valid Signature Version 4 of the
+configured credentials and Content-MD5 is checked like S3 does, so a
+signing or framing bug shows up here and not against a real store. latency
+is added to every request to stand in for the round trip to a remote one,
+fail() makes the next requests of a method fail like an overloaded store.
+"""
+import os
+import sys
+import hmac
+import time
+import uuid
+import base64
+import shutil
+import hashlib
+import argparse
+import threading
+import xml.etree.ElementTree as ElementTree
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlsplit, parse_qsl, quote, unquote
+
+ACCESS_KEY = 'bench'
+SECRET_KEY = 'bench-secret'
+COPY_BLOCK = 4 * 2 ** 20
+
+
+class FakeS3:
+    def __init__(self, root, access_key=ACCESS_KEY, secret_key=SECRET_KEY, latency=0.0, host='127.0.0.1', port=0):
+        self.root = root
+        self.access_key = access_key
+        self.secret_key = secret_key
+        self.latency = latency
+        self.requests = dict()
+        self.faults = dict()
+        self.lock = threading.Lock()
+        os.makedirs(os.path.join(root, '.uploads'), exist_ok=True)
+        self.server = ThreadingHTTPServer((host, port), _handler(self))
+        self.server.daemon_threads = True
+        self.thread = None
+
+    @property
+    def endpoint(self):
+        host, port = self.server.server_address[:2]
+        return f'http://{host}:{port}'
+
+    def start(self):
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def count(self, method):
+        with self.lock:
+            self.requests[method] = self.requests.get(method, 0) + 1
+
+    def fail(self, method, count=1, status=503):
+        """Answer the next count requests of method with status."""
+        with self.lock:
+            self.faults[method] = self.faults.get(method, (0, status))[0] + count, status
+
+    def fault(self, method):
+        """Status of a failure set up by fail() for this request, None if there is none."""
+        with self.lock:
+            count, status = self.faults.get(method, (0, None))
+            if not count:
+                return None
+            self.faults[method] = count - 1, status
+            return status
+
+    def path(self, bucket, key):
+        path = os.path.normpath(os.path.join(self.root, bucket, key))
+        if not path.startswith(os.path.join(self.root, bucket) + os.sep):
+            raise ValueError(key)
+        return path
+
+    def signature(self, method, path, query, headers, signed_names, scope, amz_date):
+        canonical_query = '&'.join(
+            f'{quote(name, safe="-_.~")}={quote(value, safe="-_.~")}' for name, value in sorted(query)
+        )
+        canonical = '\n'.join([
+            method,
+            quote(unquote(path), safe='/-_.~'),
+            canonical_query,
+            ''.join(f'{name}:{" ".join(headers.get(name, "").split())}\n' for name in signed_names),
+            ';'.join(signed_names),
+            headers.get('x-amz-content-sha256', ''),
+        ])
+        string_to_sign = '\n'.join([
+            'AWS4-HMAC-SHA256', amz_date, scope, hashlib.sha256(canonical.encode('utf-8')).hexdigest(),
+        ])
+        key = ('AWS4' + self.secret_key).encode('utf-8')
+        for part in scope.split('/'):
+            key = hmac.new(key, part.encode('utf-8'), hashlib.sha256).digest()
+        return hmac.new(key, string_to_sign.encode('utf-8'), hashlib.sha256).hexdigest()
+
+
+def _handler(store):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def log_message(self, format, *args):
+            pass
+
+        def do_HEAD(self):
+            self.__dispatch()
+
+        def do_GET(self):
+            self.__dispatch()
+
+        def do_PUT(self):
+            self.__dispatch()
+
+        def do_POST(self):
+            self.__dispatch()
+
+        def do_DELETE(self):
+            self.__dispatch()
+
+        def __dispatch(self):
+            url = urlsplit(self.path)
+            query = parse_qsl(url.query, keep_blank_values=True)
+            body = self.rfile.read(int(self.headers.get('content-length') or 0))
+            store.count(self.command)
+            if store.latency:
+                time.sleep(store.latency)
+            fault = store.fault(self.command)
+            if fault:
+                return self.__error(fault, 'ServiceUnavailable')
+            error = self.__check(url.path, query, body)
+            if error:
+                return self.__error(*error)
+            bucket, _, key = unquote(url.path).lstrip('/').partition('/')
+            try:
+                path = store.path(bucket, key)
+            except ValueError:
+                return self.__error(400, 'InvalidKey')
+            params = dict(query)
+            if self.command == 'HEAD':
+                self.__head(path)
+            elif self.command == 'GET':
+                self.__get(path)
+            elif self.command == 'PUT' and 'uploadId' in params:
+                self.__put_part(params['uploadId'], int(params['partNumber']), body)
+            elif self.command == 'PUT':
+                self.__put(path, body)
+            elif self.command == 'POST' and 'uploads' in params:
+                self.__create_upload()
+            elif self.command == 'POST' and 'uploadId' in params:
+                self.__complete(path, params['uploadId'], body)
+            elif self.command == 'DELETE' and 'uploadId' in params:
+                shutil.rmtree(os.path.join(store.root, '.uploads', params['uploadId']), ignore_errors=True)
+                self.__reply(204)
+            elif self.command == 'DELETE':
+                if os.path.exists(path):
+                    os.remove(path)
+                self.__reply(204)
+            else:
+                self.__error(400, 'InvalidRequest')
+
+        def __check(self, path, query, body):
+            """Status and code of a request that doesn't pass the checks."""
+            authorization = self.headers.get('authorization', '')
+            fields = dict(
+                field.strip().split('=', 1) for field in authorization[len('AWS4-HMAC-SHA256 '):].split(',') if '=' in field
+            )
+            credential = fields.get('Credential', '').split('/', 1)
+            if len(credential) != 2 or credential[0] != store.access_key:
+                return 403, 'InvalidAccessKeyId'
+            headers = {name.lower(): value for name, value in self.headers.items()}
+            signature = store.signature(
+                self.command, path, query, headers, fields.get('SignedHeaders', '').split(';'), credential[1],
+                headers.get('x-amz-date', ''),
+            )
+            if not hmac.compare_digest(signature, fields.get('Signature', '')):
+                return 403, 'SignatureDoesNotMatch'
+            md5 = self.headers.get('content-md5')
+            if md5 is not None and base64.b64decode(md5) != hashlib.md5(body).digest():
+                return 400, 'BadDigest'
+            return None
+
+        def __head(self, path):
+            if not os.path.isfile(path):
+                return self.__reply(404)
+            self.send_response(200)
+            self.send_header('Content-Length', str(os.path.getsize(path)))
+            self.end_headers()
+
+        def __get(self, path):
+            if not os.path.isfile(path):
+                return self.__error(404, 'NoSuchKey')
+            size = os.path.getsize(path)
+            start, end = 0, size - 1
+            status = 200
+            ranges = self.headers.get('range')
+            if ranges:
+                first, _, last = ranges[len('bytes='):].partition('-')
+                start = int(first)
+                end = min(int(last), size - 1) if last else size - 1
+                if start >= size:
+                    return self.__error(416, 'InvalidRange')
+                status = 206
+            with open(path, 'rb') as f:
+                f.seek(start)
+                data = f.read(end - start + 1)
+            self.send_response(status)
+            self.send_header('Content-Length', str(len(data)))
+            if status == 206:
+                self.send_header('Content-Range', f'bytes {start}-{end}/{size}')
+            self.end_headers()
+            self.wfile.write(data)
+
+        def __put(self, path, body):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            temp = f'{path}.{uuid.uuid4().hex}.tmp'
+            with open(temp, 'wb') as f:
+                f.write(body)
+            os.replace(temp, path)
+            self.__reply(200, etag=f'"{hashlib.md5(body).hexdigest()}"')
+
+        def __create_upload(self):
+            upload_id = uuid.uuid4().hex
+            os.makedirs(os.path.join(store.root, '.uploads', upload_id))
+            self.__reply(200, f'<InitiateMultipartUploadResult><UploadId>{upload_id}</UploadId>'
+                              f'</InitiateMultipartUploadResult>')
+
+        def __put_part(self, upload_id, number, body):
+            directory = os.path.join(store.root, '.uploads', upload_id)
+            if not os.path.isdir(directory):
+                return self.__error(404, 'NoSuchUpload')
+            with open(os.path.join(directory, str(number)), 'wb') as f:
+                f.write(body)
+            self.__reply(200, etag=f'"{hashlib.md5(body).hexdigest()}"')
+
+        def __complete(self, path, upload_id, body):
+            directory = os.path.join(store.root, '.uploads', upload_id)
+            if not os.path.isdir(directory):
+                return self.__error(404, 'NoSuchUpload')
+            parts = [
+                (int(part.findtext('PartNumber')), part.findtext('ETag'))
+                for part in ElementTree.fromstring(body).iter('Part')
+            ]
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            temp = f'{path}.{upload_id}.tmp'
+            with open(temp, 'wb') as out:
+                for number, etag in parts:
+                    digest = hashlib.md5()
+                    with open(os.path.join(directory, str(number)), 'rb') as f:
+                        for block in iter(lambda: f.read(COPY_BLOCK), b''):
+                            digest.update(block)
+                            out.write(block)
+                    if f'"{digest.hexdigest()}"' != etag:
+                        os.remove(temp)
+                        return self.__error(400, 'InvalidPart')
+            os.replace(temp, path)
+            shutil.rmtree(directory, ignore_errors=True)
+            self.__reply(200, '<CompleteMultipartUploadResult></CompleteMultipartUploadResult>')
+
+        def __error(self, status, code):
+            self.__reply(status, f'<Error><Code>{code}</Code><Message>{code}</Message></Error>')
+
+        def __reply(self, status, text='', etag=None):
+            data = text.encode('utf-8')
+            self.send_response(status)
+            if etag:
+                self.send_header('ETag', etag)
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            if data and self.command != 'HEAD':
+                self.wfile.write(data)
+
+    return Handler
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--root', required=True)
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=9000)
+    parser.add_argument('--latency', type=float, default=0.0, help='seconds added to every request')
+    args = parser.parse_args()
+    store = FakeS3(os.path.abspath(args.root), latency=args.latency, host=args.host, port=args.port)
+    print(f'Serving {store.root} on {store.endpoint}', file=sys.stderr)
+    try:
+        store.server.serve_forever()
+    except KeyboardInterrupt:
+        store.stop()
+
+
+if __name__ == '__main__':
+    main()
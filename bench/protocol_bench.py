@@ -0,0 +1,106 @@
+#!/usr/bin/env python
+"""Command throughput of the stream protocol against the datagram socket.
+
+    python bench/protocol_bench.py -s /tmp/backup_unix_socket -n 20000
+
+Every mode sends the same number of status commands to a running daemon:
+datagram (one command per datagram, wait for each answer), stream (one
+command per frame, a window of pipelined frames) and batch (several commands
+per frame, pipelined as well).
+"""
+import os
+import sys
+import json
+import time
+import socket
+import argparse
+from collections import deque
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from res import protocol
+
+DATAGRAM_SUFFIX = '.dgram'
+
+
+def command(number):
+    return {'task': 'status', 'id': str(number), 'ids': [str(number)]}
+
+
+def run_datagram(unix_socket, count):
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+    sock.bind(f'\0ov-backup-bench-{os.getpid()}')
+    sock.settimeout(5)
+    latencies = list()
+    for number in range(count):
+        started = time.monotonic()
+        sock.sendto(json.dumps(command(number)).encode('utf-8'), unix_socket + DATAGRAM_SUFFIX)
+        sock.recv(65536)
+        latencies.append(time.monotonic() - started)
+    sock.close()
+    return latencies
+
+
+def run_stream(unix_socket, count, batch, depth):
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.connect(unix_socket)
+    latencies = list()
+    in_flight = deque()
+    sent = 0
+    while sent < count or in_flight:
+        while sent < count and len(in_flight) < depth:
+            size = min(batch, count - sent)
+            commands = [command(number) for number in range(sent, sent + size)]
+            sock.sendall(protocol.encode(commands if batch > 1 else commands[0]))
+            in_flight.append((time.monotonic(), size))
+            sent += size
+        reply = protocol.recv_message(sock)
+        started, size = in_flight.popleft()
+        if batch > 1 and len(reply) != size:
+            raise RuntimeError('Short batch reply')
+        latencies.append(time.monotonic() - started)
+    sock.close()
+    return latencies
+
+
+def percentile(values, part):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * part))]
+
+
+def report(mode, count, elapsed, latencies):
+    return {
+        'mode': mode,
+        'commands': count,
+        'frames': len(latencies),
+        'commands_per_second': count / elapsed if elapsed else 0.0,
+        'p50_ms': percentile(latencies, 0.5) * 1000,
+        'p99_ms': percentile(latencies, 0.99) * 1000,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Control protocol throughput benchmark')
+    parser.add_argument('-s', '--socket', default='/tmp/backup_unix_socket')
+    parser.add_argument('-n', '--commands', type=int, default=10000)
+    parser.add_argument('-b', '--batch', type=int, default=50)
+    parser.add_argument('-d', '--depth', type=int, default=16)
+    args = parser.parse_args()
+
+    modes = [
+        ('datagram', lambda: run_datagram(args.socket, args.commands)),
+        ('stream', lambda: run_stream(args.socket, args.commands, 1, 1)),
+        ('stream-pipelined', lambda: run_stream(args.socket, args.commands, 1, args.depth)),
+        ('stream-batch', lambda: run_stream(args.socket, args.commands, args.batch, args.depth)),
+    ]
+    results = list()
+    for mode, run in modes:
+        started = time.monotonic()
+        latencies = run()
+        results.append(report(mode, args.commands, time.monotonic() - started, latencies))
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == '__main__':
+    main()
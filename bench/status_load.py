@@ -0,0 +1,101 @@
+#!/usr/bin/env python
+"""Load generator for the control daemon: many clients polling status.
+
+    python bench/status_load.py -s /tmp/backup_unix_socket -c 300 -n 20
+
+Next to the latency seen by the clients it reports the mean time the daemon
+spent on a status command, from its ovbackup_control_request_seconds metric.
+"""
+import os
+import sys
+import json
+import time
+import socket
+import argparse
+import threading
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from res import protocol
+
+
+def client(unix_socket, number, requests, latencies, errors):
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+    # abstract address, so the server can answer
+    sock.bind(f'\0ov-backup-load-{os.getpid()}-{number}')
+    sock.settimeout(5)
+    message = json.dumps({'task': 'status', 'id': str(number)}).encode('utf-8')
+    for i in range(requests):
+        started = time.monotonic()
+        try:
+            sock.sendto(message, unix_socket + '.dgram')
+            sock.recv(65536)
+        except OSError:
+            errors.append(number)
+            continue
+        latencies.append(time.monotonic() - started)
+    sock.close()
+
+
+def server_time(unix_socket):
+    """Total seconds and count of status commands answered by the daemon."""
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.connect(unix_socket)
+    try:
+        sock.sendall(protocol.encode({'task': 'metrics'}))
+        text = protocol.recv_message(sock)
+    finally:
+        sock.close()
+    totals = {'sum': 0.0, 'count': 0}
+    for line in text.splitlines():
+        for name in totals:
+            if line.startswith(f'ovbackup_control_request_seconds_{name}{{command="status"}}'):
+                totals[name] = float(line.rsplit(' ', 1)[1])
+    return totals['sum'], totals['count']
+
+
+def percentile(values, part):
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, int(len(values) * part))]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Status polling load generator')
+    parser.add_argument('-s', '--socket', default='/tmp/backup_unix_socket')
+    parser.add_argument('-c', '--clients', type=int, default=200)
+    parser.add_argument('-n', '--requests', type=int, default=20)
+    args = parser.parse_args()
+
+    latencies = list()
+    errors = list()
+    threads = [
+        threading.Thread(target=client, args=(args.socket, number, args.requests, latencies, errors))
+        for number in range(args.clients)
+    ]
+    server_seconds, server_count = server_time(args.socket)
+    started = time.monotonic()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.monotonic() - started
+    server_seconds, server_count = (
+        value - before for value, before in zip(server_time(args.socket), (server_seconds, server_count))
+    )
+
+    latencies.sort()
+    print(json.dumps({
+        'clients': args.clients,
+        'requests': len(latencies),
+        'errors': len(errors),
+        'requests_per_second': len(latencies) / elapsed if elapsed else 0.0,
+        'p50_ms': percentile(latencies, 0.5) * 1000,
+        'p95_ms': percentile(latencies, 0.95) * 1000,
+        'p99_ms': percentile(latencies, 0.99) * 1000,
+        'max_ms': (latencies[-1] if latencies else 0.0) * 1000,
+        'server_mean_ms': server_seconds / server_count * 1000 if server_count else 0.0,
+    }, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,10 +1,6 @@
 import json
-import uuid
-import os
-from functools import partial
 
-from main_daemon import start_daemon
-from res import status, config_tool
+from res import status, config_tool, workers, registry, metrics
 import backup_tools
 from res import app_logger
 logger = app_logger.get_logger(__name__)
@@ -14,30 +10,30 @@ class MessageBroker:
     def __init__(self, message):
         self.message = json.loads(message)
         self.config = config_tool.ConfigTool()
-        self.pid_file_name = self.__pid_file_generate()
-        self.pid_file = os.path.join(self.config.get_pid_folder(), self.pid_file_name)
-        self.active_pid = self.config.get_active_pid_file()
 
     def run(self):
         task = self.message['task']
-        task_id = self.message['id']
+        task_id = self.message.get('id')
         if task == 'status':
             status_dict = status.Status().get()
             return json.dumps(status_dict)
-        elif task == 'backup':
-            backup_function = partial(backup, self.message, task_id)
-            start_daemon(pid_file=self.pid_file, partial_function=backup_function)
-            pid = self.__get_pid()
-            self.config.add_active_pid(task_id, pid)
-            return pid
+        elif task in ('backup', 'restore', 'cancel') and not task_id:
+            # the pool tells idle workers by their empty task id
+            return {'id': task_id, 'state': 'rejected', 'error': 'task id required'}
+        elif task in ('backup', 'restore'):
+            priority = int(self.message.get('priority', 0))
+            # recorded first, the pool marks it running as soon as a worker takes it
+            get_registry().create(task_id, task)
+            result = get_workers().submit(task_id, task, self.message, priority)
+            if result['state'] == 'rejected':
+                get_registry().finish(task_id, 'rejected')
+            return result
+        elif task == 'cancel':
+            return get_workers().cancel(task_id)
+        elif task == 'read':
+            return backup_tools.read_disk(self.message)
         elif task == 'cron_bkp':
             pass
-        elif task == 'restore':
-            restore_function = partial(restore, self.message, task_id)
-            start_daemon(pid_file=self.pid_file, partial_function=restore_function)
-            pid = self.__get_pid()
-            self.config.add_active_pid(task_id, pid)
-            return pid
         elif task == 'save_conf':
             pass
         elif task == 'load_conf':
@@ -47,14 +43,24 @@ class MessageBroker:
         elif task == 'check_api':
             pass
 
-    @staticmethod
-    def __pid_file_generate():
-        return 'ov-backup_' + uuid.uuid4().hex + '.pid'
 
-    def __get_pid(self):
-        with open(self.pid_file, 'r') as f:
-            pid = f.read()
-        return pid
+def get_workers():
+    return workers.get_pool({'backup': backup, 'restore': restore}, on_start=task_started, on_finish=task_finished)
+
+
+def get_registry():
+    config = config_tool.ConfigTool()
+    return registry.get_registry(config.get_task_registry_file(), config.get_task_retention())
+
+
+def task_started(task_id, pid):
+    get_registry().start(task_id, pid)
+
+
+def task_finished(task_id, state, error):
+    metrics.get_metrics().inc('ovbackup_tasks_total', state=state)
+    get_registry().finish(task_id, state, error)
+    status.Status().remove_progress(task_id)
 
 
 def backup(settings, task_id):
@@ -2,8 +2,11 @@
 
 import socket
 import os
+import json
 import logging
 
+from res import protocol
+
 
 LOG_FOLDER = os.getcwd()
 LOG_FILE = os.path.join(LOG_FOLDER, 'socket_client.log')
@@ -17,24 +20,30 @@ UNIX_SOCKET = "/tmp/backup_unix_socket"
 
 print("Connecting...")
 if os.path.exists(UNIX_SOCKET):
-    client = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
     client.connect(UNIX_SOCKET)
     print("Ready.")
     print("Ctrl-C to quit.")
-    print("Sending 'DONE' shuts down the server and quits.")
+    print("Send a JSON command or a JSON list of commands, 'DONE' quits.")
     while True:
         try:
             inp = input("> ")
             if inp != '':
-                print("SEND:", inp)
-                client.send(inp.encode('utf-8'))
                 if "DONE" == inp:
                     print("Shutting down.")
+                    client.close()
                     break
-                data = client.recv(1024).decode('utf-8')
-                if not data:
+                try:
+                    message = json.loads(inp)
+                except ValueError as e:
+                    print("Bad JSON:", e)
+                    continue
+                print("SEND:", inp)
+                client.sendall(protocol.encode(message))
+                data = protocol.recv_message(client)
+                if data is None:
                     break
-                print(data)
+                print(json.dumps(data))
         except KeyboardInterrupt as k:
             print("Shutting down...")
             client.close()
@@ -0,0 +1,153 @@
+import os
+import bz2
+import lzma
+import zlib
+import sqlite3
+import hashlib
+import threading
+
+from res import app_logger
+logger = app_logger.get_logger(__name__)
+
+CHUNK_SIZE = 4 * 1024 * 1024
+COMMIT_INTERVAL = 256
+
+# first byte of every stored chunk is the codec id
+CODECS = {
+    0: (bytes, bytes),
+    1: (zlib.compress, zlib.decompress),
+    2: (bz2.compress, bz2.decompress),
+    3: (lzma.compress, lzma.decompress),
+}
+COMPRESS_CODEC = {
+    'off': 0,
+    'gzip': 1,
+    'lzo': 1,
+    'bzip2': 2,
+    'pbzip2': 2,
+    'lzma': 3,
+    'xz': 3,
+}
+
+
+class ChunkError(Exception):
+    pass
+
+
+class ChunkStore:
+    """Content-addressed chunk repository shared by all backups.
+
+    Chunks are kept once per sha256 under <root>/<xx>/<yy>/<hash>. The index
+    is an on-disk sqlite B-tree, so lookups don't depend on the number of
+    chunks fitting in memory. Chunks are never deleted: backups are removed
+    outside the service, which can't tell the chunks still in use.
+
+    A chunk is synced before it's renamed into place and its directories
+    before the index rows pointing to it are committed, every COMMIT_INTERVAL
+    chunks and at flush(), which a backup calls at the end of every disk.
+    """
+    def __init__(self, root, compress='off', chunk_size=CHUNK_SIZE):
+        self.root = root
+        self.codec = COMPRESS_CODEC.get(compress, 1)
+        self.chunk_size = chunk_size
+        self.lock = threading.Lock()
+        self.uncommitted = 0
+        self.unsynced = set()
+        self.new_chunks = 0
+        self.dedup_chunks = 0
+
+        os.makedirs(self.root, exist_ok=True)
+        self.index = sqlite3.connect(os.path.join(self.root, 'index.sqlite'), check_same_thread=False, timeout=60)
+        self.index.execute('PRAGMA journal_mode=WAL')
+        self.index.execute('PRAGMA synchronous=NORMAL')
+        self.index.execute(
+            'CREATE TABLE IF NOT EXISTS chunks ('
+            'hash BLOB PRIMARY KEY, size INTEGER NOT NULL'
+            ') WITHOUT ROWID'
+        )
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def close(self):
+        with self.lock:
+            self.__commit(force=True)
+            self.index.close()
+
+    def flush(self):
+        """Make the chunks stored so far and their index rows durable."""
+        with self.lock:
+            self.__commit(force=True)
+
+    def put(self, data):
+        """Store a chunk if it's new and return its hex digest."""
+        digest = hashlib.sha256(data).digest()
+        with self.lock:
+            row = self.index.execute('SELECT 1 FROM chunks WHERE hash=?', (digest,)).fetchone()
+        directory = self.__write_chunk(digest.hex(), data) if row is None else None
+        with self.lock:
+            if directory:
+                # <xx>/<yy> may be new as well
+                self.unsynced.update((directory, os.path.dirname(directory), self.root))
+            cursor = self.index.execute('INSERT OR IGNORE INTO chunks (hash, size) VALUES (?, ?)', (digest, len(data)))
+            if cursor.rowcount:
+                self.new_chunks += 1
+            else:
+                self.dedup_chunks += 1
+            self.__commit()
+        return digest.hex()
+
+    def get(self, chunk_hash):
+        """Chunk of a hex digest, checked against it."""
+        with open(self.__chunk_path(chunk_hash), 'rb') as f:
+            data = f.read()
+        decompress = CODECS[data[0]][1]
+        data = decompress(data[1:])
+        if hashlib.sha256(data).hexdigest() != chunk_hash:
+            raise ChunkError(f'Corrupted chunk {chunk_hash}')
+        return data
+
+    def __commit(self, force=False):
+        if not force:
+            self.uncommitted += 1
+            if self.uncommitted < COMMIT_INTERVAL:
+                return
+        # the renames of new chunks are durable before the index points to them
+        for directory in sorted(self.unsynced, reverse=True):
+            self.__sync_directory(directory)
+        self.unsynced.clear()
+        self.index.commit()
+        self.uncommitted = 0
+
+    @staticmethod
+    def __sync_directory(directory):
+        fd = os.open(directory, os.O_RDONLY | os.O_DIRECTORY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+    def __chunk_path(self, chunk_hash):
+        return os.path.join(self.root, chunk_hash[:2], chunk_hash[2:4], chunk_hash)
+
+    def __write_chunk(self, chunk_hash, data):
+        """Directory of the chunk if it's new, None if it was stored already."""
+        path = self.__chunk_path(chunk_hash)
+        if os.path.exists(path):
+            return None
+        directory = os.path.dirname(path)
+        os.makedirs(directory, exist_ok=True)
+        compress = CODECS[self.codec][0]
+        tmp_path = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(bytes((self.codec,)))
+            f.write(compress(data))
+            f.flush()
+            # a chunk that exists is never written again, it has to be complete
+            os.fsync(f.fileno())
+        # rename is atomic, concurrent writers of one chunk store the same bytes
+        os.rename(tmp_path, path)
+        return directory
@@ -0,0 +1,125 @@
+import os
+import bz2
+import lzma
+import time
+import zlib
+
+from res import app_logger, frames
+logger = app_logger.get_logger(__name__)
+
+# compress setting of a job that lets every disk pick its own codec
+ADAPTIVE = 'adaptive'
+SAMPLES = 8
+SAMPLE_SIZE = 256 * 1024
+ALIGNMENT = 4096
+# (compress, level) tried with the native copy engine, fastest first
+NATIVE_CANDIDATES = (
+    ('zlib-mt', 1),
+    ('zlib-mt', 6),
+    ('bzip2-mt', 9),
+    ('xz-mt', 1),
+    ('xz-mt', 6),
+)
+# codecs of the shell pipeline, at the default level of their binaries
+SHELL_CANDIDATES = (
+    ('gzip', 6),
+    ('bzip2', 9),
+    ('xz', 6),
+)
+SHELL_COMPRESS = {
+    'gzip': lambda data, level: zlib.compress(data, level),
+    'bzip2': lambda data, level: bz2.compress(data, level),
+    'xz': lambda data, level: lzma.compress(data, preset=level),
+}
+
+
+class CodecSelector:
+    """Picks the codec and level of one disk from a sample of its blocks.
+
+    SAMPLES blocks spread evenly over the device are compressed with every
+    candidate on one core, which gives its ratio and per-core speed. A
+    candidate is feasible if cores of that speed keep up with the throughput
+    target; the feasible one with the best ratio wins. Data where the fastest
+    candidate saves less than min_saving is taken as incompressible and copied
+    with 'off' and the other candidates aren't tried. A candidate is dropped as
+    soon as its running speed falls below the target.
+    """
+    def __init__(self, throughput, cores, min_saving=0.05, candidates=NATIVE_CANDIDATES,
+                 samples=SAMPLES, sample_size=SAMPLE_SIZE):
+        self.throughput = throughput
+        self.cores = max(1, cores)
+        self.min_saving = min_saving
+        self.candidates = candidates
+        self.samples = max(1, samples)
+        self.sample_size = sample_size
+
+    def select(self, path, sparse=False):
+        """Return {'compress', 'level', 'ratio', 'speed', 'samples'} for the disk."""
+        blocks = self.sample(path, sparse)
+        choice = {'compress': 'off', 'level': None, 'ratio': 1.0, 'speed': 0.0, 'samples': len(blocks)}
+        if not blocks:
+            return choice
+        feasible = list()
+        for number, (compress, level) in enumerate(self.candidates):
+            estimate = self.estimate(blocks, compress, level)
+            if estimate is None:
+                continue
+            if number == 0 and 1 - estimate['ratio'] < self.min_saving:
+                logger.info(f'{path}: {compress} saves {1 - estimate["ratio"]:.1%}, incompressible')
+                return choice
+            feasible.append(estimate)
+        if feasible:
+            best = min(feasible, key=lambda estimate: estimate['ratio'])
+            choice.update(best)
+        logger.info(f'{path}: {choice["compress"]} level {choice["level"]}, '
+                    f'ratio {choice["ratio"]:.2f}, {choice["speed"] / 2 ** 20:.1f} MiB/s per core')
+        return choice
+
+    def sample(self, path, sparse=False):
+        """Blocks spread evenly over the source, without all-zero ones in
+        sparse mode as those are never compressed there."""
+        fd = os.open(path, os.O_RDONLY)
+        try:
+            size = os.lseek(fd, 0, os.SEEK_END)
+            if size <= self.samples * self.sample_size:
+                offsets = range(0, size, self.sample_size)
+            else:
+                step = (size - self.sample_size) // (self.samples - 1) if self.samples > 1 else 0
+                offsets = [number * step - number * step % ALIGNMENT for number in range(self.samples)]
+            blocks = list()
+            for offset in offsets:
+                data = os.pread(fd, self.sample_size, offset)
+                if sparse and not data.strip(b'\0'):
+                    continue
+                if data:
+                    blocks.append(data)
+            return blocks
+        finally:
+            os.close(fd)
+
+    def estimate(self, blocks, compress, level):
+        """Ratio and per-core speed of a codec on the blocks, None if it
+        can't meet the throughput target."""
+        function = self.__function(compress)
+        raw = 0
+        compressed = 0
+        elapsed = 0.0
+        for block in blocks:
+            started = time.perf_counter()
+            compressed += len(function(block, level))
+            elapsed += time.perf_counter() - started
+            raw += len(block)
+            if elapsed and raw / elapsed * self.cores < self.throughput:
+                return None
+        return {
+            'compress': compress,
+            'level': level,
+            'ratio': compressed / raw,
+            'speed': raw / max(elapsed, 1e-9),
+        }
+
+    @staticmethod
+    def __function(compress):
+        if compress in frames.CODECS:
+            return frames.COMPRESS[frames.CODECS[compress][0]]
+        return SHELL_COMPRESS[compress]
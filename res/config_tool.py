@@ -29,14 +29,11 @@ class ConfigTool:
         except:
             logger.exception('Config file error: ')
 
-        self.active_pid = self.get_active_pid_file()
-        self.pid_config = ConfigParser()
-
     def save_config(self, table):
         for section in table.keys():
             self.config.add_section(section)
             for option in table[section].keys():
-                if option == "password":
+                if option in ("password", "s3_secret_key"):
                     password = self.__save_password(table[section][option])
                     self.config.set(section, option, password)
                 else:
@@ -45,25 +42,6 @@ class ConfigTool:
         with open(self.path, 'w') as config_file:
             self.config.write(config_file)
 
-    def add_active_pid(self, task_id, pid):
-        self.pid_config.add_section('DEFAULT')
-        self.pid_config.set('DEFAULT', task_id, pid)
-
-        with open(self.active_pid, 'w') as f:
-            self.pid_config.write(f)
-
-    def get_active_pid(self):
-        pid_dict = dict()
-        try:
-            self.pid_config.read(self.active_pid)
-        except:
-            logger.exception('Active pid read: ')
-            return pid_dict
-        pid_list = self.pid_config.defaults()
-        for line in pid_list:
-            pid_dict[line[0]] = line[1]
-        return pid_dict
-
     def get_main_conf(self):
         return self.base_config.get('base', 'main_conf')
 
@@ -73,8 +51,33 @@ class ConfigTool:
     def get_pid_folder(self):
         return self.base_config.get('base', 'pid_folder')
 
-    def get_active_pid_file(self):
-        return os.path.join(self.get_tmp(), self.base_config.get('base', 'active_pid'))
+    def get_task_registry_file(self):
+        return os.path.join(self.get_tmp(), self.base_config.get('base', 'task_registry', fallback='tasks.sqlite'))
+
+    def get_task_retention(self):
+        return int(self.base_config.get('base', 'task_retention', fallback='30')) * 24 * 3600
+
+    def get_task_workers(self):
+        return max(1, int(self.base_config.get('base', 'task_workers', fallback='2')))
+
+    def get_task_queue(self):
+        return int(self.base_config.get('base', 'task_queue', fallback='100'))
+
+    def get_worker_max_tasks(self):
+        return max(1, int(self.base_config.get('base', 'worker_max_tasks', fallback='50')))
+
+    def get_metrics_file(self):
+        return self.base_config.get('base', 'metrics_file', fallback='')
+
+    def get_metrics_interval(self):
+        return int(self.base_config.get('base', 'metrics_interval', fallback='15'))
+
+    def get_throttle_file(self):
+        return os.path.join(self.get_tmp(), self.base_config.get('base', 'throttle_file', fallback='throttle.bucket'))
+
+    def get_throttle(self, direction, io_class=None):
+        option = f'throttle_{io_class}_{direction}' if io_class else f'throttle_{direction}'
+        return int(self.base_config.get('base', option, fallback='0')) * 1024 * 1024
 
     @staticmethod
     def get_time():
@@ -115,6 +118,70 @@ class ConfigTool:
     def get_disk_finding_timeout(self):
         return int(self.config.get(self.engine, 'disk_finding_timeout'))
 
+    def get_disk_workers(self):
+        return max(1, int(self.config.get(self.engine, 'disk_workers', fallback='1')))
+
+    def get_vm_workers(self):
+        return max(1, int(self.config.get(self.engine, 'vm_workers', fallback='1')))
+
+    def get_vm_workers_per_host(self):
+        return int(self.config.get(self.engine, 'vm_workers_per_host', fallback='0'))
+
+    def get_vm_workers_per_storage(self):
+        return int(self.config.get(self.engine, 'vm_workers_per_storage', fallback='0'))
+
+    def get_copy_engine(self):
+        return self.config.get(self.engine, 'copy_engine', fallback='native')
+
+    def get_copy_block_size(self):
+        return int(self.config.get(self.engine, 'copy_block_size', fallback='4')) * 1024 * 1024
+
+    def get_direct_io(self):
+        return bool(int(self.config.get(self.engine, 'direct_io', fallback='0')))
+
+    def get_sparse(self):
+        return bool(int(self.config.get(self.engine, 'sparse', fallback='0')))
+
+    def get_chunk_store(self):
+        return bool(int(self.config.get(self.engine, 'chunk_store', fallback='0')))
+
+    def get_chunk_store_dir(self):
+        return self.config.get(self.engine, 'chunk_store_dir', fallback='.chunks')
+
+    def get_chunk_size(self):
+        return int(self.config.get(self.engine, 'chunk_size', fallback='4')) * 1024 * 1024
+
+    def get_incremental(self):
+        return bool(int(self.config.get(self.engine, 'incremental', fallback='0')))
+
+    def get_incremental_block_size(self):
+        return int(self.config.get(self.engine, 'incremental_block_size', fallback='4')) * 1024 * 1024
+
+    def get_incremental_chain(self):
+        return int(self.config.get(self.engine, 'incremental_chain', fallback='7'))
+
+    def get_compress_workers(self):
+        return int(self.config.get(self.engine, 'compress_workers', fallback=str(os.cpu_count() or 1)))
+
+    def get_adaptive_throughput(self):
+        return int(self.config.get(self.engine, 'adaptive_throughput', fallback='100')) * 1024 * 1024
+
+    def get_adaptive_cores(self):
+        return int(self.config.get(self.engine, 'adaptive_cores', fallback=str(self.get_compress_workers())))
+
+    def get_adaptive_min_saving(self):
+        return int(self.config.get(self.engine, 'adaptive_min_saving', fallback='5')) / 100
+
+    def get_inventory_ttl(self):
+        return int(self.config.get(self.engine, 'inventory_ttl', fallback='300'))
+
+    def get_connection_pool_size(self):
+        # a task holds one connection while its disk workers borrow another
+        return max(2, int(self.config.get(self.engine, 'connection_pool_size', fallback='4')))
+
+    def get_connection_keepalive(self):
+        return int(self.config.get(self.engine, 'connection_keepalive', fallback='60'))
+
     def get_remote_server(self):
         return bool(int(self.config.get(self.engine, 'remote_server')))
 
@@ -124,6 +191,40 @@ class ConfigTool:
     def get_remote_user(self):
         return self.config.get(self.engine, 'remote_user')
 
+    def get_remote_transport(self):
+        return self.config.get(self.engine, 'remote_transport', fallback='session')
+
+    def get_remote_python(self):
+        return self.config.get(self.engine, 'remote_python', fallback='python3')
+
+    def get_storage(self):
+        streamed = self.get_remote_server() and self.get_remote_transport() == 'session'
+        return self.config.get(self.engine, 'storage', fallback='remote' if streamed else 'local')
+
+    def get_s3_endpoint(self):
+        return self.config.get(self.engine, 's3_endpoint')
+
+    def get_s3_bucket(self):
+        return self.config.get(self.engine, 's3_bucket')
+
+    def get_s3_prefix(self):
+        return self.config.get(self.engine, 's3_prefix', fallback='')
+
+    def get_s3_region(self):
+        return self.config.get(self.engine, 's3_region', fallback='us-east-1')
+
+    def get_s3_access_key(self):
+        return self.config.get(self.engine, 's3_access_key')
+
+    def get_s3_secret_key(self):
+        return self.__load_password(self.config.get(self.engine, 's3_secret_key')) or ''
+
+    def get_s3_part_size(self):
+        return int(self.config.get(self.engine, 's3_part_size', fallback='64')) * 1024 * 1024
+
+    def get_s3_workers(self):
+        return int(self.config.get(self.engine, 's3_workers', fallback='4'))
+
     @staticmethod
     def __save_password(password):
         """encrypt_password = Fernet(res_temp.KEY).encrypt(table[section][option].encode('utf-8'))
@@ -0,0 +1,198 @@
+import time
+import threading
+from contextlib import contextmanager
+import ovirtsdk4 as sdk
+
+from res import app_logger, metrics
+logger = app_logger.get_logger(__name__)
+
+POOL_SIZE = 4
+KEEPALIVE = 60
+
+
+class PooledConnection:
+    def __init__(self, connection):
+        self.connection = connection
+        self.last_used = time.monotonic()
+
+
+class ConnectionPool:
+    """Authenticated engine connections shared by the tasks of the daemon.
+
+    Connections are borrowed and returned instead of being opened per task, so
+    TLS handshake and SSO login are paid once. Idle connections are tested
+    every keepalive seconds which also keeps their session from expiring; a
+    connection failing the test is replaced with a new login.
+
+    A pool belongs to one process, every task worker logs in its own
+    connections. Waits for a connection, logins and the login time saved by
+    reuses go to the ovbackup_engine_* metrics, which the daemon sums over
+    the workers.
+    """
+    def __init__(self, url, username, password, ca_file, size=POOL_SIZE, keepalive=KEEPALIVE, engine=''):
+        self.engine = engine
+        self.url = url
+        self.username = username
+        self.password = password
+        self.ca_file = ca_file
+        self.size = size
+        self.keepalive = keepalive
+        self.condition = threading.Condition()
+        self.idle = list()
+        self.opened = 0
+        self.closed = False
+
+        self.borrows = 0
+        self.reuses = 0
+        self.wait_time = 0.0
+        self.max_wait = 0.0
+        self.logins = 0
+        self.login_time = 0.0
+
+        self.thread = threading.Thread(target=self.__keepalive, daemon=True)
+        self.thread.start()
+
+    @contextmanager
+    def connection(self):
+        pooled = self.borrow()
+        try:
+            yield pooled.connection
+        finally:
+            self.give_back(pooled)
+
+    def borrow(self):
+        started = time.monotonic()
+        with self.condition:
+            while not self.idle and self.opened >= self.size:
+                self.condition.wait()
+            pooled = self.idle.pop() if self.idle else None
+            if pooled is None:
+                self.opened += 1
+            waited = time.monotonic() - started
+            self.borrows += 1
+            self.wait_time += waited
+            self.max_wait = max(self.max_wait, waited)
+        metrics.get_metrics().observe('ovbackup_engine_connection_wait_seconds', waited, engine=self.engine)
+        try:
+            if pooled is None:
+                pooled = PooledConnection(self.__login())
+            else:
+                with self.condition:
+                    self.reuses += 1
+                    saved = self.login_time / self.logins if self.logins else 0.0
+                metrics.get_metrics().inc('ovbackup_engine_login_saved_seconds_total', saved, engine=self.engine)
+                if time.monotonic() - pooled.last_used > self.keepalive:
+                    pooled = self.__check(pooled)
+        except:
+            with self.condition:
+                self.opened -= 1
+                self.condition.notify()
+            raise
+        return pooled
+
+    def give_back(self, pooled):
+        pooled.last_used = time.monotonic()
+        with self.condition:
+            if self.closed:
+                self.opened -= 1
+                self.__close(pooled)
+            else:
+                self.idle.append(pooled)
+            self.condition.notify()
+
+    def stats(self):
+        with self.condition:
+            average_login = self.login_time / self.logins if self.logins else 0.0
+            return {
+                'opened': self.opened,
+                'idle': len(self.idle),
+                'borrows': self.borrows,
+                'avg_wait': self.wait_time / self.borrows if self.borrows else 0.0,
+                'max_wait': self.max_wait,
+                'logins': self.logins,
+                'avg_login': average_login,
+                'saved_time': self.reuses * average_login,
+            }
+
+    def close(self):
+        with self.condition:
+            self.closed = True
+            idle, self.idle = self.idle, list()
+            self.opened -= len(idle)
+            self.condition.notify_all()
+        for pooled in idle:
+            self.__close(pooled)
+
+    def __login(self):
+        started = time.monotonic()
+        connection = sdk.Connection(
+            url=self.url,
+            username=self.username,
+            password=self.password,
+            ca_file=self.ca_file,
+        )
+        connection.authenticate()
+        elapsed = time.monotonic() - started
+        with self.condition:
+            self.logins += 1
+            self.login_time += elapsed
+        metrics.get_metrics().inc('ovbackup_engine_logins_total', engine=self.engine)
+        metrics.get_metrics().inc('ovbackup_engine_login_seconds_total', elapsed, engine=self.engine)
+        return connection
+
+    def __check(self, pooled):
+        if pooled.connection.test(raise_exception=False):
+            pooled.last_used = time.monotonic()
+            return pooled
+        logger.info('Engine session expired, login again')
+        self.__close(pooled)
+        return PooledConnection(self.__login())
+
+    @staticmethod
+    def __close(pooled):
+        try:
+            pooled.connection.close()
+        except:
+            logger.exception('Connection close error: ')
+
+    def __keepalive(self):
+        while True:
+            time.sleep(self.keepalive)
+            with self.condition:
+                if self.closed:
+                    return
+                now = time.monotonic()
+                # taken out of idle but still counted as opened while tested
+                expired = [pooled for pooled in self.idle if now - pooled.last_used > self.keepalive]
+                for pooled in expired:
+                    self.idle.remove(pooled)
+            for pooled in expired:
+                try:
+                    pooled = self.__check(pooled)
+                except:
+                    logger.exception('Keepalive error: ')
+                    with self.condition:
+                        self.opened -= 1
+                        self.condition.notify()
+                else:
+                    self.give_back(pooled)
+
+
+_pools = dict()
+_pools_lock = threading.Lock()
+
+
+def get_pool(engine, config):
+    """Connection pool of the engine, created from its config on first use."""
+    with _pools_lock:
+        if engine not in _pools:
+            _pools[engine] = ConnectionPool(
+                url=config.get_url(),
+                username=config.get_username(),
+                password=config.get_password(),
+                ca_file=config.get_ca_file(),
+                size=config.get_connection_pool_size(),
+                keepalive=config.get_connection_keepalive(),
+                engine=engine,
+            )
+        return _pools[engine]
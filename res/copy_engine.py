@@ -0,0 +1,718 @@
+import os
+import bz2
+import errno
+import lzma
+import mmap
+import time
+import zlib
+import fcntl
+import hashlib
+import stat
+import struct
+from concurrent.futures import ThreadPoolExecutor
+
+from res import app_logger, frames, progress
+logger = app_logger.get_logger(__name__)
+
+BLOCK_SIZE = 4 * 1024 * 1024
+ALIGNMENT = 4096
+# granularity of zero detection in sparse mode
+SCAN_SIZE = 64 * 1024
+BLKZEROOUT = 0x127f
+
+# codecs compressed in-process, output is compatible with COMPRESS_TYPES binaries
+COMPRESSORS = {
+    'off': None,
+    'gzip': lambda: zlib.compressobj(6, zlib.DEFLATED, zlib.MAX_WBITS | 16),
+    'bzip2': lambda: bz2.BZ2Compressor(9),
+    'lzma': lambda: lzma.LZMACompressor(format=lzma.FORMAT_ALONE),
+    'xz': lambda: lzma.LZMACompressor(format=lzma.FORMAT_XZ, check=lzma.CHECK_CRC64),
+}
+DECOMPRESSORS = {
+    'off': None,
+    'gzip': lambda: zlib.decompressobj(zlib.MAX_WBITS | 16),
+    'bzip2': lambda: bz2.BZ2Decompressor(),
+    'pbzip2': lambda: bz2.BZ2Decompressor(),
+    'lzma': lambda: lzma.LZMADecompressor(format=lzma.FORMAT_AUTO),
+    'xz': lambda: lzma.LZMADecompressor(format=lzma.FORMAT_AUTO),
+}
+
+
+def is_supported(compress, save):
+    if compress in frames.CODECS:
+        return True
+    if save:
+        return compress in COMPRESSORS
+    return compress in DECOMPRESSORS
+
+
+class CopyCancelled(Exception):
+    pass
+
+
+class StreamDecompressor:
+    """Bounded-output wrapper over zlib/bz2/lzma decompressors.
+
+    Handles concatenated streams (multi-member gzip, pbzip2 output) by starting
+    a new decompressor on the unused data of a finished one. finish() is
+    called at the end of the input: the decompressors return what they have
+    of a cut stream without complaint.
+    """
+    def __init__(self, factory, max_length=BLOCK_SIZE):
+        self.factory = factory
+        self.max_length = max_length
+        self.obj = factory()
+        # the input so far ends with a complete stream
+        self.complete = False
+
+    def decompress(self, data):
+        is_zlib = not hasattr(self.obj, 'needs_input')
+        if data:
+            self.complete = False
+        while True:
+            out = self.obj.decompress(data, self.max_length)
+            if out:
+                yield out
+            if self.obj.eof:
+                data = self.obj.unused_data
+                self.obj = self.factory()
+                if not data:
+                    self.complete = True
+                    return
+            elif is_zlib:
+                data = self.obj.unconsumed_tail
+                if not data and len(out) < self.max_length:
+                    return
+            else:
+                data = b''
+                if self.obj.needs_input:
+                    return
+
+    def finish(self):
+        """Raise if the input ended inside a compressed stream."""
+        if not self.complete:
+            raise EOFError('Compressed image is truncated')
+
+
+class CopyEngine:
+    def __init__(self, block_size=BLOCK_SIZE, direct=False, progress_file=None, level=None, workers=None,
+                 throttle=None, cancel=None):
+        self.block_size = max(ALIGNMENT, block_size - block_size % ALIGNMENT)
+        self.direct = direct
+        self.level = level
+        self.workers = workers
+        self.progress_file = progress_file
+        # res.throttle.Limiter of the job, None copies at full speed
+        self.throttle = throttle
+        # threading.Event, once it is set the copy stops at its next block
+        self.cancel = cancel
+        self.bytes_read = 0
+        self.bytes_written = 0
+        self.total = 0
+        self.position = 0
+        self.extents = list()
+        self.elapsed = 0.0
+        # compression, write and throttle time, read is what is left of elapsed
+        self.codec_time = 0.0
+        self.write_time = 0.0
+        self.throttle_time = 0.0
+        self.progress = None
+
+        # page aligned buffer, reused for every read
+        self.buffer = mmap.mmap(-1, self.block_size)
+        self.view = memoryview(self.buffer)
+        self.zero_view = memoryview(bytes(max(SCAN_SIZE, self.block_size)))
+
+    def backup(self, input_file, output_file, compress, sparse=False):
+        """Copy input_file to output_file, with sparse=True only data extents
+        are stored and their map is left in self.extents. output_file may be
+        a writable stream (res.remote), it is left open for its owner."""
+        compressor = self.__get_compressor(compress)
+        in_fd = self.__open_source(input_file)
+        if self.__is_stream(output_file):
+            out_fd = output_file
+        else:
+            out_fd = os.open(output_file, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o640)
+        try:
+            if sparse:
+                self.__copy_sparse(in_fd, out_fd, compressor)
+            else:
+                self.__copy(in_fd, out_fd, compressor)
+        finally:
+            os.close(in_fd)
+            if out_fd is not output_file:
+                os.close(out_fd)
+            self.__close_progress()
+        return self.bytes_read
+
+    def restore(self, input_file, output_file, compress, extents=None, size=0):
+        """Copy input_file to output_file, with extents the input holds only
+        the listed (offset, length) ranges and the rest is left as holes.
+        input_file may be a readable stream (res.remote), read sequentially
+        as its frame index can't be seeked to."""
+        stream = self.__is_stream(input_file)
+        if compress in frames.CODECS and extents is None and not stream:
+            return self.__restore_indexed(input_file, output_file)
+        decompressor = self.__get_decompressor(compress)
+        in_fd = input_file if stream else self.__open_source(input_file)
+        out_fd = os.open(output_file, os.O_WRONLY | os.O_CREAT, 0o640)
+        try:
+            if extents is not None:
+                self.__restore_sparse(in_fd, out_fd, decompressor, extents, size)
+            else:
+                self.__copy(in_fd, out_fd, decompressor)
+        finally:
+            if not stream:
+                os.close(in_fd)
+            os.close(out_fd)
+            self.__close_progress()
+        return self.bytes_written
+
+    def backup_chunks(self, input_file, store):
+        """Split input_file into block_size chunks and put them into store.
+
+        Returns the list of chunk hashes, None stands for an all-zero chunk.
+        """
+        chunks = list()
+        in_fd = self.__open_source(input_file)
+        try:
+            self.total = os.lseek(in_fd, 0, os.SEEK_END)
+            self.__fadvise(in_fd, 0, 0, 'POSIX_FADV_SEQUENTIAL')
+            start = time.monotonic()
+            while self.position < self.total:
+                size = self.__pread_full(in_fd, self.position)
+                if not size:
+                    break
+                data = self.view[:size]
+                if data == self.zero_view[:size]:
+                    chunks.append(None)
+                else:
+                    chunks.append(store.put(data))
+                self.__fadvise(in_fd, self.position, size, 'POSIX_FADV_DONTNEED')
+                self.bytes_read += size
+                self.position += size
+                self.__report()
+            self.elapsed = time.monotonic() - start
+            self.__report(force=True)
+        finally:
+            os.close(in_fd)
+            self.__close_progress()
+        return chunks
+
+    def restore_chunks(self, chunks, size, output_file, store):
+        """Reassemble output_file from chunk hashes produced by backup_chunks."""
+        out_fd = os.open(output_file, os.O_WRONLY | os.O_CREAT, 0o640)
+        try:
+            self.total = size
+            is_block = stat.S_ISBLK(os.fstat(out_fd).st_mode)
+            if not is_block:
+                os.ftruncate(out_fd, 0)
+                os.ftruncate(out_fd, size)
+            start = time.monotonic()
+            extents = list()
+            for chunk_hash in chunks:
+                length = min(self.block_size, size - self.position)
+                if chunk_hash is not None:
+                    data = store.get(chunk_hash)
+                    self.__pwrite(out_fd, memoryview(data), self.position)
+                    extents.append([self.position, length])
+                    self.bytes_read += length
+                self.position += length
+                self.__report()
+            if is_block:
+                self.__zero_holes(out_fd, extents, size)
+            os.fsync(out_fd)
+            self.__fadvise(out_fd, 0, 0, 'POSIX_FADV_DONTNEED')
+            self.elapsed = time.monotonic() - start
+            self.__report(force=True)
+        finally:
+            os.close(out_fd)
+            self.__close_progress()
+        return self.bytes_written
+
+    def backup_delta(self, input_file, output_file, compress, parent_hashes=None):
+        """Write only blocks whose hash differs from parent_hashes.
+
+        Returns (hashes, changed, zeroed): per-block hashes of the source (None
+        for all-zero blocks), indexes of blocks stored in output_file and
+        indexes that became all-zero since the parent.
+        """
+        parent_hashes = parent_hashes or []
+        hashes, changed, zeroed = list(), list(), list()
+        compressor = self.__get_compressor(compress)
+        in_fd = self.__open_source(input_file)
+        out_fd = os.open(output_file, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o640)
+        try:
+            self.total = os.lseek(in_fd, 0, os.SEEK_END)
+            self.__fadvise(in_fd, 0, 0, 'POSIX_FADV_SEQUENTIAL')
+            start = time.monotonic()
+            index = 0
+            while self.position < self.total:
+                size = self.__pread_full(in_fd, self.position)
+                if not size:
+                    break
+                data = self.view[:size]
+                if data == self.zero_view[:size]:
+                    block_hash = None
+                else:
+                    block_hash = hashlib.blake2b(data, digest_size=16).hexdigest()
+                parent_hash = parent_hashes[index] if index < len(parent_hashes) else None
+                if block_hash != parent_hash or index >= len(parent_hashes):
+                    if block_hash is not None:
+                        changed.append(index)
+                        if compressor is not None:
+                            started = time.perf_counter()
+                            data = compressor.compress(data)
+                            self.codec_time += time.perf_counter() - started
+                        self.__write(out_fd, data)
+                    elif parent_hash is not None:
+                        zeroed.append(index)
+                hashes.append(block_hash)
+                self.__fadvise(in_fd, self.position, size, 'POSIX_FADV_DONTNEED')
+                self.bytes_read += size
+                self.position += size
+                index += 1
+                self.__report()
+            if compressor is not None:
+                self.__write(out_fd, compressor.flush())
+            os.fsync(out_fd)
+            self.elapsed = time.monotonic() - start
+            self.__report(force=True)
+        finally:
+            os.close(in_fd)
+            os.close(out_fd)
+            self.__close_progress()
+        return hashes, changed, zeroed
+
+    def restore_chain(self, layers, size, output_file):
+        """Rebuild a full image from delta layers, ordered oldest first.
+
+        Every layer is a dict with 'file', 'compress', 'changed' and 'zeroed'
+        as produced by backup_delta. Each block is written once, from the
+        newest layer that holds it.
+        """
+        blocks = (size + self.block_size - 1) // self.block_size
+        owner = [-1] * blocks
+        for number, layer in enumerate(layers):
+            for index in layer['changed']:
+                owner[index] = number
+            for index in layer['zeroed']:
+                owner[index] = -1
+
+        out_fd = os.open(output_file, os.O_WRONLY | os.O_CREAT, 0o640)
+        try:
+            self.total = size
+            is_block = stat.S_ISBLK(os.fstat(out_fd).st_mode)
+            if not is_block:
+                os.ftruncate(out_fd, 0)
+                os.ftruncate(out_fd, size)
+            start = time.monotonic()
+            for number, layer in enumerate(layers):
+                if number not in owner:
+                    continue
+                pending = bytearray()
+                changed = iter(layer['changed'])
+                index = next(changed, None)
+                for chunk in self.__read_stream(layer['file'], layer['compress']):
+                    pending += chunk
+                    while index is not None:
+                        offset = index * self.block_size
+                        length = min(self.block_size, size - offset)
+                        if len(pending) < length:
+                            break
+                        if owner[index] == number:
+                            self.__pwrite(out_fd, memoryview(pending)[:length], offset)
+                            self.position += length
+                            self.__report()
+                        del pending[:length]
+                        index = next(changed, None)
+            if is_block:
+                extents = [[i * self.block_size, self.block_size] for i in range(blocks) if owner[i] >= 0]
+                self.__zero_holes(out_fd, extents, size)
+            os.fsync(out_fd)
+            self.__fadvise(out_fd, 0, 0, 'POSIX_FADV_DONTNEED')
+            self.elapsed = time.monotonic() - start
+            self.__report(force=True)
+        finally:
+            os.close(out_fd)
+            self.__close_progress()
+        return self.bytes_written
+
+    def throughput(self):
+        if not self.elapsed:
+            return 0.0
+        return self.bytes_read / self.elapsed
+
+    def __restore_indexed(self, input_file, output_file):
+        """Restore a framed stream, frames are decompressed and written at
+        their offsets by a thread pool, so they may land out of order."""
+        out_fd = os.open(output_file, os.O_WRONLY | os.O_CREAT, 0o640)
+        try:
+            with frames.FrameReader(input_file, self.workers) as reader:
+                self.total = reader.size
+                start = time.monotonic()
+                window = reader.workers * 2
+                with ThreadPoolExecutor(max_workers=reader.workers) as executor:
+                    for first in range(0, len(reader.index), window):
+                        futures = [
+                            executor.submit(self.__restore_frame, reader, entry, out_fd)
+                            for entry in reader.index[first:first + window]
+                        ]
+                        for future in futures:
+                            size, length = future.result()
+                            self.__throttle('read', size)
+                            self.__throttle('write', length)
+                            self.bytes_read += size
+                            self.bytes_written += length
+                            self.position += length
+                            self.__report()
+                self.elapsed = time.monotonic() - start
+            os.fsync(out_fd)
+            self.__fadvise(out_fd, 0, 0, 'POSIX_FADV_DONTNEED')
+            self.__report(force=True)
+        finally:
+            os.close(out_fd)
+            self.__close_progress()
+        return self.bytes_written
+
+    @staticmethod
+    def __restore_frame(reader, entry, out_fd):
+        offset, stream_offset, size, length = entry
+        data = memoryview(reader.read_frame(entry))
+        while data:
+            written = os.pwrite(out_fd, data, offset)
+            data = data[written:]
+            offset += written
+        return size, length
+
+    def __get_compressor(self, compress):
+        if compress in frames.CODECS:
+            return frames.FrameCompressor(compress, self.level, self.workers)
+        if compress not in COMPRESSORS:
+            raise ValueError(f'Compression {compress} is not supported by the copy engine')
+        factory = COMPRESSORS[compress]
+        return factory() if factory else None
+
+    def __get_decompressor(self, compress):
+        if compress in frames.CODECS:
+            return frames.FrameDecompressor(self.workers)
+        if compress not in DECOMPRESSORS:
+            raise ValueError(f'Compression {compress} is not supported by the copy engine')
+        factory = DECOMPRESSORS[compress]
+        return StreamDecompressor(factory, self.block_size) if factory else None
+
+    def __open_source(self, path):
+        flags = os.O_RDONLY
+        if self.direct and hasattr(os, 'O_DIRECT'):
+            try:
+                return os.open(path, flags | os.O_DIRECT)
+            except OSError:
+                logger.debug(f'O_DIRECT is not supported for {path}')
+        return os.open(path, flags)
+
+    def __read_stream(self, path, compress):
+        decompressor = self.__get_decompressor(compress)
+        in_fd = self.__open_source(path)
+        try:
+            self.__fadvise(in_fd, 0, 0, 'POSIX_FADV_SEQUENTIAL')
+            while True:
+                size = os.readv(in_fd, [self.buffer])
+                if not size:
+                    break
+                self.__throttle('read', size)
+                self.bytes_read += size
+                if decompressor is None:
+                    yield self.view[:size]
+                else:
+                    yield from decompressor.decompress(self.view[:size])
+            self.__finish(decompressor)
+        finally:
+            os.close(in_fd)
+
+    def __copy(self, in_fd, out_fd, codec):
+        self.total = self.__size(in_fd)
+        self.__fadvise(in_fd, 0, 0, 'POSIX_FADV_SEQUENTIAL')
+
+        start = time.monotonic()
+        while True:
+            size = self.__readv(in_fd)
+            if not size:
+                break
+            self.__throttle('read', size)
+            data = self.view[:size]
+            if codec is None:
+                self.__write(out_fd, data)
+            else:
+                started = time.perf_counter()
+                waited = self.write_time + self.throttle_time
+                if isinstance(codec, (StreamDecompressor, frames.FrameDecompressor)):
+                    for chunk in codec.decompress(data):
+                        self.__write(out_fd, chunk)
+                else:
+                    self.__write(out_fd, codec.compress(data))
+                self.codec_time += time.perf_counter() - started - (self.write_time + self.throttle_time - waited)
+            self.__fadvise(in_fd, self.bytes_read, size, 'POSIX_FADV_DONTNEED')
+            self.bytes_read += size
+            self.position = self.bytes_read
+            self.__report()
+        if codec is not None and not isinstance(codec, (StreamDecompressor, frames.FrameDecompressor)):
+            self.__write(out_fd, codec.flush())
+        self.__finish(codec)
+
+        self.__sync(out_fd)
+        self.elapsed = time.monotonic() - start
+        self.__report(force=True)
+
+    def __copy_sparse(self, in_fd, out_fd, compressor):
+        self.total = os.lseek(in_fd, 0, os.SEEK_END)
+        self.__fadvise(in_fd, 0, 0, 'POSIX_FADV_SEQUENTIAL')
+
+        start = time.monotonic()
+        for data_start, data_end in self.__data_ranges(in_fd):
+            offset = data_start
+            while offset < data_end:
+                size = os.preadv(in_fd, [self.view[:min(self.block_size, data_end - offset)]], offset)
+                if not size:
+                    break
+                self.__throttle('read', size)
+                for run_start, run_end in self.__nonzero_runs(size):
+                    self.__add_extent(offset + run_start, run_end - run_start)
+                    piece = self.view[run_start:run_end]
+                    if compressor is None:
+                        self.__write(out_fd, piece)
+                    else:
+                        started = time.perf_counter()
+                        piece = compressor.compress(piece)
+                        self.codec_time += time.perf_counter() - started
+                        self.__write(out_fd, piece)
+                self.__fadvise(in_fd, offset, size, 'POSIX_FADV_DONTNEED')
+                self.bytes_read += size
+                offset += size
+                self.position = offset
+                self.__report()
+        if compressor is not None:
+            self.__write(out_fd, compressor.flush())
+
+        self.__sync(out_fd)
+        self.position = self.total
+        self.elapsed = time.monotonic() - start
+        self.__report(force=True)
+
+    def __data_ranges(self, fd):
+        """Yield allocated ranges using SEEK_DATA/SEEK_HOLE, the whole source
+        if the file system or device doesn't support them."""
+        if not hasattr(os, 'SEEK_DATA'):
+            yield 0, self.total
+            return
+        offset = 0
+        while offset < self.total:
+            try:
+                data_start = os.lseek(fd, offset, os.SEEK_DATA)
+            except OSError as e:
+                if e.errno == errno.ENXIO:
+                    return
+                if offset == 0:
+                    yield 0, self.total
+                return
+            data_end = os.lseek(fd, data_start, os.SEEK_HOLE)
+            yield data_start, data_end
+            offset = data_end
+
+    def __nonzero_runs(self, size):
+        """Yield (start, end) runs of the buffer that are not all zeros."""
+        run_start = None
+        for pos in range(0, size, SCAN_SIZE):
+            end = min(pos + SCAN_SIZE, size)
+            # memoryview comparison of equal formats is a plain memcmp
+            if self.view[pos:end] == self.zero_view[:end - pos]:
+                if run_start is not None:
+                    yield run_start, pos
+                    run_start = None
+            elif run_start is None:
+                run_start = pos
+        if run_start is not None:
+            yield run_start, size
+
+    def __add_extent(self, offset, length):
+        if self.extents and sum(self.extents[-1]) == offset:
+            self.extents[-1][1] += length
+        else:
+            self.extents.append([offset, length])
+
+    def __restore_sparse(self, in_fd, out_fd, decompressor, extents, size):
+        self.total = self.__size(in_fd)
+        self.__fadvise(in_fd, 0, 0, 'POSIX_FADV_SEQUENTIAL')
+        is_block = stat.S_ISBLK(os.fstat(out_fd).st_mode)
+        if not is_block:
+            # a fresh file of the right size is one big hole
+            os.ftruncate(out_fd, 0)
+            os.ftruncate(out_fd, size)
+
+        start = time.monotonic()
+        pending = iter(extents)
+        offset, remaining = 0, 0
+        while True:
+            read_size = self.__readv(in_fd)
+            if not read_size:
+                break
+            self.__throttle('read', read_size)
+            data = self.view[:read_size]
+            chunks = decompressor.decompress(data) if decompressor else [data]
+            for chunk in chunks:
+                chunk = memoryview(chunk)
+                while chunk:
+                    if not remaining:
+                        offset, remaining = next(pending)
+                    length = min(remaining, len(chunk))
+                    self.__pwrite(out_fd, chunk[:length], offset)
+                    chunk = chunk[length:]
+                    offset += length
+                    remaining -= length
+            self.bytes_read += read_size
+            self.position = self.bytes_read
+            self.__report()
+        self.__finish(decompressor)
+        if is_block:
+            self.__zero_holes(out_fd, extents, size)
+
+        self.__sync(out_fd)
+        self.elapsed = time.monotonic() - start
+        self.__report(force=True)
+
+    @staticmethod
+    def __finish(codec):
+        if isinstance(codec, (StreamDecompressor, frames.FrameDecompressor)):
+            codec.finish()
+
+    @staticmethod
+    def __zero_holes(fd, extents, size):
+        """Let the device zero the ranges between extents (BLKZEROOUT)."""
+        offset = 0
+        for start, length in list(extents) + [[size, 0]]:
+            if start > offset:
+                try:
+                    fcntl.ioctl(fd, BLKZEROOUT, struct.pack('QQ', offset, start - offset))
+                except OSError:
+                    logger.exception('Zeroing holes error: ')
+                    return
+            offset = start + length
+
+    def __pread_full(self, fd, offset):
+        size = 0
+        while size < self.block_size:
+            read_size = os.preadv(fd, [self.view[size:]], offset + size)
+            if not read_size:
+                break
+            size += read_size
+        self.__throttle('read', size)
+        return size
+
+    def __pwrite(self, fd, data, offset):
+        self.__throttle('write', len(data))
+        started = time.perf_counter()
+        while data:
+            written = os.pwrite(fd, data, offset)
+            data = data[written:]
+            offset += written
+            self.bytes_written += written
+        self.write_time += time.perf_counter() - started
+
+    def __write(self, fd, data):
+        view = memoryview(data)
+        self.__throttle('write', view.nbytes)
+        started = time.perf_counter()
+        while view:
+            written = os.write(fd, view) if isinstance(fd, int) else fd.write(view)
+            view = view[written:]
+            self.bytes_written += written
+        self.write_time += time.perf_counter() - started
+
+    def __throttle(self, direction, size):
+        if self.throttle is not None and size:
+            self.throttle_time += self.throttle.acquire(direction, size)
+
+    @staticmethod
+    def __is_stream(target):
+        return not isinstance(target, (str, bytes, os.PathLike))
+
+    @staticmethod
+    def __size(fd):
+        """Size of the source, its position is rewound for sequential reads."""
+        if not isinstance(fd, int):
+            return fd.size
+        size = os.lseek(fd, 0, os.SEEK_END)
+        os.lseek(fd, 0, os.SEEK_SET)
+        return size
+
+    def __readv(self, fd):
+        if not isinstance(fd, int):
+            return fd.readinto(self.view)
+        return os.readv(fd, [self.buffer])
+
+    def __sync(self, fd):
+        """Flush a written file, a stream is made durable by its owner."""
+        if isinstance(fd, int):
+            os.fsync(fd)
+            self.__fadvise(fd, 0, 0, 'POSIX_FADV_DONTNEED')
+
+    @staticmethod
+    def __fadvise(fd, offset, length, advice):
+        if not hasattr(os, 'posix_fadvise') or not isinstance(fd, int):
+            return
+        try:
+            os.posix_fadvise(fd, offset, length, getattr(os, advice))
+        except OSError:
+            pass
+
+    def __report(self, force=False):
+        if self.cancel is not None and self.cancel.is_set():
+            raise CopyCancelled('Copy cancelled')
+        if not self.progress_file:
+            return
+        if self.progress is None:
+            self.progress = progress.ProgressRecord(self.progress_file)
+        self.progress.update(self.position, self.total, final=force)
+        if force:
+            # the final report ends the copy, its record stays readable on disk
+            self.__close_progress()
+
+    def __close_progress(self):
+        if self.progress is not None:
+            self.progress.close()
+            self.progress = None
+
+
+def read_image(image_file, offset, length, extents=None, size=0, workers=None):
+    """Read a byte range of a backed-up disk from a framed image without
+    restoring it. extents and size are the map of a sparse image, gaps read
+    as zeros."""
+    with frames.FrameReader(image_file, workers) as reader:
+        if extents is None:
+            return reader.read(offset, length)
+        length = max(0, min(length, size - offset))
+        data = bytearray(length)
+        stream_offset = 0
+        for extent_offset, extent_length in extents:
+            start = max(offset, extent_offset)
+            end = min(offset + length, extent_offset + extent_length)
+            if start < end:
+                piece = reader.read(stream_offset + start - extent_offset, end - start)
+                data[start - offset:end - offset] = piece
+            stream_offset += extent_length
+        return bytes(data)
+
+
+if __name__ == '__main__':
+    import sys
+    import tempfile
+
+    size = int(sys.argv[1]) if len(sys.argv) > 1 else 256
+    with tempfile.TemporaryDirectory() as tmp:
+        device = os.path.join(tmp, 'device.img')
+        with open(device, 'wb') as f:
+            for i in range(size):
+                f.write(os.urandom(512 * 1024) + bytes(512 * 1024))
+        for name in COMPRESSORS:
+            engine = CopyEngine()
+            engine.backup(device, os.path.join(tmp, 'backup.' + name), name)
+            print(f'{name}: {engine.throughput() / 2 ** 20:.1f} MiB/s')
@@ -0,0 +1,146 @@
+import os
+import glob
+import time
+import socket
+import threading
+
+from res import app_logger, metrics
+logger = app_logger.get_logger(__name__)
+
+NETLINK_KOBJECT_UEVENT = 15
+POLL_INTERVAL = 0.5
+
+
+class DeviceDiscovery:
+    """Keeps a serial -> block device index of the backup proxy.
+
+    New devices are picked up from kernel uevents (netlink) as soon as they
+    appear; without netlink, or for a fake sysfs tree, only unknown devices
+    are rescanned every POLL_INTERVAL. A device whose serial couldn't be read
+    yet is read again at every rescan and every poll_interval of a waiter, as no
+    uevent tells when it becomes readable. Waiters are woken by the index
+    update and their discovery latency goes to the process metrics.
+    """
+    def __init__(self, sysfs='/sys', dev='/dev', use_netlink=True, poll_interval=POLL_INTERVAL):
+        self.sysfs = sysfs
+        self.dev = dev
+        self.poll_interval = poll_interval
+        self.condition = threading.Condition()
+        self.devices = dict()
+        self.serials = dict()
+        self.closed = False
+        self.sock = self.__open_netlink() if use_netlink else None
+
+        self.rescan()
+        target = self.__listen if self.sock else self.__poll
+        self.thread = threading.Thread(target=target, daemon=True)
+        self.thread.start()
+
+    def wait(self, serial, timeout):
+        """Return /dev path of the disk with serial, None on timeout."""
+        started = time.monotonic()
+        deadline = started + timeout
+        with self.condition:
+            while serial not in self.serials:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0 or self.closed:
+                    return None
+                self.condition.wait(min(remaining, self.poll_interval))
+                self.__read_unknown_serials()
+            path = os.path.join(self.dev, self.serials[serial])
+        metrics.get_metrics().observe('ovbackup_disk_discovery_seconds', time.monotonic() - started)
+        return path
+
+    def close(self):
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+        if self.sock:
+            self.sock.close()
+
+    def rescan(self):
+        """Index devices not known yet and forget removed ones."""
+        names = set()
+        for path in glob.glob(os.path.join(self.sysfs, 'block', '*')):
+            name = os.path.basename(path)
+            names.add(name)
+            if not self.devices.get(name):
+                self.__add(name)
+        for name in set(self.devices) - names:
+            self.__remove(name)
+
+    def __add(self, name):
+        try:
+            with open(os.path.join(self.sysfs, 'block', name, 'serial'), 'r') as f:
+                serial = f.read().strip()
+        except OSError:
+            serial = ''
+        with self.condition:
+            self.devices[name] = serial
+            if serial:
+                self.serials[serial] = name
+                self.condition.notify_all()
+
+    def __read_unknown_serials(self):
+        for name in [name for name, serial in self.devices.items() if not serial]:
+            self.__add(name)
+
+    def __remove(self, name):
+        with self.condition:
+            serial = self.devices.pop(name, '')
+            if self.serials.get(serial) == name:
+                del self.serials[serial]
+
+    def __open_netlink(self):
+        try:
+            sock = socket.socket(socket.AF_NETLINK, socket.SOCK_DGRAM, NETLINK_KOBJECT_UEVENT)
+            sock.bind((os.getpid(), 1))
+        except (AttributeError, OSError):
+            logger.warning('Netlink uevents unavailable, polling sysfs')
+            return None
+        return sock
+
+    def __listen(self):
+        while not self.closed:
+            try:
+                data = self.sock.recv(65536)
+            except OSError:
+                if not self.closed:
+                    logger.exception('Uevent socket error: ')
+                return
+            event = self.parse_uevent(data)
+            if event.get('SUBSYSTEM') != 'block' or event.get('DEVTYPE') != 'disk':
+                continue
+            name = event.get('DEVNAME', '').split('/')[-1]
+            if event.get('ACTION') == 'add':
+                self.__add(name)
+            elif event.get('ACTION') == 'remove':
+                self.__remove(name)
+
+    def __poll(self):
+        while not self.closed:
+            time.sleep(self.poll_interval)
+            self.rescan()
+
+    @staticmethod
+    def parse_uevent(data):
+        fields = data.split(b'\0')
+        event = dict()
+        for field in fields[1:]:
+            key, sep, value = field.decode('utf-8', 'replace').partition('=')
+            if sep:
+                event[key] = value
+        return event
+
+
+_discovery = None
+_discovery_lock = threading.Lock()
+
+
+def get_discovery():
+    """Process wide discovery service, started on first use."""
+    global _discovery
+    with _discovery_lock:
+        if _discovery is None:
+            _discovery = DeviceDiscovery()
+        return _discovery
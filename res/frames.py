@@ -0,0 +1,225 @@
+import os
+import bz2
+import lzma
+import zlib
+import bisect
+import struct
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from res import app_logger
+logger = app_logger.get_logger(__name__)
+
+FRAME_SIZE = 4 * 1024 * 1024
+MAGIC = b'OVBF'
+VERSION = 1
+# magic, version, codec, level, frame size
+HEADER = struct.Struct('<4sBBBxI')
+# compressed size, uncompressed size, crc32 of uncompressed data
+FRAME = struct.Struct('<III')
+# uncompressed offset, stream offset, size with frame header, uncompressed size
+INDEX_ENTRY = struct.Struct('<QQII')
+# index offset, entries count, magic
+FOOTER = struct.Struct('<QQ4s')
+INDEX_MAGIC = b'OVBI'
+
+# compress setting: (codec id, default level), all of them release the GIL
+CODECS = {
+    'zlib-mt': (1, 6),
+    'bzip2-mt': (2, 9),
+    'xz-mt': (3, 6),
+}
+COMPRESS = {
+    1: lambda data, level: zlib.compress(data, level),
+    2: lambda data, level: bz2.compress(data, level),
+    3: lambda data, level: lzma.compress(data, format=lzma.FORMAT_ALONE, preset=level),
+}
+DECOMPRESS = {
+    1: zlib.decompress,
+    2: bz2.decompress,
+    3: lzma.decompress,
+}
+
+
+class FrameError(Exception):
+    pass
+
+
+class FrameCompressor:
+    """Splits a stream into independent frames compressed on a thread pool.
+
+    Has the compress()/flush() interface of zlib/bz2/lzma compressors, frames
+    are returned in stream order. The index of frames is collected as they are
+    emitted and flush() appends it as a footer after the end marker.
+    """
+    def __init__(self, compress, level=None, workers=None, frame_size=FRAME_SIZE):
+        self.codec, default_level = CODECS[compress]
+        self.level = default_level if level is None else int(level)
+        self.frame_size = frame_size
+        self.workers = workers or os.cpu_count() or 1
+        self.executor = ThreadPoolExecutor(max_workers=self.workers)
+        self.futures = deque()
+        self.pending = bytearray()
+        self.header_sent = False
+        self.index = list()
+        self.offset = 0
+        self.stream_offset = 0
+
+    def compress(self, data):
+        out = bytearray()
+        if not self.header_sent:
+            out += HEADER.pack(MAGIC, VERSION, self.codec, self.level, self.frame_size)
+            self.stream_offset += HEADER.size
+            self.header_sent = True
+        self.pending += data
+        while len(self.pending) >= self.frame_size:
+            frame = bytes(self.pending[:self.frame_size])
+            del self.pending[:self.frame_size]
+            self.__submit(frame, out)
+        while self.futures and self.futures[0].done():
+            self.__emit(self.futures.popleft().result(), out)
+        return bytes(out)
+
+    def flush(self):
+        out = bytearray(self.compress(b''))
+        if self.pending:
+            self.__submit(bytes(self.pending), out)
+            self.pending = bytearray()
+        while self.futures:
+            self.__emit(self.futures.popleft().result(), out)
+        out += self.__trailer()
+        self.executor.shutdown()
+        return bytes(out)
+
+    def __submit(self, frame, out):
+        # bounded in-flight frames keep memory at workers * 2 * frame_size
+        if len(self.futures) >= self.workers * 2:
+            self.__emit(self.futures.popleft().result(), out)
+        self.futures.append(self.executor.submit(self.__compress_frame, frame))
+
+    def __emit(self, frame, out):
+        size, length, crc = FRAME.unpack_from(frame)
+        self.index.append((self.offset, self.stream_offset, len(frame), length))
+        self.offset += length
+        self.stream_offset += len(frame)
+        out += frame
+
+    def __trailer(self):
+        index_offset = self.stream_offset + FRAME.size
+        trailer = bytearray(FRAME.pack(0, 0, 0))
+        for entry in self.index:
+            trailer += INDEX_ENTRY.pack(*entry)
+        trailer += FOOTER.pack(index_offset, len(self.index), INDEX_MAGIC)
+        return trailer
+
+    def __compress_frame(self, frame):
+        payload = COMPRESS[self.codec](frame, self.level)
+        return FRAME.pack(len(payload), len(frame), zlib.crc32(frame)) + payload
+
+
+class FrameDecompressor:
+    """Decompresses frames of a FrameCompressor stream on a thread pool."""
+    def __init__(self, workers=None):
+        self.workers = workers or os.cpu_count() or 1
+        self.executor = ThreadPoolExecutor(max_workers=self.workers)
+        self.futures = deque()
+        self.buffer = bytearray()
+        self.codec = None
+        self.eof = False
+
+    def decompress(self, data):
+        self.buffer += data
+        if self.codec is None:
+            if len(self.buffer) < HEADER.size:
+                return
+            magic, version, self.codec, level, frame_size = HEADER.unpack_from(self.buffer)
+            if magic != MAGIC or version != VERSION:
+                raise FrameError('Not a framed backup stream')
+            del self.buffer[:HEADER.size]
+        while not self.eof and len(self.buffer) >= FRAME.size:
+            size, length, crc = FRAME.unpack_from(self.buffer)
+            if not size:
+                self.eof = True
+                break
+            if len(self.buffer) < FRAME.size + size:
+                break
+            payload = bytes(self.buffer[FRAME.size:FRAME.size + size])
+            del self.buffer[:FRAME.size + size]
+            if len(self.futures) >= self.workers * 2:
+                yield self.futures.popleft().result()
+            self.futures.append(self.executor.submit(self.__decompress_frame, payload, length, crc))
+        while self.futures and (self.eof or self.futures[0].done()):
+            yield self.futures.popleft().result()
+        if self.eof:
+            self.executor.shutdown()
+
+    def finish(self):
+        """Raise if the input ended before the end marker."""
+        if not self.eof:
+            for future in self.futures:
+                future.cancel()
+            self.executor.shutdown()
+            raise FrameError('Framed stream ended before its end marker')
+
+    def __decompress_frame(self, payload, length, crc):
+        data = DECOMPRESS[self.codec](payload)
+        if len(data) != length or zlib.crc32(data) != crc:
+            raise FrameError('Corrupted frame')
+        return data
+
+
+class FrameReader:
+    """Random access to a framed stream through its footer index."""
+    def __init__(self, path, workers=None):
+        self.path = path
+        self.workers = workers or os.cpu_count() or 1
+        self.fd = os.open(path, os.O_RDONLY)
+        header = os.pread(self.fd, HEADER.size, 0)
+        magic, version, self.codec, level, self.frame_size = HEADER.unpack(header)
+        if magic != MAGIC or version != VERSION:
+            raise FrameError('Not a framed backup stream')
+
+        end = os.lseek(self.fd, 0, os.SEEK_END)
+        index_offset, count, magic = FOOTER.unpack(os.pread(self.fd, FOOTER.size, end - FOOTER.size))
+        if magic != INDEX_MAGIC:
+            raise FrameError('Framed stream has no index')
+        data = os.pread(self.fd, count * INDEX_ENTRY.size, index_offset)
+        self.index = [entry for entry in INDEX_ENTRY.iter_unpack(data)]
+        self.offsets = [entry[0] for entry in self.index]
+        self.size = self.index[-1][0] + self.index[-1][3] if self.index else 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def close(self):
+        os.close(self.fd)
+
+    def frames(self, offset=0, length=None):
+        """Return index entries of frames covering the uncompressed range."""
+        end = self.size if length is None else min(self.size, offset + length)
+        first = max(0, bisect.bisect_right(self.offsets, offset) - 1)
+        last = bisect.bisect_left(self.offsets, end)
+        return self.index[first:last]
+
+    def read_frame(self, entry):
+        offset, stream_offset, size, length = entry
+        data = os.pread(self.fd, size, stream_offset)
+        size, length, crc = FRAME.unpack_from(data)
+        frame = DECOMPRESS[self.codec](data[FRAME.size:])
+        if len(frame) != length or zlib.crc32(frame) != crc:
+            raise FrameError('Corrupted frame')
+        return frame
+
+    def read(self, offset, length):
+        """Read an uncompressed byte range, decompressing only the frames it
+        touches, in parallel."""
+        entries = self.frames(offset, length)
+        if not entries:
+            return b''
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            data = b''.join(executor.map(self.read_frame, entries))
+        start = offset - entries[0][0]
+        return data[start:start + length]
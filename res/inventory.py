@@ -0,0 +1,112 @@
+import time
+import threading
+
+from res import app_logger, metrics
+logger = app_logger.get_logger(__name__)
+
+TTL = 300
+
+
+class Inventory:
+    """Cache of engine collections shared by every task on one engine.
+
+    Clusters and vNIC profiles are kept as dicts indexed by id and name, VM
+    name -> id lookups are cached one by one. Entries expire after ttl
+    seconds or when invalidate() is called after a change made by us.
+
+    The cache belongs to one process, every task worker fills its own. Hits
+    and misses are counted in ovbackup_inventory_lookups_total, which the
+    daemon sums over the workers.
+    """
+    def __init__(self, ttl=TTL, engine=''):
+        self.ttl = ttl
+        self.engine = engine
+        self.lock = threading.Lock()
+        self.collections = dict()
+        self.vm_ids = dict()
+        self.hits = 0
+        self.misses = 0
+
+    def cluster_name(self, api_service, cluster_id):
+        by_id, by_name = self.__collection('clusters', api_service.clusters_service)
+        return by_id.get(cluster_id)
+
+    def nic_profile_name(self, api_service, nic_id):
+        by_id, by_name = self.__collection('vnic_profiles', api_service.vnic_profiles_service)
+        return by_id.get(nic_id)
+
+    def nic_profile_id(self, api_service, nic_name):
+        by_id, by_name = self.__collection('vnic_profiles', api_service.vnic_profiles_service)
+        return by_name.get(nic_name)
+
+    def vm_id(self, api_service, vm_name):
+        with self.lock:
+            entry = self.vm_ids.get(vm_name)
+            hit = entry and entry[0] > time.monotonic()
+            self.__count(hit)
+            if hit:
+                return entry[1]
+        self.prime_vms(api_service, [vm_name])
+        with self.lock:
+            entry = self.vm_ids.get(vm_name)
+        return entry[1] if entry else None
+
+    def prime_vms(self, api_service, vm_names):
+        """Resolve many VM names with one OR'ed search."""
+        if not vm_names:
+            return
+        search = ' or '.join(f'name={vm_name}' for vm_name in vm_names)
+        vms = api_service.vms_service().list(search=search)
+        expires = time.monotonic() + self.ttl
+        with self.lock:
+            for vm in vms:
+                self.vm_ids[vm.name] = (expires, vm.id)
+
+    def invalidate(self, name=None):
+        with self.lock:
+            if name is None:
+                self.collections.clear()
+                self.vm_ids.clear()
+            elif name == 'vms':
+                self.vm_ids.clear()
+            else:
+                self.collections.pop(name, None)
+
+    def stats(self):
+        with self.lock:
+            return {'hits': self.hits, 'misses': self.misses}
+
+    def __count(self, hit):
+        if hit:
+            self.hits += 1
+        else:
+            self.misses += 1
+        metrics.get_metrics().inc('ovbackup_inventory_lookups_total', engine=self.engine,
+                                  result='hit' if hit else 'miss')
+
+    def __collection(self, name, service_getter):
+        with self.lock:
+            entry = self.collections.get(name)
+            hit = entry and entry[0] > time.monotonic()
+            self.__count(hit)
+            if hit:
+                return entry[1], entry[2]
+        by_id = dict()
+        by_name = dict()
+        for item in service_getter().list():
+            by_id[item.id] = item.name
+            by_name.setdefault(item.name, item.id)
+        with self.lock:
+            self.collections[name] = (time.monotonic() + self.ttl, by_id, by_name)
+        return by_id, by_name
+
+
+_inventories = dict()
+_inventories_lock = threading.Lock()
+
+
+def get_inventory(engine, ttl=TTL):
+    with _inventories_lock:
+        if engine not in _inventories:
+            _inventories[engine] = Inventory(ttl, engine)
+        return _inventories[engine]
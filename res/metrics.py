@@ -0,0 +1,189 @@
+import os
+import time
+import bisect
+import threading
+from contextlib import contextmanager
+
+from res import app_logger
+logger = app_logger.get_logger(__name__)
+
+STAGE_BUCKETS = (0.01, 0.05, 0.1, 0.5, 1, 5, 10, 30, 60, 300, 900, 1800, 3600, 10800)
+THROUGHPUT_BUCKETS = tuple(mib * 2 ** 20 for mib in (1, 5, 10, 25, 50, 100, 200, 400, 800, 1600))
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5)
+
+# name: (type, help, histogram buckets)
+METRICS = {
+    'ovbackup_stage_duration_seconds': (
+        'histogram', 'Duration of one task stage.', STAGE_BUCKETS),
+    'ovbackup_stage_seconds_total': (
+        'counter', 'Time spent in a task stage per VM.', None),
+    'ovbackup_stage_errors_total': (
+        'counter', 'Task stages that raised an error.', None),
+    'ovbackup_copy_bytes_total': (
+        'counter', 'Bytes read by disk copies.', None),
+    'ovbackup_copy_seconds_total': (
+        'counter', 'Time of disk copies split into read, codec, write and throttle waits.', None),
+    'ovbackup_copy_throughput_bytes': (
+        'histogram', 'Throughput of one disk copy in bytes per second.', THROUGHPUT_BUCKETS),
+    'ovbackup_copy_last_throughput_bytes': (
+        'gauge', 'Throughput of the last copy of a disk in bytes per second.', None),
+    'ovbackup_tasks_total': (
+        'counter', 'Finished tasks by final state.', None),
+    'ovbackup_task_start_latency_seconds': (
+        'histogram', 'Time from submit to a worker picking up the task.', LATENCY_BUCKETS),
+    'ovbackup_workers': (
+        'gauge', 'Task worker processes of the daemon.', None),
+    'ovbackup_workers_busy': (
+        'gauge', 'Task workers running a task.', None),
+    'ovbackup_tasks_queued': (
+        'gauge', 'Tasks waiting for a free worker.', None),
+    'ovbackup_control_request_seconds': (
+        'histogram', 'Time the daemon took to answer one control command.', LATENCY_BUCKETS),
+    'ovbackup_disk_discovery_seconds': (
+        'histogram', 'Time from waiting for an attached disk to finding its device.', STAGE_BUCKETS),
+    'ovbackup_remote_sessions_total': (
+        'counter', 'Remote transport sessions started, reconnects included.', None),
+    'ovbackup_remote_bytes_total': (
+        'counter', 'Bytes moved by remote transport streams.', None),
+    'ovbackup_remote_resent_bytes_total': (
+        'counter', 'Bytes sent or requested again after a remote session was lost.', None),
+    'ovbackup_remote_stream_throughput_bytes': (
+        'histogram', 'Throughput of one remote stream in bytes per second.', THROUGHPUT_BUCKETS),
+    'ovbackup_s3_bytes_total': (
+        'counter', 'Image bytes uploaded to or downloaded from object storage.', None),
+    'ovbackup_s3_retries_total': (
+        'counter', 'Object storage requests repeated after an error.', None),
+    'ovbackup_inventory_lookups_total': (
+        'counter', 'Engine inventory cache lookups by result, hit or miss.', None),
+    'ovbackup_engine_connection_wait_seconds': (
+        'histogram', 'Time a task waited for a pooled engine connection.', LATENCY_BUCKETS),
+    'ovbackup_engine_logins_total': (
+        'counter', 'Engine logins of the connection pools.', None),
+    'ovbackup_engine_login_seconds_total': (
+        'counter', 'Time spent logging in to the engine.', None),
+    'ovbackup_engine_login_saved_seconds_total': (
+        'counter', 'Login time saved by reusing pooled connections, at the average login time.', None),
+}
+
+
+class Metrics:
+    """Counters, gauges and histograms of one process.
+
+    Samples are keyed by (name, labels) where labels is a sorted tuple of
+    pairs. snapshot() is a plain picklable dict, so worker processes send
+    theirs to the daemon, which merges them into one Prometheus text page.
+    Callers record once per stage or per copy, never per block.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = dict()
+        self.gauges = dict()
+        self.histograms = dict()
+
+    def inc(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def set(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.gauges[key] = value
+
+    def observe(self, name, value, **labels):
+        buckets = METRICS[name][2]
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                # per-bucket counts, +Inf last, then sum and count
+                histogram = self.histograms[key] = [0] * (len(buckets) + 1) + [0.0, 0]
+            histogram[bisect.bisect_left(buckets, value)] += 1
+            histogram[-2] += value
+            histogram[-1] += 1
+
+    @contextmanager
+    def stage(self, kind, stage, vm=''):
+        started = time.monotonic()
+        try:
+            yield
+        except:
+            self.inc('ovbackup_stage_errors_total', kind=kind, stage=stage)
+            raise
+        finally:
+            elapsed = time.monotonic() - started
+            self.observe('ovbackup_stage_duration_seconds', elapsed, kind=kind, stage=stage)
+            self.inc('ovbackup_stage_seconds_total', elapsed, kind=kind, stage=stage, vm=vm)
+
+    def snapshot(self):
+        with self.lock:
+            return {
+                'counters': dict(self.counters),
+                'gauges': dict(self.gauges),
+                'histograms': {key: list(value) for key, value in self.histograms.items()},
+            }
+
+    def merge(self, snapshot):
+        with self.lock:
+            for key, value in snapshot['counters'].items():
+                self.counters[key] = self.counters.get(key, 0) + value
+            self.gauges.update(snapshot['gauges'])
+            for key, value in snapshot['histograms'].items():
+                histogram = self.histograms.get(key)
+                if histogram is None:
+                    self.histograms[key] = list(value)
+                else:
+                    for i, count in enumerate(value):
+                        histogram[i] += count
+
+
+def render(snapshots):
+    """Prometheus text exposition of the merged snapshots."""
+    merged = Metrics()
+    for snapshot in snapshots:
+        merged.merge(snapshot)
+    samples = dict()
+    for values in (merged.counters, merged.gauges):
+        for (name, labels), value in values.items():
+            samples.setdefault(name, list()).append(f'{name}{_labels(labels)} {value}')
+    for (name, labels), histogram in merged.histograms.items():
+        lines = samples.setdefault(name, list())
+        cumulative = 0
+        for bound, count in zip(METRICS[name][2] + ('+Inf',), histogram):
+            cumulative += count
+            lines.append(f'{name}_bucket{_labels(labels + (("le", str(bound)),))} {cumulative}')
+        lines.append(f'{name}_sum{_labels(labels)} {histogram[-2]}')
+        lines.append(f'{name}_count{_labels(labels)} {histogram[-1]}')
+    text = list()
+    for name in sorted(samples):
+        metric_type, description, buckets = METRICS[name]
+        text.append(f'# HELP {name} {description}')
+        text.append(f'# TYPE {name} {metric_type}')
+        text.extend(samples[name])
+    return '\n'.join(text) + '\n'
+
+
+def write_file(path, text):
+    """Replace path atomically, for the node_exporter textfile collector."""
+    temp = f'{path}.{os.getpid()}.tmp'
+    with open(temp, 'w') as f:
+        f.write(text)
+    os.replace(temp, path)
+
+
+def _labels(labels):
+    if not labels:
+        return ''
+    pairs = ','.join(f'{key}="{_escape(value)}"' for key, value in labels)
+    return '{' + pairs + '}'
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+_metrics = Metrics()
+
+
+def get_metrics():
+    return _metrics
@@ -0,0 +1,132 @@
+import time
+import threading
+from concurrent.futures import Future
+
+from res import app_logger
+logger = app_logger.get_logger(__name__)
+
+MIN_INTERVAL = 0.5
+MAX_INTERVAL = 10
+BACKOFF = 1.5
+# ids per OR'ed search expression
+SEARCH_BATCH = 50
+
+
+class Watch:
+    def __init__(self, service, object_id, ready, timeout, search):
+        self.service = service
+        self.object_id = object_id
+        self.ready = ready
+        self.search = search
+        self.started = time.monotonic()
+        self.deadline = self.started + timeout
+        self.future = Future()
+
+
+class StatusPoller:
+    """Single thread polling the status of many pending engine objects.
+
+    Watches are grouped by collection service, each group costs one list call
+    per round (OR'ed id search for searchable collections). The interval grows
+    while nothing changes and drops back when an object resolves or a new watch
+    arrives. Every watch resolves a Future with the time the object took to
+    become ready, which is also kept in self.durations.
+    """
+    def __init__(self, lock=None, min_interval=MIN_INTERVAL, max_interval=MAX_INTERVAL):
+        self.lock = lock or threading.Lock()
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.interval = min_interval
+        self.condition = threading.Condition()
+        self.watches = list()
+        self.durations = dict()
+        self.closed = False
+        self.thread = None
+
+    def watch(self, service, object_id, ready, timeout, search=False):
+        with self.condition:
+            watch = Watch(service, object_id, ready, timeout, search)
+            self.watches.append(watch)
+            self.interval = self.min_interval
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.__run, daemon=True)
+                self.thread.start()
+            self.condition.notify()
+        return watch.future
+
+    def wait(self, service, object_id, ready, timeout, search=False):
+        """Block until the object is ready, return the seconds it took."""
+        return self.watch(service, object_id, ready, timeout, search).result()
+
+    def close(self):
+        with self.condition:
+            self.closed = True
+            self.condition.notify()
+
+    def __run(self):
+        while True:
+            with self.condition:
+                while not self.watches and not self.closed:
+                    self.condition.wait()
+                if self.closed:
+                    for watch in self.watches:
+                        watch.future.cancel()
+                    return
+                watches = list(self.watches)
+
+            resolved = self.__poll(watches)
+
+            with self.condition:
+                for watch in resolved:
+                    self.watches.remove(watch)
+                if resolved:
+                    self.interval = self.min_interval
+                else:
+                    self.interval = min(self.max_interval, self.interval * BACKOFF)
+                if self.watches and not self.closed:
+                    self.condition.wait(self.interval)
+
+    def __poll(self, watches):
+        groups = dict()
+        for watch in watches:
+            key = getattr(watch.service, '_path', id(watch.service))
+            groups.setdefault(key, list()).append(watch)
+
+        resolved = list()
+        now = time.monotonic()
+        for group in groups.values():
+            try:
+                objects = self.__list(group)
+            except:
+                logger.exception('Status polling error: ')
+                objects = dict()
+            for watch in group:
+                obj = objects.get(watch.object_id)
+                if obj is not None and watch.ready(obj):
+                    elapsed = now - watch.started
+                    self.durations[watch.object_id] = elapsed
+                    logger.info(f'{watch.object_id} was locked for {elapsed:.1f}s')
+                    watch.future.set_result(elapsed)
+                    resolved.append(watch)
+                elif now > watch.deadline:
+                    watch.future.set_exception(TimeoutError(f'Timeout waiting for {watch.object_id}'))
+                    resolved.append(watch)
+        return resolved
+
+    def __list(self, group):
+        service = group[0].service
+        objects = dict()
+        if not group[0].search:
+            with self.lock:
+                found = service.list()
+            for obj in found:
+                objects[obj.id] = obj
+            return objects
+        ids = [watch.object_id for watch in group]
+        for first in range(0, len(ids), SEARCH_BATCH):
+            search = ' or '.join(f'id={object_id}' for object_id in ids[first:first + SEARCH_BATCH])
+            with self.lock:
+                found = service.list(search=search)
+            for obj in found:
+                objects[obj.id] = obj
+        return objects
@@ -0,0 +1,98 @@
+import os
+import mmap
+import time
+import struct
+
+from res import app_logger
+logger = app_logger.get_logger(__name__)
+
+# sequence, bytes done, bytes total, bytes/s, eta seconds, wall clock of the update
+RECORD = struct.Struct('<QQQddd')
+SEQUENCE = struct.Struct('<Q')
+# minimum window of a throughput sample and weight of the newest one
+RATE_INTERVAL = 1.0
+RATE_WEIGHT = 0.3
+READ_RETRIES = 100
+
+
+class ProgressRecord:
+    """Fixed-size progress record of one disk copy, updated in place.
+
+    The record is a small memory-mapped file, so an update is a few stores
+    into shared memory and a read costs the same at the first and at the last
+    byte of a copy. The single writer bumps the sequence to an odd value
+    before changing the fields and to the next even value after, readers
+    retry until they see the same even sequence around their copy
+    (a seqlock), which gives them a consistent snapshot without locking.
+    """
+    def __init__(self, path):
+        self.path = path
+        fd = os.open(path, os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0o644)
+        try:
+            os.ftruncate(fd, RECORD.size)
+            self.map = mmap.mmap(fd, RECORD.size)
+        finally:
+            os.close(fd)
+        self.sequence = 0
+        self.throughput = 0.0
+        self.sample_time = time.monotonic()
+        self.sample_done = 0
+
+    def update(self, done, total, final=False):
+        now = time.monotonic()
+        elapsed = now - self.sample_time
+        if elapsed >= RATE_INTERVAL or final:
+            rate = (done - self.sample_done) / elapsed if elapsed > 0 else 0.0
+            if self.throughput:
+                self.throughput += RATE_WEIGHT * (rate - self.throughput)
+            else:
+                self.throughput = rate
+            self.sample_time = now
+            self.sample_done = done
+        if total and self.throughput > 0:
+            eta = max(0, total - done) / self.throughput
+        else:
+            eta = -1.0
+        self.sequence += 1
+        SEQUENCE.pack_into(self.map, 0, self.sequence)
+        RECORD.pack_into(self.map, 0, self.sequence, done, total, self.throughput, eta, time.time())
+        self.sequence += 1
+        SEQUENCE.pack_into(self.map, 0, self.sequence)
+
+    def close(self):
+        self.map.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+def read_progress(path):
+    """Consistent snapshot of a progress record, None if it isn't there yet."""
+    try:
+        fd = os.open(path, os.O_RDONLY)
+    except FileNotFoundError:
+        return None
+    try:
+        if os.fstat(fd).st_size < RECORD.size:
+            return None
+        with mmap.mmap(fd, RECORD.size, access=mmap.ACCESS_READ) as record:
+            for i in range(READ_RETRIES):
+                sequence, done, total, throughput, eta, updated = RECORD.unpack_from(record)
+                if sequence % 2 == 0 and SEQUENCE.unpack_from(record)[0] == sequence:
+                    break
+            else:
+                logger.error(f'Progress record {path} kept changing')
+                return None
+    finally:
+        os.close(fd)
+    return {
+        'done': done,
+        'total': total,
+        'percent': done * 100 // total if total else 0,
+        'throughput': throughput,
+        'eta': eta,
+        'updated': updated,
+    }
@@ -0,0 +1,62 @@
+import json
+import struct
+import asyncio
+
+# 4 byte big-endian payload length, then UTF-8 JSON
+LENGTH = struct.Struct('>I')
+MAX_FRAME = 64 * 1024 * 1024
+
+
+class ProtocolError(Exception):
+    pass
+
+
+def encode(message):
+    payload = json.dumps(message).encode('utf-8')
+    if len(payload) > MAX_FRAME:
+        raise ProtocolError('Frame too large')
+    return LENGTH.pack(len(payload)) + payload
+
+
+def decode(payload):
+    return json.loads(payload.decode('utf-8'))
+
+
+async def read_message(reader):
+    """Read one frame from an asyncio stream, None on a clean EOF."""
+    try:
+        header = await reader.readexactly(LENGTH.size)
+    except asyncio.IncompleteReadError as e:
+        if e.partial:
+            raise ProtocolError('Connection closed inside a frame')
+        return None
+    size, = LENGTH.unpack(header)
+    if size > MAX_FRAME:
+        raise ProtocolError('Frame too large')
+    try:
+        return decode(await reader.readexactly(size))
+    except asyncio.IncompleteReadError:
+        raise ProtocolError('Connection closed inside a frame')
+
+
+def recv_message(sock):
+    """Blocking counterpart of read_message for clients."""
+    header = _recv_exactly(sock, LENGTH.size)
+    if header is None:
+        return None
+    size, = LENGTH.unpack(header)
+    if size > MAX_FRAME:
+        raise ProtocolError('Frame too large')
+    return decode(_recv_exactly(sock, size))
+
+
+def _recv_exactly(sock, size):
+    data = bytearray()
+    while len(data) < size:
+        chunk = sock.recv(size - len(data))
+        if not chunk:
+            if data:
+                raise ProtocolError('Connection closed inside a frame')
+            return None
+        data += chunk
+    return bytes(data)
@@ -0,0 +1,141 @@
+import time
+import sqlite3
+import threading
+
+from res import app_logger
+logger = app_logger.get_logger(__name__)
+
+RETENTION = 30 * 24 * 3600
+COMPACT_INTERVAL = 3600
+ACTIVE_STATES = ('queued', 'running')
+COLUMNS = ('id', 'kind', 'pid', 'state', 'created', 'started', 'finished', 'updated', 'bytes', 'error', 'info')
+
+
+class TaskRegistry:
+    """Durable record of every task: pid, state, timestamps, bytes and errors.
+
+    Tasks live in one sqlite table in WAL mode, so the daemon, the workers
+    and the tasks' own threads write to it concurrently, each through its own
+    connection and with single-statement transactions. State and update
+    time are indexed, so active tasks or the last day of history are read
+    without a scan or a sort. Finished tasks older than retention seconds are
+    deleted at most once per COMPACT_INTERVAL, from whichever writer finishes
+    a task.
+    """
+    def __init__(self, path, retention=RETENTION):
+        self.path = path
+        self.retention = retention
+        self.local = threading.local()
+        self.compacted = 0.0
+        db = self.__db()
+        db.execute(
+            'CREATE TABLE IF NOT EXISTS tasks ('
+            'id TEXT PRIMARY KEY, kind TEXT, pid INTEGER, state TEXT NOT NULL, '
+            'created REAL NOT NULL, started REAL, finished REAL, updated REAL NOT NULL, '
+            "bytes INTEGER NOT NULL DEFAULT 0, error TEXT, info TEXT NOT NULL DEFAULT ''"
+            ')'
+        )
+        db.execute('CREATE INDEX IF NOT EXISTS tasks_state ON tasks (state, updated)')
+        db.execute('CREATE INDEX IF NOT EXISTS tasks_finished ON tasks (finished)')
+        db.execute('CREATE INDEX IF NOT EXISTS tasks_updated ON tasks (updated)')
+
+    def create(self, task_id, kind, state='queued'):
+        """Record a new task. The id of a finished task starts over as a new
+        one, the record of a task that is still active is left as it is."""
+        now = time.time()
+        self.__db().execute(
+            'INSERT INTO tasks (id, kind, state, created, updated) VALUES (?, ?, ?, ?, ?) '
+            'ON CONFLICT (id) DO UPDATE SET kind=excluded.kind, state=excluded.state, pid=NULL, '
+            'created=excluded.created, started=NULL, finished=NULL, updated=excluded.updated, '
+            "bytes=0, error=NULL, info='' WHERE finished IS NOT NULL",
+            (task_id, kind, state, now, now)
+        )
+
+    def start(self, task_id, pid):
+        now = time.time()
+        self.__db().execute(
+            "INSERT INTO tasks (id, pid, state, created, started, updated) VALUES (?, ?, 'running', ?, ?, ?) "
+            "ON CONFLICT (id) DO UPDATE SET pid=excluded.pid, state='running', "
+            'started=excluded.started, updated=excluded.updated WHERE finished IS NULL',
+            (task_id, pid, now, now, now)
+        )
+
+    def finish(self, task_id, state, error=None):
+        now = time.time()
+        self.__db().execute(
+            'UPDATE tasks SET state=?, error=COALESCE(?, error), finished=?, updated=? WHERE id=?',
+            (state, error, now, now, task_id)
+        )
+        if now - self.compacted > COMPACT_INTERVAL:
+            self.compact()
+
+    def add_info(self, task_id, line):
+        self.__db().execute(
+            'UPDATE tasks SET info=info || ?, updated=? WHERE id=?', (line + '\n', time.time(), task_id)
+        )
+
+    def add_bytes(self, task_id, count):
+        self.__db().execute(
+            'UPDATE tasks SET bytes=bytes + ?, updated=? WHERE id=?', (count, time.time(), task_id)
+        )
+
+    def get(self, task_id):
+        row = self.__db().execute(f'SELECT {", ".join(COLUMNS)} FROM tasks WHERE id=?', (task_id,)).fetchone()
+        return dict(zip(COLUMNS, row)) if row else None
+
+    def find(self, task_ids=None, states=None, since=None, limit=None):
+        """Tasks by id, or by state and last update time, newest first."""
+        query = f'SELECT {", ".join(COLUMNS)} FROM tasks'
+        where = list()
+        params = list()
+        if task_ids is not None:
+            where.append(f'id IN ({", ".join("?" * len(task_ids))})')
+            params.extend(task_ids)
+        if states is not None:
+            where.append(f'state IN ({", ".join("?" * len(states))})')
+            params.extend(states)
+        if since is not None:
+            where.append('updated >= ?')
+            params.append(since)
+        if where:
+            query += ' WHERE ' + ' AND '.join(where)
+        query += ' ORDER BY updated DESC'
+        if limit is not None:
+            query += ' LIMIT ?'
+            params.append(limit)
+        return [dict(zip(COLUMNS, row)) for row in self.__db().execute(query, params)]
+
+    def compact(self):
+        self.compacted = time.time()
+        try:
+            db = self.__db()
+            cursor = db.execute(
+                f'DELETE FROM tasks WHERE finished < ? AND state NOT IN ({", ".join("?" * len(ACTIVE_STATES))})',
+                (self.compacted - self.retention,) + ACTIVE_STATES
+            )
+            if cursor.rowcount:
+                logger.info(f'Task registry: {cursor.rowcount} finished tasks removed')
+            db.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+        except sqlite3.OperationalError:
+            logger.exception('Task registry compact error: ')
+
+    def __db(self):
+        db = getattr(self.local, 'db', None)
+        if db is None:
+            # autocommit, every statement is its own short transaction
+            db = sqlite3.connect(self.path, timeout=60, isolation_level=None)
+            db.execute('PRAGMA journal_mode=WAL')
+            db.execute('PRAGMA synchronous=NORMAL')
+            self.local.db = db
+        return db
+
+
+_registries = dict()
+_registries_lock = threading.Lock()
+
+
+def get_registry(path, retention=RETENTION):
+    with _registries_lock:
+        if path not in _registries:
+            _registries[path] = TaskRegistry(path, retention)
+        return _registries[path]
@@ -0,0 +1,431 @@
+import os
+import sys
+import json
+import time
+import shlex
+import struct
+import itertools
+import threading
+import subprocess
+from collections import deque
+
+from res import app_logger, metrics, remote_receiver
+from res.remote_receiver import OPEN, OPENED, DATA, ACK, CLOSE, CLOSED, READ, ERROR
+logger = app_logger.get_logger(__name__)
+
+FRAME_SIZE = 1024 * 1024
+# bytes a stream may have in flight without acknowledgement
+WINDOW = 32 * 1024 * 1024
+# reconnects of a session a stream tries before it fails
+RETRIES = 3
+# seconds a stream waits without any progress
+TIMEOUT = 300
+WAIT = 1.0
+
+
+class RemoteError(Exception):
+    pass
+
+
+class _Broken(Exception):
+    """The session of a stream died, the stream has to recover."""
+
+
+def receiver_command(host='', user='', python='python3'):
+    """Command starting a receiver: through ssh, or a local process with
+    no host, which stands in for a remote one."""
+    receiver = os.path.abspath(remote_receiver.__file__)
+    if not host:
+        return [sys.executable, '-u', receiver]
+    with open(receiver, 'r') as f:
+        source = f.read()
+    target = f'{user}@{host}' if user else host
+    return ['ssh', '-o', 'BatchMode=yes', target, f'{python} -u -c {shlex.quote(source)}']
+
+
+class RemoteSession:
+    """One receiver process per remote host, shared by the copies of a process.
+
+    The ssh login and key exchange are paid once per session instead of once
+    per disk. Disk streams are multiplexed over the session's pipes: frames of
+    different streams interleave, a reader thread hands replies to their
+    streams. Writes are pipelined, a stream keeps up to WINDOW bytes in flight
+    and holds them until they are acknowledged. When the receiver or the
+    connection dies the first stream to notice starts a new session and every
+    stream re-opens its file, learns how far the receiver got and sends the
+    rest from its unacknowledged frames.
+    """
+    def __init__(self, command, name='local'):
+        self.command = command
+        self.name = name
+        self.condition = threading.Condition()
+        self.send_lock = threading.Lock()
+        self.streams = dict()
+        self.ids = itertools.count(1)
+        self.process = None
+        self.generation = 0
+        self.broken = True
+        self.closed = False
+        self.reconnect(0)
+
+    def reconnect(self, generation):
+        """Start a new receiver unless another stream already replaced the
+        session of that generation."""
+        with self.condition:
+            if self.closed:
+                raise RemoteError('Remote session closed')
+            if generation != self.generation and not self.broken:
+                return
+            if self.process is not None:
+                logger.warning(f'Remote session {self.name} lost, reconnecting')
+                self.__stop(self.process)
+            self.process = subprocess.Popen(self.command, stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+            self.generation += 1
+            self.broken = False
+            metrics.get_metrics().inc('ovbackup_remote_sessions_total', host=self.name)
+            thread = threading.Thread(target=self.__read_loop, args=(self.process, self.generation), daemon=True)
+            thread.start()
+
+    def register(self, stream):
+        with self.condition:
+            stream_id = next(self.ids)
+            self.streams[stream_id] = stream
+            return stream_id
+
+    def unregister(self, stream_id):
+        with self.condition:
+            self.streams.pop(stream_id, None)
+
+    def is_broken(self, generation):
+        with self.condition:
+            return self.broken or generation != self.generation
+
+    def send(self, generation, kind, stream_id, offset=0, payload=b''):
+        header = remote_receiver.HEADER.pack(kind, stream_id, offset, len(payload))
+        with self.send_lock:
+            with self.condition:
+                if self.broken or generation != self.generation:
+                    raise _Broken()
+                fd = self.process.stdin.fileno()
+            buffers = [header, memoryview(payload)]
+            try:
+                while buffers:
+                    written = os.writev(fd, buffers)
+                    while buffers and written >= len(buffers[0]):
+                        written -= len(buffers[0])
+                        buffers.pop(0)
+                    if buffers and written:
+                        buffers[0] = buffers[0][written:]
+            except OSError:
+                self.__lost(generation)
+                raise _Broken()
+
+    def open_writer(self, path, resume=False, window=WINDOW):
+        return RemoteWriter(self, path, resume, window)
+
+    def open_reader(self, path, window=WINDOW):
+        return RemoteReader(self, path, window)
+
+    def close(self):
+        with self.condition:
+            self.closed = True
+            self.broken = True
+            process, self.process = self.process, None
+        if process is not None:
+            self.__stop(process)
+
+    def __read_loop(self, process, generation):
+        try:
+            while True:
+                frame = remote_receiver.read_frame(process.stdout)
+                if frame is None:
+                    break
+                kind, stream_id, offset, payload = frame
+                with self.condition:
+                    if generation != self.generation:
+                        return
+                    stream = self.streams.get(stream_id)
+                if stream is not None:
+                    stream.deliver(kind, offset, payload)
+        except (OSError, EOFError):
+            logger.exception(f'Remote session {self.name} read error: ')
+        self.__lost(generation)
+
+    def __lost(self, generation):
+        with self.condition:
+            if generation != self.generation:
+                return
+            self.broken = True
+            streams = list(self.streams.values())
+        for stream in streams:
+            stream.wake()
+
+    @staticmethod
+    def __stop(process):
+        try:
+            process.stdin.close()
+        except OSError:
+            pass
+        try:
+            process.wait(timeout=5)
+        except subprocess.TimeoutExpired:
+            process.kill()
+            process.wait()
+
+
+class _Stream:
+    mode = None
+
+    def __init__(self, session, path, window):
+        self.session = session
+        self.path = path
+        self.window = window
+        self.condition = threading.Condition()
+        self.reply = None
+        self.error = None
+        self.generation = session.generation
+        self.bytes = 0
+        self.resent = 0
+        self.started = time.monotonic()
+        self.elapsed = 0.0
+        self.stream_id = session.register(self)
+
+    def deliver(self, kind, offset, payload):
+        with self.condition:
+            if kind in (OPENED, CLOSED):
+                self.reply = offset
+            elif kind == ERROR:
+                self.error = payload.decode('utf-8', 'replace')
+            else:
+                self.received(kind, offset, payload)
+            self.condition.notify_all()
+
+    def received(self, kind, offset, payload):
+        pass
+
+    def wake(self):
+        with self.condition:
+            self.condition.notify_all()
+
+    def throughput(self):
+        return self.bytes / self.elapsed if self.elapsed else 0.0
+
+    def _open(self, resume, recover=True):
+        request = {'path': self.path, 'mode': self.mode, 'resume': resume}
+        return self._request(OPEN, json.dumps(request).encode('utf-8'), recover)
+
+    def _request(self, kind, payload=b'', recover=True):
+        """Send OPEN or CLOSE and wait for its reply offset."""
+        while True:
+            with self.condition:
+                self.reply = None
+            try:
+                self._send(kind, 0, payload)
+                self._wait(lambda: self.reply is not None, recover=False)
+                return self.reply
+            except _Broken:
+                if not recover:
+                    raise
+                self._recover()
+
+    def _send(self, kind, offset, payload=b''):
+        self.session.send(self.generation, kind, self.stream_id, offset, payload)
+
+    def _wait(self, predicate, recover=True):
+        deadline = time.monotonic() + TIMEOUT
+        while True:
+            try:
+                with self.condition:
+                    while True:
+                        if self.error is not None:
+                            raise RemoteError(f'{self.path}: {self.error}')
+                        if predicate():
+                            return
+                        if self.session.is_broken(self.generation):
+                            raise _Broken()
+                        if time.monotonic() > deadline:
+                            raise RemoteError(f'{self.path}: no progress for {TIMEOUT}s')
+                        self.condition.wait(WAIT)
+            except _Broken:
+                if not recover:
+                    raise
+                self._recover()
+                deadline = time.monotonic() + TIMEOUT
+
+    def _recover(self):
+        for attempt in range(RETRIES):
+            self.session.reconnect(self.generation)
+            self.generation = self.session.generation
+            try:
+                self._resume(self._open(True, recover=False))
+                return
+            except _Broken:
+                continue
+        raise RemoteError(f'{self.path}: remote session lost')
+
+    def _resume(self, offset):
+        pass
+
+    def _finish(self):
+        try:
+            self._request(CLOSE)
+        finally:
+            self.session.unregister(self.stream_id)
+            self.elapsed = time.monotonic() - self.started
+            labels = {'host': self.session.name, 'direction': self.mode}
+            stats = metrics.get_metrics()
+            stats.inc('ovbackup_remote_bytes_total', self.bytes, **labels)
+            stats.inc('ovbackup_remote_resent_bytes_total', self.resent, **labels)
+            if self.elapsed:
+                stats.observe('ovbackup_remote_stream_throughput_bytes', self.throughput(), **labels)
+
+
+class RemoteWriter(_Stream):
+    """Sequential writer of one remote file, stored as <path>.part until
+    close() has every byte acknowledged and the receiver renamed it."""
+    mode = 'write'
+
+    def __init__(self, session, path, resume=False, window=WINDOW):
+        super().__init__(session, path, window)
+        # sent and not yet acknowledged (offset, data)
+        self.pending = deque()
+        self.unacked = 0
+        # a session lost during the first OPEN recovers from here
+        self.offset = 0
+        self.offset = self._open(resume)
+
+    def write(self, data):
+        view = memoryview(data).cast('B')
+        for start in range(0, len(view), FRAME_SIZE):
+            piece = bytes(view[start:start + FRAME_SIZE])
+            self._wait(lambda: not self.pending or self.unacked + len(piece) <= self.window)
+            with self.condition:
+                offset = self.offset
+                self.pending.append((offset, piece))
+                self.unacked += len(piece)
+                self.offset += len(piece)
+                self.bytes += len(piece)
+            try:
+                self._send(DATA, offset, piece)
+            except _Broken:
+                # the frame is pending, recovery sends it again
+                self._recover()
+        return len(view)
+
+    def close(self):
+        self._wait(lambda: not self.pending)
+        self._finish()
+
+    def received(self, kind, offset, payload):
+        if kind != ACK:
+            return
+        while self.pending and self.pending[0][0] + len(self.pending[0][1]) <= offset:
+            self.unacked -= len(self.pending.popleft()[1])
+
+    def _resume(self, offset):
+        """Send again what the receiver doesn't have, from offset on."""
+        with self.condition:
+            self.received(ACK, offset, b'')
+            first = self.pending[0][0] if self.pending else self.offset
+            if offset < first:
+                raise RemoteError(f'{self.path}: receiver lost acknowledged data at {offset}')
+            frames = list(self.pending)
+        for frame_offset, piece in frames:
+            if frame_offset < offset:
+                piece = piece[offset - frame_offset:]
+                frame_offset = offset
+            self.resent += len(piece)
+            self._send(DATA, frame_offset, piece)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self.session.unregister(self.stream_id)
+
+
+class RemoteReader(_Stream):
+    """Sequential reader of one remote file with up to window bytes of READ
+    requests in flight."""
+    mode = 'read'
+
+    def __init__(self, session, path, window=WINDOW):
+        super().__init__(session, path, window)
+        self.chunks = dict()
+        self.outstanding = set()
+        self.requested = 0
+        self.position = 0
+        self.size = self._open(False)
+
+    def readinto(self, buffer):
+        view = memoryview(buffer).cast('B')
+        filled = 0
+        while filled < len(view) and self.position < self.size:
+            self.__request_more()
+            self._wait(lambda: self.position in self.chunks)
+            with self.condition:
+                data = self.chunks.pop(self.position)
+            if not data:
+                raise RemoteError(f'{self.path}: file shrank at {self.position}')
+            length = min(len(data), len(view) - filled)
+            view[filled:filled + length] = data[:length]
+            if length < len(data):
+                with self.condition:
+                    self.chunks[self.position + length] = data[length:]
+            filled += length
+            self.position += length
+        return filled
+
+    def close(self):
+        self._finish()
+
+    def received(self, kind, offset, payload):
+        if kind != DATA or offset not in self.outstanding:
+            return
+        self.outstanding.discard(offset)
+        self.chunks[offset] = payload
+        self.bytes += len(payload)
+
+    def _resume(self, offset):
+        with self.condition:
+            offsets = sorted(self.outstanding)
+        for chunk_offset in offsets:
+            self.resent += min(FRAME_SIZE, self.size - chunk_offset)
+            self._send(READ, chunk_offset, struct.pack('>I', FRAME_SIZE))
+
+    def __request_more(self):
+        while self.requested < self.size and self.requested - self.position < self.window:
+            with self.condition:
+                offset = self.requested
+                self.outstanding.add(offset)
+                self.requested += FRAME_SIZE
+            try:
+                self._send(READ, offset, struct.pack('>I', FRAME_SIZE))
+            except _Broken:
+                self._recover()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self.session.unregister(self.stream_id)
+
+
+_sessions = dict()
+_sessions_lock = threading.Lock()
+
+
+def get_session(host='', user='', python='python3'):
+    """Session of the host, the local stand-in receiver without one."""
+    key = (host, user)
+    with _sessions_lock:
+        session = _sessions.get(key)
+        if session is None or session.closed:
+            session = _sessions[key] = RemoteSession(receiver_command(host, user, python), host or 'local')
+        return session
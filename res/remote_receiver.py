@@ -0,0 +1,123 @@
+"""Receiving end of the remote transport (see res/remote.py).
+
+Runs on the remote host with the standard library only: the daemon starts it
+as `ssh user@host python3 -u -c <this file>`, so nothing has to be installed
+there. Frames come on stdin and replies go to stdout:
+
+    kind (1 byte), stream id (4), offset (8), payload length (4), payload
+
+OPEN carries {"path", "mode": "write"|"read", "resume"} as JSON. A written
+file is kept as <path>.part until CLOSE, which syncs it and renames it into
+place. With resume the .part file is kept and its size is returned, the
+sender restarts from there. DATA frames are written at their offset and
+acknowledged with ACK(end offset), READ(offset, length) is answered with
+DATA, an empty one at end of file.
+"""
+import os
+import sys
+import json
+import struct
+
+HEADER = struct.Struct('>BIQI')
+OPEN, OPENED, DATA, ACK, CLOSE, CLOSED, READ, ERROR = range(1, 9)
+PART_SUFFIX = '.part'
+MAX_PAYLOAD = 64 * 1024 * 1024
+
+
+def read_exactly(stream, size):
+    data = bytearray()
+    while len(data) < size:
+        chunk = stream.read(size - len(data))
+        if not chunk:
+            if data:
+                raise EOFError('Connection closed inside a frame')
+            return None
+        data += chunk
+    return bytes(data)
+
+
+def read_frame(stream):
+    """Return (kind, stream id, offset, payload), None on a clean EOF."""
+    header = read_exactly(stream, HEADER.size)
+    if header is None:
+        return None
+    kind, stream_id, offset, length = HEADER.unpack(header)
+    if length > MAX_PAYLOAD:
+        raise EOFError('Frame too large')
+    payload = read_exactly(stream, length) if length else b''
+    if payload is None:
+        raise EOFError('Connection closed inside a frame')
+    return kind, stream_id, offset, payload
+
+
+def pack_frame(kind, stream_id, offset=0, payload=b''):
+    return HEADER.pack(kind, stream_id, offset, len(payload)) + payload
+
+
+class Receiver:
+    def __init__(self, stdin, stdout):
+        self.stdin = stdin
+        self.stdout = stdout
+        self.files = dict()
+
+    def serve(self):
+        while True:
+            frame = read_frame(self.stdin)
+            if frame is None:
+                break
+            kind, stream_id, offset, payload = frame
+            try:
+                self.handle(kind, stream_id, offset, payload)
+            except Exception as e:
+                entry = self.files.pop(stream_id, None)
+                if entry:
+                    os.close(entry[0])
+                self.reply(ERROR, stream_id, 0, repr(e).encode('utf-8'))
+            self.stdout.flush()
+        for fd, path, mode in self.files.values():
+            os.close(fd)
+
+    def handle(self, kind, stream_id, offset, payload):
+        if kind == OPEN:
+            request = json.loads(payload.decode('utf-8'))
+            path = request['path']
+            if request['mode'] == 'write':
+                directory = os.path.dirname(path)
+                if directory:
+                    os.makedirs(directory, exist_ok=True)
+                flags = os.O_WRONLY | os.O_CREAT | (0 if request.get('resume') else os.O_TRUNC)
+                fd = os.open(path + PART_SUFFIX, flags, 0o640)
+            else:
+                fd = os.open(path, os.O_RDONLY)
+            self.files[stream_id] = (fd, path, request['mode'])
+            self.reply(OPENED, stream_id, os.lseek(fd, 0, os.SEEK_END))
+        elif kind == DATA:
+            fd, path, mode = self.files[stream_id]
+            view = memoryview(payload)
+            position = offset
+            while view:
+                written = os.pwrite(fd, view, position)
+                view = view[written:]
+                position += written
+            self.reply(ACK, stream_id, offset + len(payload))
+        elif kind == READ:
+            fd, path, mode = self.files[stream_id]
+            length, = struct.unpack('>I', payload)
+            self.reply(DATA, stream_id, offset, os.pread(fd, length, offset))
+        elif kind == CLOSE:
+            fd, path, mode = self.files.pop(stream_id)
+            size = os.lseek(fd, 0, os.SEEK_END)
+            if mode == 'write':
+                os.fsync(fd)
+                os.close(fd)
+                os.replace(path + PART_SUFFIX, path)
+            else:
+                os.close(fd)
+            self.reply(CLOSED, stream_id, size)
+
+    def reply(self, kind, stream_id, offset=0, payload=b''):
+        self.stdout.write(pack_frame(kind, stream_id, offset, payload))
+
+
+if __name__ == '__main__':
+    Receiver(sys.stdin.buffer, sys.stdout.buffer).serve()
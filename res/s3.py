@@ -0,0 +1,203 @@
+import hmac
+import time
+import base64
+import hashlib
+import datetime
+import threading
+import http.client
+import xml.etree.ElementTree as ElementTree
+from urllib.parse import quote, urlsplit
+
+from res import app_logger, metrics
+logger = app_logger.get_logger(__name__)
+
+RETRIES = 4
+BACKOFF = 0.5
+TIMEOUT = 300
+# kept by S3-compatible services as parts of at least this size
+MIN_PART_SIZE = 5 * 1024 * 1024
+MAX_PARTS = 10000
+# statuses a request is repeated on
+RETRY_STATUS = (500, 502, 503, 504)
+
+
+class S3Error(Exception):
+    def __init__(self, status, code, message=''):
+        super().__init__(f'{status} {code}: {message}')
+        self.status = status
+        self.code = code
+
+
+class S3Client:
+    """The few calls of the S3 REST API the storage backend needs.
+
+    Requests are signed with AWS Signature Version 4 and addressed path-style
+    (<endpoint>/<bucket>/<key>), which AWS and the S3-compatible stores
+    (MinIO, Ceph RGW, ...) accept. Each thread keeps its own keep-alive
+    connection, so parallel part uploads don't pay a TLS handshake per part.
+    Bodies aren't hashed for the signature (UNSIGNED-PAYLOAD), parts carry a
+    Content-MD5 the service checks instead. Connection errors and 5xx
+    replies are retried with a growing pause.
+    """
+    def __init__(self, endpoint, bucket, access_key, secret_key, region='us-east-1', timeout=TIMEOUT):
+        url = urlsplit(endpoint if '://' in endpoint else 'https://' + endpoint)
+        self.secure = url.scheme == 'https'
+        self.host = url.netloc
+        self.bucket = bucket
+        self.access_key = access_key
+        self.secret_key = secret_key
+        self.region = region
+        self.timeout = timeout
+        self.local = threading.local()
+
+    def head_object(self, key):
+        """Size of the object, None if it doesn't exist."""
+        status, headers, body = self.__request('HEAD', key, ok=(200, 404))
+        if status == 404:
+            return None
+        return int(headers['content-length'])
+
+    def get_object(self, key, start=None, length=None):
+        headers = dict()
+        if start is not None:
+            headers['range'] = f'bytes={start}-{start + length - 1}' if length else f'bytes={start}-'
+        status, headers, body = self.__request('GET', key, headers=headers, ok=(200, 206))
+        return body
+
+    def put_object(self, key, data):
+        self.__request('PUT', key, body=data)
+
+    def delete_object(self, key):
+        self.__request('DELETE', key, ok=(204, 200, 404))
+
+    def create_multipart_upload(self, key):
+        status, headers, body = self.__request('POST', key, query={'uploads': ''})
+        return _find(ElementTree.fromstring(body), 'UploadId')
+
+    def upload_part(self, key, upload_id, number, data):
+        """Upload part number (from 1) and return its ETag."""
+        query = {'partNumber': str(number), 'uploadId': upload_id}
+        status, headers, body = self.__request('PUT', key, query=query, body=data)
+        return headers['etag']
+
+    def complete_multipart_upload(self, key, upload_id, etags):
+        parts = ''.join(
+            f'<Part><PartNumber>{number}</PartNumber><ETag>{etag}</ETag></Part>'
+            for number, etag in enumerate(etags, 1)
+        )
+        body = f'<CompleteMultipartUpload>{parts}</CompleteMultipartUpload>'.encode('utf-8')
+        status, headers, reply = self.__request('POST', key, query={'uploadId': upload_id}, body=body)
+        # the reply status is sent before the parts are joined, failures come in the body
+        root = ElementTree.fromstring(reply)
+        if _name(root) == 'Error':
+            raise S3Error(status, _find(root, 'Code'), _find(root, 'Message'))
+
+    def abort_multipart_upload(self, key, upload_id):
+        self.__request('DELETE', key, query={'uploadId': upload_id}, ok=(204, 200, 404))
+
+    def close(self):
+        connection = getattr(self.local, 'connection', None)
+        if connection is not None:
+            connection.close()
+            self.local.connection = None
+
+    def __request(self, method, key, query=None, headers=None, body=b'', ok=(200,)):
+        path = '/' + quote(self.bucket, safe='') + '/' + quote(key, safe='/-_.~')
+        query = query or dict()
+        query_string = '&'.join(
+            f'{quote(name, safe="-_.~")}={quote(value, safe="-_.~")}' for name, value in sorted(query.items())
+        )
+        headers = dict(headers or dict())
+        if body:
+            headers['content-md5'] = base64.b64encode(hashlib.md5(body).digest()).decode('ascii')
+        for attempt in range(RETRIES + 1):
+            signed = self.__sign(method, path, query_string, headers)
+            try:
+                connection = self.__connection()
+                connection.request(method, path + ('?' + query_string if query_string else ''), body=body,
+                                   headers=signed)
+                response = connection.getresponse()
+                reply = response.read()
+                status = response.status
+                reply_headers = {name.lower(): value for name, value in response.getheaders()}
+            except (OSError, http.client.HTTPException) as e:
+                self.close()
+                if attempt == RETRIES:
+                    raise
+                logger.warning(f'S3 {method} {key} error, retrying: {e!r}')
+            else:
+                if status in ok:
+                    return status, reply_headers, reply
+                if status not in RETRY_STATUS or attempt == RETRIES:
+                    raise self.__error(status, reply)
+                logger.warning(f'S3 {method} {key} returned {status}, retrying')
+            metrics.get_metrics().inc('ovbackup_s3_retries_total', method=method)
+            time.sleep(BACKOFF * 2 ** attempt)
+
+    def __sign(self, method, path, query_string, headers):
+        now = datetime.datetime.now(datetime.timezone.utc)
+        amz_date = now.strftime('%Y%m%dT%H%M%SZ')
+        scope = f'{now.strftime("%Y%m%d")}/{self.region}/s3/aws4_request'
+        signed = dict(headers)
+        signed.update({'host': self.host, 'x-amz-date': amz_date, 'x-amz-content-sha256': 'UNSIGNED-PAYLOAD'})
+        names = sorted(signed)
+        canonical = '\n'.join([
+            method,
+            path,
+            query_string,
+            ''.join(f'{name}:{str(signed[name]).strip()}\n' for name in names),
+            ';'.join(names),
+            'UNSIGNED-PAYLOAD',
+        ])
+        string_to_sign = '\n'.join([
+            'AWS4-HMAC-SHA256', amz_date, scope, hashlib.sha256(canonical.encode('utf-8')).hexdigest(),
+        ])
+        key = ('AWS4' + self.secret_key).encode('utf-8')
+        for part in scope.split('/'):
+            key = hmac.new(key, part.encode('utf-8'), hashlib.sha256).digest()
+        signature = hmac.new(key, string_to_sign.encode('utf-8'), hashlib.sha256).hexdigest()
+        signed['authorization'] = (
+            f'AWS4-HMAC-SHA256 Credential={self.access_key}/{scope}, '
+            f'SignedHeaders={";".join(names)}, Signature={signature}'
+        )
+        return signed
+
+    def __connection(self):
+        connection = getattr(self.local, 'connection', None)
+        if connection is None:
+            factory = http.client.HTTPSConnection if self.secure else http.client.HTTPConnection
+            connection = self.local.connection = factory(self.host, timeout=self.timeout)
+        return connection
+
+    @staticmethod
+    def __error(status, reply):
+        try:
+            root = ElementTree.fromstring(reply)
+            return S3Error(status, _find(root, 'Code'), _find(root, 'Message'))
+        except ElementTree.ParseError:
+            return S3Error(status, 'Unknown', reply[:200].decode('utf-8', 'replace'))
+
+
+def _name(element):
+    """Tag without the XML namespace."""
+    return element.tag.rsplit('}', 1)[-1]
+
+
+def _find(root, name):
+    for element in root.iter():
+        if _name(element) == name:
+            return element.text or ''
+    return ''
+
+
+_clients = dict()
+_clients_lock = threading.Lock()
+
+
+def get_client(endpoint, bucket, access_key, secret_key, region='us-east-1'):
+    key = (endpoint, bucket, access_key, region)
+    with _clients_lock:
+        client = _clients.get(key)
+        if client is None or client.secret_key != secret_key:
+            client = _clients[key] = S3Client(endpoint, bucket, access_key, secret_key, region)
+        return client
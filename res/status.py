@@ -1,47 +1,82 @@
 import os
+import glob
+import time
 
-import config_tool
-import app_logger
+from res import app_logger, config_tool, registry, progress
 logger = app_logger.get_logger(__name__)
 
+# finished tasks listed by a status request without task ids
+HISTORY = 24 * 3600
+
 
 class Status:
     def __init__(self):
         self.config = config_tool.ConfigTool()
         self.tmp = self.config.get_tmp()
-        self.active_pid = self.config.get_active_pid_file()
-        self.info_file = ''
-        self.info = dict()
+        self.registry = registry.get_registry(self.config.get_task_registry_file(), self.config.get_task_retention())
+        self.task_id = None
 
-    def get(self):
+    def get(self, task_ids=None):
+        """Status of the given tasks, or of active and recently finished ones."""
+        if task_ids is not None:
+            tasks = self.registry.find(task_ids=list(task_ids))
+        else:
+            tasks = self.registry.find(states=registry.ACTIVE_STATES)
+            tasks += self.registry.find(since=time.time() - HISTORY)
         status = dict()
-        tasks = self.config.get_active_pid()
-        if not tasks:
-            return
-        for task_id in tasks.keys():
-            info_file = os.path.join(self.tmp, task_id + '.info')
-            try:
-                with open(info_file, 'r') as f:
-                    info = f.read()
-            except:
-                logger.exception('Get info file: ')
-                info = ''
-            data_file = os.path.join(self.tmp, task_id + '.dat')
-            try:
-                with open(data_file, 'r') as f:
-                    data = int(f.readlines()[-1])
-            except:
-                logger.exception('Get info file: ')
-                data = 0
-            status[task_id] = {
-                'info': info,
+        for task in tasks:
+            if task['id'] in status:
+                continue
+            disks = self.__disks(task['id']) if task['state'] == 'running' else dict()
+            data = sum(disk['percent'] for disk in disks.values()) // len(disks) if disks else 0
+            if task['state'] == 'done':
+                data = 100
+            etas = [disk['eta'] for disk in disks.values()]
+            status[task['id']] = {
+                'info': task['info'],
                 'data': data,
+                'disks': disks,
+                'throughput': sum(disk['throughput'] for disk in disks.values()),
+                'eta': -1.0 if not etas or min(etas) < 0 else max(etas),
+                'state': task['state'],
+                'pid': task['pid'],
+                'bytes': task['bytes'],
+                'error': task['error'],
+                'created': task['created'],
+                'started': task['started'],
+                'finished': task['finished'],
             }
         return status
 
+    def remove_progress(self, task_id):
+        """Drop the progress records of a finished task, only running tasks list their disks."""
+        for progress_file in self.__progress_files(task_id):
+            try:
+                os.remove(progress_file)
+            except FileNotFoundError:
+                pass
+
+    def __progress_files(self, task_id):
+        return glob.glob(os.path.join(self.tmp, glob.escape(task_id) + '_*.progress'))
+
+    def __disks(self, task_id):
+        disks = dict()
+        for progress_file in self.__progress_files(task_id):
+            disk_id = os.path.basename(progress_file)[len(task_id) + 1:-len('.progress')]
+            try:
+                record = progress.read_progress(progress_file)
+            except:
+                logger.exception('Get progress record: ')
+                record = None
+            if record is not None:
+                disks[disk_id] = record
+        return disks
+
     def status_file(self, task_id):
-        self.info_file = os.path.join(self.tmp, task_id + '.info')
+        self.task_id = task_id
 
     def send_info(self, data):
-        with open(self.info_file, 'a') as f:
-            f.write(data)
+        self.registry.add_info(self.task_id, data)
+
+    def add_bytes(self, count):
+        self.registry.add_bytes(self.task_id, count)
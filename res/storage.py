@@ -0,0 +1,282 @@
+import os
+import json
+from contextlib import nullcontext
+from concurrent.futures import ThreadPoolExecutor
+
+from res import app_logger, metrics, remote, s3
+logger = app_logger.get_logger(__name__)
+
+BACKENDS = ('local', 'remote', 's3')
+# parts of an S3 upload kept free of the image size, and their size unit
+PARTS_RESERVE = 100
+PART_ALIGNMENT = 1024 * 1024
+
+
+class LocalStorage:
+    """Backups under main_backup_dir on a POSIX path.
+
+    A backend stores the disk images and the small metadata files of a
+    backup (.meta, .extents, VM settings). Paths are the ones a local backup
+    would have, a backend maps them to its own namespace. open_image()
+    gives the copy engine either that path, the engine then reads and writes
+    the image itself, or a stream it copies through without staging the
+    image on local disk (streamed backends).
+
+    posix backends keep the metadata as local files, which the chunk store,
+    incremental images and the shell pipeline depend on.
+    """
+    name = 'local'
+    streamed = False
+    posix = True
+
+    def open_image(self, path, save, size=0):
+        """Image at path for the copy engine, size is the disk size of a
+        saved image when it is known."""
+        return nullcontext(path)
+
+    def makedirs(self, path):
+        os.makedirs(path, exist_ok=True)
+
+    def exists(self, path):
+        return os.path.exists(path)
+
+    def write_file(self, path, text):
+        with open(path, 'w') as f:
+            f.write(text)
+
+    def read_file(self, path):
+        with open(path, 'r') as f:
+            return f.read()
+
+    def write_json(self, path, data):
+        self.write_file(path, json.dumps(data))
+
+    def read_json(self, path):
+        return json.loads(self.read_file(path))
+
+
+class RemoteStorage(LocalStorage):
+    """Images on the remote server, streamed over the session of res.remote.
+    Metadata stays in the local tree as it always did with remote_server."""
+    name = 'remote'
+    streamed = True
+
+    def __init__(self, host, user, python):
+        self.host = host
+        self.user = user
+        self.python = python
+
+    def open_image(self, path, save, size=0):
+        session = remote.get_session(self.host, self.user, self.python)
+        return session.open_writer(path) if save else session.open_reader(path)
+
+
+class S3Storage(LocalStorage):
+    """Everything of a backup in an S3-compatible bucket, under
+    <prefix><path relative to main_backup_dir>.
+
+    Images are uploaded as multipart uploads of part_size parts, workers of
+    them at a time, and restored with that many ranged GETs in flight.
+    Memory use is bounded by about (workers + 1) parts per copy. Parts of
+    images too large for MAX_PARTS parts of part_size are made larger, up
+    front, as the part size can't change within an upload.
+    """
+    name = 's3'
+    streamed = True
+    posix = False
+
+    def __init__(self, client, root, prefix='', part_size=64 * 1024 * 1024, workers=4):
+        self.client = client
+        self.root = root
+        self.prefix = prefix
+        self.part_size = max(s3.MIN_PART_SIZE, part_size)
+        self.workers = max(1, workers)
+
+    def key(self, path):
+        relative = os.path.relpath(os.path.abspath(path), os.path.abspath(self.root))
+        if relative.startswith('..'):
+            relative = os.path.abspath(path).lstrip('/')
+        return self.prefix + relative.replace(os.sep, '/')
+
+    def open_image(self, path, save, size=0):
+        if save:
+            return S3Writer(self.client, self.key(path), self.upload_part_size(size), self.workers)
+        return S3Reader(self.client, self.key(path), self.part_size, self.workers)
+
+    def upload_part_size(self, size):
+        """Part size of an upload of about size bytes, within MAX_PARTS parts."""
+        # incompressible data grows a little in compression, the reserve leaves room for it
+        needed = -(-size // (s3.MAX_PARTS - PARTS_RESERVE))
+        return max(self.part_size, -(-needed // PART_ALIGNMENT) * PART_ALIGNMENT)
+
+    def makedirs(self, path):
+        pass
+
+    def exists(self, path):
+        return self.client.head_object(self.key(path)) is not None
+
+    def write_file(self, path, text):
+        self.client.put_object(self.key(path), text.encode('utf-8'))
+
+    def read_file(self, path):
+        key = self.key(path)
+        try:
+            return self.client.get_object(key).decode('utf-8')
+        except s3.S3Error as e:
+            if e.status == 404:
+                raise FileNotFoundError(key) from e
+            raise
+
+
+class S3Writer:
+    """Sequential writer of one object, uploaded in parts while it's written.
+
+    An object that ends within its first part is sent with one PUT. The
+    upload is aborted if the writer is left with an exception, so failed
+    copies don't leave parts billed in the bucket.
+    """
+    def __init__(self, client, key, part_size, workers):
+        self.client = client
+        self.key = key
+        self.part_size = part_size
+        self.workers = workers
+        self.buffer = bytearray()
+        self.upload_id = None
+        self.futures = list()
+        self.etags = list()
+        self.bytes = 0
+        self.executor = None
+
+    def write(self, data):
+        self.buffer += data
+        self.bytes += len(data)
+        while len(self.buffer) >= self.part_size:
+            with memoryview(self.buffer) as view:
+                part = bytes(view[:self.part_size])
+            del self.buffer[:self.part_size]
+            self.__upload(part)
+        return len(data)
+
+    def close(self):
+        try:
+            if self.upload_id is None:
+                self.client.put_object(self.key, bytes(self.buffer))
+            else:
+                if self.buffer:
+                    self.__upload(bytes(self.buffer))
+                self.etags.extend(future.result() for future in self.futures)
+                self.futures = list()
+                self.client.complete_multipart_upload(self.key, self.upload_id, self.etags)
+        except:
+            self.abort()
+            raise
+        finally:
+            self.buffer = bytearray()
+            self.__shutdown()
+        metrics.get_metrics().inc('ovbackup_s3_bytes_total', self.bytes, direction='write')
+
+    def abort(self):
+        for future in self.futures:
+            future.cancel()
+        self.__shutdown()
+        if self.upload_id is not None:
+            try:
+                self.client.abort_multipart_upload(self.key, self.upload_id)
+            except:
+                logger.exception(f'Abort upload of {self.key} error: ')
+
+    def __upload(self, part):
+        if self.upload_id is None:
+            self.upload_id = self.client.create_multipart_upload(self.key)
+            self.executor = ThreadPoolExecutor(max_workers=self.workers)
+        if len(self.etags) + len(self.futures) >= s3.MAX_PARTS:
+            raise s3.S3Error(0, 'TooManyParts', f'{self.key} needs more than {s3.MAX_PARTS} parts')
+        # at most workers parts in flight, the writer waits for the oldest
+        while len(self.futures) >= self.workers:
+            self.etags.append(self.futures.pop(0).result())
+        number = len(self.etags) + len(self.futures) + 1
+        self.futures.append(self.executor.submit(self.client.upload_part, self.key, self.upload_id, number, part))
+
+    def __shutdown(self):
+        if self.executor is not None:
+            self.executor.shutdown(wait=True)
+            self.executor = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+
+class S3Reader:
+    """Sequential reader of one object with workers ranged GETs of part_size
+    fetched ahead of the position."""
+    def __init__(self, client, key, part_size, workers):
+        self.client = client
+        self.key = key
+        self.part_size = part_size
+        self.workers = workers
+        self.size = client.head_object(key)
+        if self.size is None:
+            raise FileNotFoundError(key)
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        # offset: future of the range starting there
+        self.ranges = dict()
+        self.requested = 0
+        self.position = 0
+        self.part = b''
+        self.part_offset = 0
+
+    def readinto(self, buffer):
+        view = memoryview(buffer).cast('B')
+        filled = 0
+        while filled < len(view) and self.position < self.size:
+            start = self.position - self.part_offset
+            if start >= len(self.part):
+                self.__next_part()
+                continue
+            length = min(len(self.part) - start, len(view) - filled)
+            view[filled:filled + length] = self.part[start:start + length]
+            filled += length
+            self.position += length
+        return filled
+
+    def close(self):
+        for future in self.ranges.values():
+            future.cancel()
+        self.ranges = dict()
+        self.executor.shutdown(wait=True)
+        metrics.get_metrics().inc('ovbackup_s3_bytes_total', self.position, direction='read')
+
+    def __next_part(self):
+        while self.requested < self.size and len(self.ranges) < self.workers + 1:
+            self.ranges[self.requested] = self.executor.submit(
+                self.client.get_object, self.key, self.requested, min(self.part_size, self.size - self.requested))
+            self.requested += self.part_size
+        self.part = self.ranges.pop(self.position).result()
+        self.part_offset = self.position
+        if not self.part:
+            raise EOFError(f'{self.key} ended at {self.position} of {self.size}')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+def get_storage(config):
+    """Backend of the engine configuration."""
+    backend = config.get_storage()
+    if backend == 'remote':
+        return RemoteStorage(config.get_remote_fqdn(), config.get_remote_user(), config.get_remote_python())
+    if backend == 's3':
+        client = s3.get_client(config.get_s3_endpoint(), config.get_s3_bucket(), config.get_s3_access_key(),
+                               config.get_s3_secret_key(), config.get_s3_region())
+        return S3Storage(client, config.get_backup_dir(), config.get_s3_prefix(), config.get_s3_part_size(),
+                         config.get_s3_workers())
+    return LocalStorage()
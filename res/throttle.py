@@ -0,0 +1,175 @@
+import os
+import mmap
+import time
+import fcntl
+import threading
+from contextlib import contextmanager
+
+from res import app_logger
+logger = app_logger.get_logger(__name__)
+
+DIRECTIONS = ('read', 'write')
+# priority classes, highest first
+CLASSES = ('interactive', 'normal', 'background')
+DEFAULT_CLASS = {'restore': 'interactive', 'backup': 'background'}
+# seconds of its rate a bucket can hold
+BURST = 0.5
+# share of the daemon bucket a class leaves to a busy higher class
+RESERVE = 0.5
+# a class is busy for this long after it asked for tokens
+ACTIVE = 1.0
+MAX_SLEEP = 0.1
+
+# doubles per direction: daemon rate, tokens, refill time, then per class
+# rate, tokens, refill time and last demand
+DAEMON_SLOTS = 3
+CLASS_SLOTS = 4
+STRIDE = DAEMON_SLOTS + CLASS_SLOTS * len(CLASSES)
+SIZE = 8 * STRIDE * len(DIRECTIONS)
+
+
+class Throttle:
+    """Token buckets shared by every copy of the daemon and its workers.
+
+    Each direction has a daemon-wide bucket and one bucket per priority
+    class, a copy takes the bytes it reads or writes from both. Rates of 0
+    are unlimited. The buckets are doubles in a small memory-mapped file, so
+    the worker processes share them with the daemon, updated under flock (and
+    a thread lock, flock doesn't exclude threads of one process). Limits are
+    read from the file on every acquire, a change made with set_limits() is
+    seen by running copies at their next block.
+
+    Priority: while a higher class is busy, a lower one only takes tokens
+    when the daemon bucket is more than RESERVE full, so it gets what the
+    higher class leaves unused and yields the rest.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+        with self.__locked():
+            if os.fstat(self.fd).st_size != SIZE:
+                os.ftruncate(self.fd, 0)
+                os.ftruncate(self.fd, SIZE)
+        self.map = mmap.mmap(self.fd, SIZE)
+        self.slots = memoryview(self.map).cast('d')
+
+    def set_limits(self, read=None, write=None, classes=None):
+        """Set daemon and class rates in bytes/s, None leaves a rate as is."""
+        with self.__locked():
+            for number, rate in enumerate((read, write)):
+                if rate is not None:
+                    self.slots[number * STRIDE] = max(0.0, float(rate))
+            for io_class, rates in (classes or dict()).items():
+                index = CLASSES.index(io_class)
+                for number, direction in enumerate(DIRECTIONS):
+                    if rates.get(direction) is not None:
+                        self.slots[self.__class_base(number, index)] = max(0.0, float(rates[direction]))
+        logger.info(f'Throttle limits: {self.limits()}')
+
+    def limits(self):
+        limits = {direction: self.slots[number * STRIDE] for number, direction in enumerate(DIRECTIONS)}
+        limits['classes'] = {
+            io_class: {
+                direction: self.slots[self.__class_base(number, index)]
+                for number, direction in enumerate(DIRECTIONS)
+            }
+            for index, io_class in enumerate(CLASSES)
+        }
+        return limits
+
+    def rate(self, direction, io_class):
+        """Current limit of a class in bytes/s, 0 if it is unlimited."""
+        number = DIRECTIONS.index(direction)
+        rates = [self.slots[number * STRIDE], self.slots[self.__class_base(number, CLASSES.index(io_class))]]
+        return min([rate for rate in rates if rate] or [0.0])
+
+    def acquire(self, direction, io_class, count):
+        """Block until count bytes may be moved, return the seconds waited."""
+        number = DIRECTIONS.index(direction)
+        index = CLASSES.index(io_class)
+        base = number * STRIDE
+        class_base = self.__class_base(number, index)
+        if not self.slots[base] and not self.slots[class_base]:
+            return 0.0
+        waited = 0.0
+        while True:
+            with self.__locked():
+                now = time.monotonic()
+                self.slots[class_base + 3] = now
+                wait = max(
+                    self.__shortage(class_base, count, now, 0.0),
+                    self.__shortage(base, count, now, self.__reserve(number, index, now)),
+                )
+                if wait <= 0:
+                    for start in (base, class_base):
+                        if self.slots[start]:
+                            self.slots[start + 1] -= count
+                    return waited
+            wait = min(wait, MAX_SLEEP)
+            time.sleep(wait)
+            waited += wait
+
+    def limiter(self, io_class):
+        return Limiter(self, io_class if io_class in CLASSES else 'normal')
+
+    def close(self):
+        self.slots.release()
+        self.map.close()
+        os.close(self.fd)
+
+    def __shortage(self, start, count, now, reserve):
+        """Refill the bucket at start, return seconds until it holds count
+        bytes above reserve (0 if it does now)."""
+        rate = self.slots[start]
+        if not rate:
+            return 0.0
+        capacity = max(rate * BURST, count)
+        tokens = min(capacity, self.slots[start + 1] + rate * max(0.0, now - self.slots[start + 2]))
+        self.slots[start + 1] = tokens
+        self.slots[start + 2] = now
+        missing = min(capacity, count + capacity * reserve) - tokens
+        return missing / rate if missing > 0 else 0.0
+
+    def __reserve(self, number, index, now):
+        for higher in range(index):
+            if now - self.slots[self.__class_base(number, higher) + 3] < ACTIVE:
+                return RESERVE
+        return 0.0
+
+    @staticmethod
+    def __class_base(number, index):
+        return number * STRIDE + DAEMON_SLOTS + index * CLASS_SLOTS
+
+    @contextmanager
+    def __locked(self):
+        with self.lock:
+            fcntl.flock(self.fd, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(self.fd, fcntl.LOCK_UN)
+
+
+class Limiter:
+    """Throttle bound to the priority class of one job, for CopyEngine."""
+    def __init__(self, throttle, io_class):
+        self.throttle = throttle
+        self.io_class = io_class
+
+    def acquire(self, direction, count):
+        return self.throttle.acquire(direction, self.io_class, count)
+
+    def rate(self, direction):
+        return self.throttle.rate(direction, self.io_class)
+
+
+_throttles = dict()
+_throttles_lock = threading.Lock()
+
+
+def get_throttle(path):
+    with _throttles_lock:
+        if path not in _throttles:
+            _throttles[path] = Throttle(path)
+        return _throttles[path]
@@ -7,7 +7,11 @@ COMPRESS_TYPES = {
     "lzo": (".lzo", ["lzop", "-c"], ["lzop", "-d"]),
     "lzma": (".lzma", ["lzma", "-c"], ["unlzma", "-c"]),
     "xz": (".xz", ["xz", "-c"], ["xz", "-d"]),
-    "pbzip2": (".pbzip2", ["pbzip2", "-c"], ["pbzip2", "-d"])
+    "pbzip2": (".pbzip2", ["pbzip2", "-c"], ["pbzip2", "-d"]),
+    # built-in multi-threaded framed codecs, no external pipeline
+    "zlib-mt": (".zlib.ovbf", None, None),
+    "bzip2-mt": (".bzip2.ovbf", None, None),
+    "xz-mt": (".xz.ovbf", None, None),
 }
 DISK_FORMAT = {
     'cow': types.DiskFormat.COW,
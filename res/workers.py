@@ -0,0 +1,370 @@
+import time
+import heapq
+import signal
+import itertools
+import threading
+import multiprocessing
+from collections import OrderedDict
+from multiprocessing import connection as mp_connection
+
+from res import app_logger, config_tool, connection_pool, metrics
+logger = app_logger.get_logger(__name__)
+
+WORKERS = 2
+MAX_QUEUE = 100
+MAX_TASKS = 50
+SUPERVISE_INTERVAL = 0.5
+# final states kept for tasks that are no longer queued or running
+FINISHED_HISTORY = 1000
+# a cancelled task has this long to clean up before its worker is killed
+CANCEL_GRACE = 120
+# respawn delay after a worker died before its first task, doubled per death
+RESPAWN_BACKOFF = 1
+RESPAWN_MAX = 60
+
+# set in a worker process when its running task is cancelled
+_cancel = threading.Event()
+
+
+class TaskCancelled(Exception):
+    pass
+
+
+def cancel_event():
+    """Event of the worker process that is set when its task is cancelled."""
+    return _cancel
+
+
+def check_cancelled():
+    if _cancel.is_set():
+        raise TaskCancelled('Task cancelled')
+
+
+def _warm_up():
+    """Log in to the engines before the first task instead of during it."""
+    for engine in config_tool.ConfigTool().get_engines():
+        try:
+            pool = connection_pool.get_pool(engine, config_tool.ConfigTool(engine))
+            pool.give_back(pool.borrow())
+        except:
+            logger.exception(f'Warm up {engine} error: ')
+
+
+def _worker_main(pipe, runners, config_folder):
+    # a spawned worker imports config_tool again in the working directory of
+    # the daemon, which isn't the one the daemon resolved its config in
+    config_tool.CONFIG_FOLDER = config_folder
+    running = threading.Event()
+
+    def on_terminate(signum, frame):
+        # a running task is asked to stop and cleans up on its way out
+        if not running.is_set():
+            raise SystemExit(0)
+        _cancel.set()
+
+    signal.signal(signal.SIGTERM, on_terminate)
+    _warm_up()
+    while True:
+        task = pipe.recv()
+        if task is None:
+            break
+        task_id, kind, settings = task
+        _cancel.clear()
+        running.set()
+        try:
+            runners[kind](settings, task_id)
+        except Exception as e:
+            if _cancel.is_set():
+                state, error = 'cancelled', None
+            else:
+                logger.exception(f'Task {task_id} error: ')
+                state, error = 'failed', repr(e)
+        else:
+            state, error = 'cancelled' if _cancel.is_set() else 'done', None
+        running.clear()
+        pipe.send((task_id, state, error, metrics.get_metrics().snapshot()))
+
+
+class Worker:
+    def __init__(self, process, pipe):
+        self.process = process
+        self.pipe = pipe
+        self.task_id = None
+        self.tasks = 0
+        self.cancelled = False
+        self.cancel_time = 0.0
+        # cumulative metrics of the worker, as of its last finished task
+        self.metrics = None
+
+
+class WorkerPool:
+    """Supervisor of pre-started task processes.
+
+    Every worker imports the task code and logs in to the engines once, at
+    start, then runs tasks sent through its pipe one after another, so a task
+    starts in the time of a pipe write. Tasks beyond the number of workers wait
+    in a bounded priority queue (higher priority first, FIFO within one
+    priority). A queued task is cancelled by dropping it, a running one by a
+    SIGTERM to its worker: the task stops at its next check, detaching its
+    disks on the way, and a worker still busy CANCEL_GRACE later is killed
+    and replaced. Workers are recycled after max_tasks tasks to keep their
+    memory bounded; one that dies before its first task is replaced after a
+    growing delay, so a broken setup doesn't spawn processes in a loop.
+    on_start(task_id, pid) and on_finish(task_id, state, error) are called
+    outside the pool lock.
+    """
+    def __init__(self, runners, workers=WORKERS, max_queue=MAX_QUEUE, max_tasks=MAX_TASKS,
+                 on_start=None, on_finish=None):
+        self.runners = runners
+        self.size = workers
+        self.max_queue = max_queue
+        self.max_tasks = max_tasks
+        self.on_start = on_start
+        self.on_finish = on_finish
+        self.context = multiprocessing.get_context('spawn')
+        self.condition = threading.Condition()
+        self.queue = list()
+        self.queued = dict()
+        self.counter = itertools.count()
+        self.closed = False
+
+        self.submitted = dict()
+        self.finished = OrderedDict()
+        self.events = list()
+        self.retired_metrics = metrics.Metrics()
+        self.failures = 0
+        self.respawn_at = 0.0
+
+        self.workers = [self.__start_worker() for i in range(self.size)]
+        self.thread = threading.Thread(target=self.__supervise, daemon=True)
+        self.thread.start()
+
+    def submit(self, task_id, kind, settings, priority=0):
+        with self.condition:
+            if self.closed:
+                return {'id': task_id, 'state': 'rejected'}
+            if task_id in self.queued or self.__running(task_id):
+                return {'id': task_id, 'state': 'duplicate'}
+            if len(self.queued) >= self.max_queue:
+                return {'id': task_id, 'state': 'rejected'}
+            entry = [-priority, next(self.counter), task_id, kind, settings]
+            heapq.heappush(self.queue, entry)
+            self.queued[task_id] = entry
+            self.submitted[task_id] = time.monotonic()
+            started = self.__dispatch()
+        self.__notify(started, list())
+        with self.condition:
+            worker = self.__running(task_id)
+            if worker:
+                return {'id': task_id, 'state': 'running', 'pid': worker.process.pid}
+            return {'id': task_id, 'state': 'queued', 'position': len(self.queued)}
+
+    def cancel(self, task_id):
+        with self.condition:
+            entry = self.queued.pop(task_id, None)
+            if entry:
+                # lazy removal, dropped when it reaches the top of the heap
+                entry[2] = None
+                self.submitted.pop(task_id, None)
+                self.__remember(task_id, 'cancelled')
+                finished, self.events = self.events, list()
+        if entry:
+            self.__notify(list(), finished)
+            return {'id': task_id, 'state': 'cancelled'}
+        with self.condition:
+            worker = self.__running(task_id)
+            if worker is None:
+                return {'id': task_id, 'state': self.finished.get(task_id, 'unknown')}
+            if not worker.cancelled:
+                worker.cancelled = True
+                worker.cancel_time = time.monotonic()
+                worker.process.terminate()
+            return {'id': task_id, 'state': 'cancelling'}
+
+    def metrics_snapshots(self):
+        """Metrics of the workers and the current load of the pool."""
+        load = metrics.Metrics()
+        with self.condition:
+            snapshots = [worker.metrics for worker in self.workers if worker.metrics]
+            load.set('ovbackup_workers', len(self.workers))
+            load.set('ovbackup_workers_busy', sum(1 for worker in self.workers if worker.task_id is not None))
+            load.set('ovbackup_tasks_queued', len(self.queued))
+        return [self.retired_metrics.snapshot(), load.snapshot()] + snapshots
+
+    def close(self):
+        with self.condition:
+            self.closed = True
+            workers = list(self.workers)
+        for worker in workers:
+            try:
+                worker.pipe.send(None)
+            except OSError:
+                pass
+        for worker in workers:
+            worker.process.join(timeout=1)
+            if worker.process.is_alive():
+                worker.process.terminate()
+        deadline = time.monotonic() + CANCEL_GRACE
+        for worker in workers:
+            worker.process.join(timeout=max(0.0, deadline - time.monotonic()))
+            if worker.process.is_alive():
+                worker.process.kill()
+
+    def __start_worker(self):
+        parent_pipe, child_pipe = self.context.Pipe()
+        process = self.context.Process(
+            target=_worker_main, args=(child_pipe, self.runners, config_tool.CONFIG_FOLDER), daemon=True)
+        process.start()
+        child_pipe.close()
+        return Worker(process, parent_pipe)
+
+    def __running(self, task_id):
+        for worker in self.workers:
+            if worker.task_id == task_id:
+                return worker
+        return None
+
+    def __dispatch(self):
+        """Hand queued tasks to idle workers, called with the lock held."""
+        started = list()
+        for worker in self.workers:
+            if worker.task_id is not None:
+                continue
+            while self.queue and self.queue[0][2] is None:
+                heapq.heappop(self.queue)
+            if not self.queue:
+                break
+            priority, number, task_id, kind, settings = heapq.heappop(self.queue)
+            del self.queued[task_id]
+            worker.pipe.send((task_id, kind, settings))
+            worker.task_id = task_id
+            latency = time.monotonic() - self.submitted.pop(task_id)
+            metrics.get_metrics().observe('ovbackup_task_start_latency_seconds', latency)
+            started.append((task_id, worker.process.pid))
+        return started
+
+    def __notify(self, started, finished):
+        for task_id, pid in started:
+            if self.on_start is None:
+                break
+            try:
+                self.on_start(task_id, pid)
+            except:
+                logger.exception('Task start callback error: ')
+        for task_id, state, error in finished:
+            if self.on_finish is None:
+                break
+            try:
+                self.on_finish(task_id, state, error)
+            except:
+                logger.exception('Task finish callback error: ')
+
+    def __finish(self, worker, state, error=None):
+        logger.info(f'Task {worker.task_id} {state}')
+        self.__remember(worker.task_id, state, error)
+        worker.task_id = None
+        worker.cancelled = False
+        worker.tasks += 1
+        self.failures = 0
+
+    def __remember(self, task_id, state, error=None):
+        self.events.append((task_id, state, error))
+        self.finished[task_id] = state
+        while len(self.finished) > FINISHED_HISTORY:
+            self.finished.popitem(last=False)
+
+    def __replace(self, worker):
+        if worker.metrics:
+            self.retired_metrics.merge(worker.metrics)
+        self.workers.remove(worker)
+        self.__respawn()
+
+    def __respawn(self):
+        if time.monotonic() < self.respawn_at:
+            return
+        while len(self.workers) < self.size:
+            self.workers.append(self.__start_worker())
+
+    def __kill_cancelled(self):
+        """Kill workers whose cancelled task didn't stop within CANCEL_GRACE."""
+        now = time.monotonic()
+        for worker in self.workers:
+            if worker.cancelled and now - worker.cancel_time > CANCEL_GRACE and worker.process.is_alive():
+                logger.warning(f'Task {worker.task_id} ignored the cancel, killing worker {worker.process.pid}')
+                worker.process.kill()
+
+    def __supervise(self):
+        while True:
+            with self.condition:
+                if self.closed:
+                    return
+                waitables = dict()
+                for worker in self.workers:
+                    waitables[worker.pipe] = worker
+                    waitables[worker.process.sentinel] = worker
+            ready = mp_connection.wait(list(waitables), timeout=SUPERVISE_INTERVAL)
+            with self.condition:
+                if self.closed:
+                    return
+                # results first, a worker may have exited right after sending one
+                for handle in ready:
+                    worker = waitables[handle]
+                    if handle is not worker.pipe or worker not in self.workers:
+                        continue
+                    try:
+                        task_id, state, error, worker.metrics = worker.pipe.recv()
+                    except (EOFError, OSError):
+                        continue
+                    self.__finish(worker, state, error)
+                    if worker.tasks >= self.max_tasks:
+                        worker.pipe.send(None)
+                        self.__replace(worker)
+                for handle in ready:
+                    worker = waitables[handle]
+                    if handle is worker.pipe or worker not in self.workers:
+                        continue
+                    if worker.task_id is not None:
+                        if worker.cancelled:
+                            self.__finish(worker, 'cancelled')
+                        else:
+                            self.__finish(worker, 'failed', f'worker exited with {worker.process.exitcode}')
+                    elif not worker.tasks:
+                        self.failures += 1
+                        delay = min(RESPAWN_MAX, RESPAWN_BACKOFF * 2 ** (self.failures - 1))
+                        self.respawn_at = time.monotonic() + delay
+                        logger.error(f'Worker {worker.process.pid} died before its first task, '
+                                     f'respawning in {delay}s')
+                    else:
+                        logger.error(f'Worker {worker.process.pid} died')
+                    self.__replace(worker)
+                self.__respawn()
+                self.__kill_cancelled()
+                started = self.__dispatch()
+                finished, self.events = self.events, list()
+            self.__notify(started, finished)
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def get_pool(runners, on_start=None, on_finish=None):
+    """Task worker pool of the daemon, started from the base config on first use."""
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            config = config_tool.ConfigTool()
+            _pool = WorkerPool(
+                runners,
+                workers=config.get_task_workers(),
+                max_queue=config.get_task_queue(),
+                max_tasks=config.get_worker_max_tasks(),
+                on_start=on_start,
+                on_finish=on_finish,
+            )
+        return _pool
+
+
+def get_metrics_snapshots():
+    with _pool_lock:
+        return _pool.metrics_snapshots() if _pool else list()
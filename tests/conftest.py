@@ -0,0 +1,12 @@
+import os
+import sys
+import tempfile
+
+TESTS_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(TESTS_DIR)
+sys.path.insert(0, REPO_DIR)
+sys.path.insert(0, os.path.join(REPO_DIR, 'bench'))
+
+from res import app_logger
+# the daemon log lives under /var/log, tests log next to their temporary files
+app_logger.LOGGING_CONFIG['handlers']['default']['filename'] = os.path.join(tempfile.gettempdir(), 'ovbackup-tests.log')
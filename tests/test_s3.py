@@ -0,0 +1,125 @@
+"""S3 storage backend against bench/fake_s3.py, a local S3-compatible store."""
+import os
+import random
+
+import pytest
+
+import fake_s3
+from res import s3, storage
+
+BUCKET = 'backups'
+MIB = 1024 * 1024
+
+
+@pytest.fixture
+def store(tmp_path):
+    store = fake_s3.FakeS3(str(tmp_path / 's3')).start()
+    yield store
+    store.stop()
+
+
+@pytest.fixture
+def client(store):
+    client = s3.S3Client(store.endpoint, BUCKET, fake_s3.ACCESS_KEY, fake_s3.SECRET_KEY)
+    yield client
+    client.close()
+
+
+@pytest.fixture
+def backend(client):
+    return storage.S3Storage(client, '/backups', part_size=s3.MIN_PART_SIZE, workers=2)
+
+
+@pytest.fixture(autouse=True)
+def no_backoff(monkeypatch):
+    monkeypatch.setattr(s3, 'BACKOFF', 0)
+
+
+def object_path(store, key):
+    return os.path.join(store.root, BUCKET, key)
+
+
+def uploads(store):
+    return os.listdir(os.path.join(store.root, '.uploads'))
+
+
+def write_image(backend, path, data, block=MIB + 123):
+    with backend.open_image(path, True) as image:
+        for offset in range(0, len(data), block):
+            image.write(data[offset:offset + block])
+
+
+def test_multipart_upload(store, backend):
+    data = random.Random(1).randbytes(3 * s3.MIN_PART_SIZE + 12345)
+    write_image(backend, '/backups/vm/disk.img', data)
+    with open(object_path(store, 'vm/disk.img'), 'rb') as f:
+        assert f.read() == data
+    # one upload of four parts, nothing left of it
+    assert store.requests['POST'] == 2
+    assert store.requests['PUT'] == 4
+    assert uploads(store) == []
+
+
+def test_small_image_single_put(store, backend):
+    write_image(backend, '/backups/vm/small.img', b'x' * 1000)
+    assert store.requests == {'PUT': 1}
+    assert backend.read_file('/backups/vm/small.img') == 'x' * 1000
+
+
+def test_ranged_reads(store, client, backend):
+    data = random.Random(2).randbytes(2 * s3.MIN_PART_SIZE + 777)
+    write_image(backend, '/backups/vm/disk.img', data)
+    assert client.get_object('vm/disk.img', 100, 50) == data[100:150]
+    assert client.get_object('vm/disk.img', len(data) - 10) == data[-10:]
+    restored = bytearray()
+    buffer = bytearray(MIB - 1)
+    with backend.open_image('/backups/vm/disk.img', False) as image:
+        while True:
+            size = image.readinto(buffer)
+            if not size:
+                break
+            restored += buffer[:size]
+    assert restored == data
+
+
+def test_failed_copy_aborts_upload(store, backend):
+    with pytest.raises(RuntimeError):
+        with backend.open_image('/backups/vm/disk.img', True) as image:
+            image.write(bytes(2 * s3.MIN_PART_SIZE))
+            raise RuntimeError('copy failed')
+    assert not os.path.exists(object_path(store, 'vm/disk.img'))
+    assert uploads(store) == []
+    assert store.requests['DELETE'] == 1
+
+
+def test_retry_on_server_errors(store, backend):
+    data = random.Random(3).randbytes(2 * s3.MIN_PART_SIZE)
+    store.fail('PUT', count=2)
+    store.fail('POST', count=1)
+    write_image(backend, '/backups/vm/disk.img', data)
+    with open(object_path(store, 'vm/disk.img'), 'rb') as f:
+        assert f.read() == data
+
+
+def test_gives_up_after_retries(store, client):
+    store.fail('GET', count=s3.RETRIES + 1)
+    client.put_object('vm/disk.meta', b'{}')
+    with pytest.raises(s3.S3Error) as error:
+        client.get_object('vm/disk.meta')
+    assert error.value.status == 503
+    assert store.requests['GET'] == s3.RETRIES + 1
+
+
+def test_missing_object(client, backend):
+    assert client.head_object('vm/none.meta') is None
+    with pytest.raises(FileNotFoundError):
+        backend.read_file('/backups/vm/none.meta')
+
+
+def test_part_size_fits_large_disks(backend):
+    assert backend.upload_part_size(0) == s3.MIN_PART_SIZE
+    assert backend.upload_part_size(10 * 1024 ** 3) == s3.MIN_PART_SIZE
+    size = 4 * 1024 ** 4
+    part_size = backend.upload_part_size(size)
+    assert part_size % MIB == 0
+    assert size * 1.005 / part_size <= s3.MAX_PARTS